@@ -84,6 +84,10 @@ setup(
         "wrapt==1.12.1",
         "zipp==0.5.1"
     ],
+    # The parquet and arrow formats of the results: pip install .[arrow]
+    extras_require={
+        'arrow': ["pyarrow"]
+    },
     python_requires='>=3.6',
     entry_points={
         'console_scripts': [
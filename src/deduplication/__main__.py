@@ -3,17 +3,119 @@ import datetime
 import os
 
 from deduplication.commands.delete import delete
+from deduplication.commands.helpers import deletion_modes, keep_policies, results_formats
+from deduplication.commands.enqueue import enqueue
+from deduplication.commands.estimate import estimate
+from deduplication.commands.join import join
+from deduplication.commands.merge import merge
+from deduplication.commands.purge import purge
+from deduplication.commands.resume import resume
 from deduplication.commands.search import search
+from deduplication.commands.shard_map import shard_map
+from deduplication.commands.shard_reduce import shard_reduce
 from deduplication.commands.show import show
-from deduplication.dataset.ImageToHash import ImageToHash
+from deduplication.commands.undo import undo
+from deduplication.commands.worker import worker
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.dataset.ImageToHash import ImageToHash, scheduling_orders
+from deduplication.duplicatefinder.GroupWriter import group_formats
+from deduplication.utils.ArrowUtils import ArrowUtils
 from deduplication.utils.CommandLine import CommandLine
-from deduplication.utils.FileSystem import FileSystem
+from deduplication.utils.CpuUtils import worker_priorities
+from deduplication.utils.FileSystem import FileSystem, backup_methods, link_methods
 
 """
 (C) Umberto Griffo, 2019
 """
 
 
+def image_to_hash_args(args):
+    """The arguments of ImageToHash that control how the images are read.
+
+    Parameters
+    ----------
+    args
+        The parsed command line arguments.
+
+    Returns
+    -------
+    A dict of keyword arguments.
+    """
+    return {'scheduling_order': args.scheduling_order,
+            'max_bytes_per_second': args.max_read_rate,
+            'max_files_per_second': args.max_files_rate,
+            'worker_priority': args.worker_priority,
+            'image_timeout': args.image_timeout,
+            'max_image_pixels': args.max_image_pixels,
+            'max_worker_memory': args.max_worker_memory,
+            'quality_score': args.quality_score}
+
+
+def build_dataset(args):
+    """Hash the images of args.images_path, or open the dataset saved in args.load_dataset.
+
+    Parameters
+    ----------
+    args
+        The parsed command line arguments.
+
+    Returns
+    -------
+    The dataset and the list of images.
+    """
+    if args.load_dataset is not None:
+        dataset = HashDataset.load(args.load_dataset)
+        print("Dataset loaded from {0}: {1} images".format(args.load_dataset, len(dataset)))
+        if args.export_dataset is not None:
+            ArrowUtils.write_dataset(dataset, args.export_dataset)
+        return dataset, dataset.files
+
+    image_to_hash = ImageToHash(args.images_path,
+                                hash_size=args.hash_size,
+                                hash_algo=args.hash_algorithm,
+                                checkpoint_path=args.checkpoint,
+                                quarantine_path=args.quarantine_file,
+                                **image_to_hash_args(args))
+
+    dataset, img_file_list = image_to_hash.build_dataset(parallel=args.parallel, batch_size=args.batch_size,
+                                                         workers=args.workers)
+    if args.save_dataset is not None:
+        image_to_hash.save_dataset(args.save_dataset)
+    if args.export_dataset is not None:
+        ArrowUtils.write_dataset(dataset, args.export_dataset)
+
+    return dataset, img_file_list
+
+
+def build_join_dataset(args, dataset):
+    """Open the collection args.join_path: a saved dataset, or a directory of images hashed like dataset.
+
+    Parameters
+    ----------
+    args
+        The parsed command line arguments.
+    dataset
+        The other collection of the join.
+
+    Returns
+    -------
+    The dataset of the collection.
+    """
+    if HashDataset.is_saved_dataset(args.join_path):
+        join_dataset = HashDataset.load(args.join_path)
+        print("Dataset loaded from {0}: {1} images".format(args.join_path, len(join_dataset)))
+        return join_dataset
+
+    image_to_hash = ImageToHash(args.join_path,
+                                hash_size=dataset.hash_size,
+                                hash_algo=dataset.hash_algo,
+                                quarantine_path=args.quarantine_file,
+                                **image_to_hash_args(args))
+    join_dataset, _ = image_to_hash.build_dataset(parallel=args.parallel, batch_size=args.batch_size,
+                                                  workers=args.workers)
+    return join_dataset
+
+
 def main(args=None):
 
     # Parse command line arguments
@@ -22,18 +124,25 @@ def main(args=None):
     parser.add_argument("command",
                         metavar="<command>",
                         type=str,
-                        choices=['delete', 'show', 'search'],
-                        help='delete or show or search.')
+                        choices=['delete', 'show', 'search', 'join', 'enqueue', 'worker', 'merge', 'shard-map',
+                                 'shard-reduce', 'purge', 'resume', 'undo', 'estimate'],
+                        help='delete or show or search. join finds the images that near-duplicate images of '
+                             'another collection. enqueue, worker and merge hash the images on several machines '
+                             'through a shared --queue. shard-map and shard-reduce find the duplicates shard by '
+                             'shard through a shared --shards-path. purge deletes the images quarantined by the '
+                             'run --run-path, resume finishes its deletions after a crash and undo restores its '
+                             'images. estimate extrapolates the near duplicates and the reclaimable bytes of '
+                             '--images-path from a sample.')
     parser.add_argument('--images-path',
-                        required=True,
+                        required=False,
                         metavar="/path/to/images/",
                         type=str,
-                        help='The Directory containing images.')
+                        help='The Directory containing images. Required unless --load-dataset is set.')
     parser.add_argument('--output-path',
-                        required=True,
+                        required=False,
                         metavar="/path/to/output/",
                         type=str,
-                        help='The Directory containing results.')
+                        help='The Directory containing results. Required by delete, show, search and join.')
     parser.add_argument("-q",
                         "--query",
                         required=False,
@@ -93,7 +202,13 @@ def main(args=None):
     parser.add_argument("--batch-size",
                         type=int,
                         default=32,
-                        help="The batch size is used when parallel is set to true.")
+                        help="The batch size is used when parallel is set to true, and by join to query the "
+                             "smaller collection.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="The number of workers used when parallel is set to true. "
+                             "By default the CPUs available to the process (affinity and cgroup quota).")
     parser.add_argument("--backup-keep",
                         type=CommandLine.str2bool,
                         nargs='?',
@@ -106,12 +221,73 @@ def main(args=None):
                         const=True,
                         default='true',
                         help="Whether to save the duplicates into a folder.")
+    parser.add_argument("--backup-method",
+                        type=str,
+                        default='auto',
+                        choices=list(backup_methods.keys()),
+                        help="How the images are saved into the folders: auto makes a reflink, else a hard link, "
+                             "else a copy. The links fall back to a copy across filesystems.")
     parser.add_argument("--safe-deletion",
                         type=CommandLine.str2bool,
                         nargs='?',
                         const=True,
                         default='false',
                         help="Whether to execute the deletion without really deleting nothing.")
+    parser.add_argument("--deletion-mode",
+                        type=str,
+                        default='delete',
+                        choices=deletion_modes,
+                        help="quarantine moves the duplicates into the output folder with a rename and writes a "
+                             "manifest, instead of backing them up and deleting them. Use purge to delete them. "
+                             "link replaces each duplicate with a link to the image kept in its place, see "
+                             "--link-method.")
+    parser.add_argument("--keep",
+                        type=str,
+                        default='first',
+                        choices=keep_policies,
+                        help="The image kept among near duplicates: the first one in natural order, the largest "
+                             "file, the newest or oldest capture (EXIF, else modification time), the most pixels, "
+                             "the sharpest (see --quality-score) or the first one of --priority-paths. Decided from "
+                             "the metadata of the hashing, no image is read again.")
+    parser.add_argument("--priority-paths",
+                        nargs='+',
+                        metavar="/path/to/folder/",
+                        type=str,
+                        default=None,
+                        help="The folders in order of preference for --keep path-priority.")
+    parser.add_argument("--stream-groups",
+                        type=str,
+                        default=None,
+                        choices=group_formats,
+                        help="Stream the groups of near duplicates into duplicate_groups_*.jsonl or .csv as they "
+                             "are selected, with the image kept, the images removed and their distances. parquet "
+                             "and arrow write the same rows in batches, readable once the run is over.")
+    parser.add_argument("--max-radius",
+                        type=int,
+                        default=None,
+                        help="Build the single-linkage hierarchy of the near duplicates within this distance, cut "
+                             "it at --threshold and write the number of groups and of removed images of every "
+                             "threshold up to it into threshold_summary_*.csv. Only delete supports it.")
+    parser.add_argument("--forest",
+                        required=False,
+                        metavar="/path/to/forest.npz",
+                        type=str,
+                        default=None,
+                        help="Save the hierarchy of --max-radius into this file, the next runs on the same dataset "
+                             "reuse it to cut other thresholds without querying the images again.")
+    parser.add_argument("--link-method",
+                        type=str,
+                        default='hardlink',
+                        choices=link_methods,
+                        help="The links made by --deletion-mode link. A duplicate is only replaced if it and the "
+                             "kept image still have the size and the modification time of the hashing, the link is "
+                             "renamed over the duplicate, which is never missing.")
+    parser.add_argument("--run-path",
+                        required=False,
+                        metavar="/path/to/output/run/",
+                        type=str,
+                        default=None,
+                        help="The output folder of a run, required by purge, resume and undo.")
     parser.add_argument("--image-w",
                         type=int,
                         default=128,
@@ -120,13 +296,313 @@ def main(args=None):
                         type=int,
                         default=128,
                         help="The source image is resized down to or up to the specified size.")
+    parser.add_argument("--scheduling-order",
+                        type=str,
+                        default='natural',
+                        choices=scheduling_orders,
+                        help="The order in which the images are read. Use inode or fiemap on spinning disks.")
+    parser.add_argument("--max-read-rate",
+                        type=CommandLine.str2size,
+                        default=None,
+                        metavar="BYTES",
+                        help="The maximum number of bytes read per second while hashing, for example 50M.")
+    parser.add_argument("--max-files-rate",
+                        type=float,
+                        default=None,
+                        help="The maximum number of files read per second while hashing.")
+    parser.add_argument("--worker-priority",
+                        type=str,
+                        default='normal',
+                        choices=worker_priorities,
+                        help="The CPU priority of the processes hashing the images. Without --parallel a single "
+                             "child process hashes the images, the command keeps its priority.")
+    parser.add_argument("--checkpoint",
+                        required=False,
+                        metavar="/path/to/checkpoint.jsonl",
+                        type=str,
+                        default=None,
+                        help="Append the hashes to this file as they are computed. "
+                             "Running again with the same arguments skips the images already hashed.")
+    parser.add_argument("--image-timeout",
+                        type=float,
+                        default=None,
+                        metavar="SECONDS",
+                        help="The maximum time to decode an image. Stuck workers are replaced.")
+    parser.add_argument("--max-image-pixels",
+                        type=int,
+                        default=None,
+                        help="The images with more pixels are rejected as decompression bombs.")
+    parser.add_argument("--max-worker-memory",
+                        type=CommandLine.str2size,
+                        default=None,
+                        metavar="BYTES",
+                        help="The maximum memory of each worker when parallel is set to true, for example 2G.")
+    parser.add_argument("--quality-score",
+                        type=CommandLine.str2bool,
+                        nargs='?',
+                        const=True,
+                        default='false',
+                        help="Whether to measure the sharpness of each image while it's hashed, from the same "
+                             "decoded image, for --keep sharpest.")
+    parser.add_argument("--quarantine-file",
+                        required=False,
+                        metavar="/path/to/quarantine.tsv",
+                        type=str,
+                        default=None,
+                        help="The images that can't be hashed are appended to this file and skipped by later runs.")
+    parser.add_argument("--save-dataset",
+                        required=False,
+                        metavar="/path/to/dataset/",
+                        type=str,
+                        default=None,
+                        help="Save the hashes into this directory, it can be opened later with --load-dataset. "
+                             "An existing dataset is replaced, any other existing directory is an error.")
+    parser.add_argument("--load-dataset",
+                        required=False,
+                        metavar="/path/to/dataset/",
+                        type=str,
+                        default=None,
+                        help="Open the hashes saved with --save-dataset instead of hashing --images-path. "
+                             "The paths and the metadata are memory-mapped and shared among the processes that "
+                             "open them, the packed hashes are unpacked in memory.")
+    parser.add_argument("--export-dataset",
+                        required=False,
+                        metavar="/path/to/dataset.parquet",
+                        type=str,
+                        default=None,
+                        help="Export the paths, the packed hashes and the metadata of the dataset into a .parquet "
+                             "or .arrow file for other tools. Requires pyarrow.")
+    parser.add_argument("--results-format",
+                        type=str,
+                        default='csv',
+                        choices=results_formats,
+                        help="The format of the results, the join pairs and images_tsne. parquet and arrow split "
+                             "the paths into a dictionary-encoded directory and a name and store the hash size "
+                             "and the threshold once. Requires pyarrow.")
+    parser.add_argument("--memory-budget",
+                        type=CommandLine.str2size,
+                        default=None,
+                        metavar="BYTES",
+                        help="Find the duplicates out of core with an external sort of the hashes using at most "
+                             "this memory, for example 1G. Use it with --load-dataset for collections larger "
+                             "than RAM. Only delete supports it.")
+    parser.add_argument("--prefix-length",
+                        type=int,
+                        default=None,
+                        help="With --memory-budget, compare the images whose hashes share this number of leading "
+                             "hexadecimal digits. By default only identical hashes are grouped.")
+    parser.add_argument("--group-level",
+                        type=int,
+                        default=None,
+                        help="Only compare the images of different groups, the group of an image is its directory "
+                             "at this depth below the common directory of the images, e.g. 1 for the version "
+                             "folders v1, v2. The groups are compared by a single process. Only delete supports it.")
+    parser.add_argument("--window-size",
+                        type=int,
+                        default=None,
+                        help="Only compare each image with this number of images before it, in the natural order "
+                             "of the paths or in the order of --timestamp-format. Only delete supports it.")
+    parser.add_argument("--window-seconds",
+                        type=float,
+                        default=None,
+                        help="Only compare each image with the images captured this number of seconds before it, "
+                             "requires --timestamp-format. Only delete supports it.")
+    parser.add_argument("--timestamp-format",
+                        type=str,
+                        default=None,
+                        help="The capture time in the file names without extension, as a strptime() format, e.g. "
+                             "%%Y-%%m-%%d-%%H-%%M-%%S for 2018-12-11-15-03-11.png.")
+    parser.add_argument("--join-path",
+                        required=False,
+                        metavar="/path/to/collection/",
+                        type=str,
+                        default=None,
+                        help="The collection B of join, a directory of images or a dataset saved with "
+                             "--save-dataset. The larger of the two collections is indexed, the other one is "
+                             "queried --batch-size images at a time.")
+    parser.add_argument("--join-self",
+                        type=CommandLine.str2bool,
+                        nargs='?',
+                        const=True,
+                        default='false',
+                        help="Whether join also finds the near duplicates within --images-path.")
+    parser.add_argument("--queue",
+                        required=False,
+                        metavar="/path/to/queue/",
+                        type=str,
+                        default=None,
+                        help="The work queue directory shared by enqueue, worker and merge.")
+    parser.add_argument("--queue-batch-size",
+                        type=int,
+                        default=1024,
+                        help="The number of images claimed at once by a worker.")
+    parser.add_argument("--lease-seconds",
+                        type=float,
+                        default=600,
+                        help="A batch claimed by a worker that stops renewing its lease for this time is claimed "
+                             "again by another worker.")
+    parser.add_argument("--worker-id",
+                        type=str,
+                        default=None,
+                        help="The id of the worker, by default host:pid.")
+    parser.add_argument("--shards-path",
+                        required=False,
+                        metavar="/path/to/shards/",
+                        type=str,
+                        default=None,
+                        help="The directory of the shards shared by shard-map and shard-reduce.")
+    parser.add_argument("--shards",
+                        type=int,
+                        default=None,
+                        help="The number of shards of shard-map, the images are partitioned by a stable hash of "
+                             "their path.")
+    parser.add_argument("--shard-id",
+                        type=int,
+                        default=None,
+                        help="The shard processed by shard-map, between 0 and --shards - 1.")
+    parser.add_argument("--allow-partial",
+                        type=CommandLine.str2bool,
+                        nargs='?',
+                        const=True,
+                        default='false',
+                        help="Whether merge assembles the batches already done while others are still pending.")
+    parser.add_argument("--sample-size",
+                        type=int,
+                        default=10000,
+                        help="The number of images hashed by estimate.")
+    parser.add_argument("--sample-block",
+                        type=int,
+                        default=32,
+                        help="estimate draws blocks of this number of consecutive images, so the bursts of a "
+                             "folder are sampled together. 1 draws single images.")
+    parser.add_argument("--confidence",
+                        type=float,
+                        default=0.95,
+                        help="The confidence level of the intervals of estimate.")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=None,
+                        help="The seed of the sample of estimate, random by default.")
 
     if args is None:
         args = parser.parse_args()
+        if args.command in ['delete', 'show', 'search', 'join']:
+            if args.images_path is None and args.load_dataset is None:
+                parser.error("--images-path is required unless --load-dataset is set.")
+            if args.output_path is None:
+                parser.error("--output-path is required by {}.".format(args.command))
+            if args.command != 'delete' and (args.memory_budget is not None or args.prefix_length is not None):
+                parser.error("--memory-budget and --prefix-length only apply to delete.")
+            if args.group_level is not None and (args.command != 'delete' or args.memory_budget is not None):
+                parser.error("--group-level only applies to delete without --memory-budget.")
+            if args.window_size is not None or args.window_seconds is not None:
+                if args.command != 'delete' or args.memory_budget is not None or args.group_level is not None:
+                    parser.error("--window-size and --window-seconds only apply to delete without --memory-budget "
+                                 "and --group-level.")
+                if args.window_seconds is not None and args.timestamp_format is None:
+                    parser.error("--window-seconds requires --timestamp-format.")
+            if args.max_radius is not None:
+                if args.command != 'delete' or args.memory_budget is not None or args.group_level is not None or \
+                        args.window_size is not None or args.window_seconds is not None:
+                    parser.error("--max-radius only applies to delete without --memory-budget, --group-level, "
+                                 "--window-size and --window-seconds.")
+                if args.threshold > args.max_radius:
+                    parser.error("--threshold must be at most --max-radius.")
+            if args.forest is not None and args.max_radius is None:
+                parser.error("--forest requires --max-radius.")
+            if args.stream_groups is not None and args.command != 'delete':
+                parser.error("--stream-groups only applies to delete.")
+            if args.keep != 'first':
+                if args.command != 'delete' or args.window_size is not None or args.window_seconds is not None:
+                    parser.error("--keep only applies to delete without --window-size and --window-seconds, and to "
+                                 "shard-reduce.")
+                if args.keep == 'path-priority' and args.priority_paths is None:
+                    parser.error("--keep path-priority requires --priority-paths.")
+            if args.command == 'join' and args.join_path is None:
+                parser.error("--join-path is required by join.")
+        elif args.command in ['shard-map', 'shard-reduce']:
+            if args.shards_path is None:
+                parser.error("--shards-path is required by {}.".format(args.command))
+            if args.command == 'shard-map':
+                if args.images_path is None and args.load_dataset is None:
+                    parser.error("--images-path is required unless --load-dataset is set.")
+                if args.shards is None or args.shard_id is None:
+                    parser.error("--shards and --shard-id are required by shard-map.")
+            if args.command == 'shard-reduce' and args.output_path is None:
+                parser.error("--output-path is required by shard-reduce.")
+            if args.command == 'shard-reduce' and args.deletion_mode == 'link':
+                parser.error("--deletion-mode link only applies to delete.")
+            if args.keep != 'first':
+                if args.command != 'shard-reduce':
+                    parser.error("--keep applies to shard-reduce, not to shard-map.")
+                if args.keep == 'path-priority' and args.priority_paths is None:
+                    parser.error("--keep path-priority requires --priority-paths.")
+        elif args.command in ['purge', 'resume', 'undo']:
+            if args.run_path is None:
+                parser.error("--run-path is required by {}.".format(args.command))
+        elif args.command == 'estimate':
+            if args.images_path is None:
+                parser.error("--images-path is required by estimate.")
+            if args.sample_size < 1 or args.sample_block < 1 or not 0 < args.confidence < 1:
+                parser.error("--sample-size and --sample-block must be positive, --confidence between 0 and 1.")
+        else:
+            if args.queue is None:
+                parser.error("--queue is required by {}.".format(args.command))
+            if args.command == 'enqueue' and args.images_path is None:
+                parser.error("--images-path is required by enqueue.")
+            if args.command == 'merge' and args.save_dataset is None:
+                parser.error("--save-dataset is required by merge.")
+        columnar = args.results_format != 'csv' or args.stream_groups in ['parquet', 'arrow']
+        if columnar or args.export_dataset is not None:
+            try:
+                ArrowUtils.require()
+                if args.export_dataset is not None:
+                    ArrowUtils.format_of(args.export_dataset)
+            except (ImportError, ValueError) as e:
+                parser.error(str(e))
 
     from deduplication._version import get_versions
     __version__ = get_versions()['version']
 
+    if args.command == "enqueue":
+        enqueue(args.images_path, args.queue, args.hash_size, args.hash_algorithm, args.queue_batch_size)
+        return
+
+    if args.command == "worker":
+        worker(args.queue, args.worker_id, args.lease_seconds, parallel=args.parallel, batch_size=args.batch_size,
+               workers=args.workers, **image_to_hash_args(args))
+        return
+
+    if args.command == "merge":
+        merge(args.queue, args.save_dataset, args.allow_partial, args.quarantine_file)
+        return
+
+    if args.command == "purge":
+        purge(args.run_path)
+        return
+
+    if args.command == "resume":
+        resume(args.run_path)
+        return
+
+    if args.command == "undo":
+        undo(args.run_path)
+        return
+
+    if args.command == "estimate":
+        if args.output_path is not None:
+            FileSystem.mkdir_if_not_exist(args.output_path)
+        estimate(args.images_path, args.hash_size, args.hash_algorithm, args.tree_type, args.distance_metric,
+                 args.leaf_size, args.batch_size, args.threshold, args.sample_size, args.sample_block,
+                 args.confidence, args.seed, args.parallel, args.workers, args.output_path, **image_to_hash_args(args))
+        return
+
+    if args.command == "shard-map":
+        df_dataset, _ = build_dataset(args)
+        shard_map(df_dataset, args.shards_path, args.shards, args.shard_id, args.distance_metric, args.threshold,
+                  args.leaf_size)
+        return
+
     dt = str(datetime.datetime.today().strftime('%Y-%m-%d-%H-%M'))
 
     output_path = os.path.join(args.output_path, dt)
@@ -134,8 +610,6 @@ def main(args=None):
 
     if args.command == "delete":
         # Config
-        images_path = args.images_path
-        hash_algo = args.hash_algorithm
         hash_size = args.hash_size
         tree_type = args.tree_type
         distance_metric = args.distance_metric
@@ -143,54 +617,69 @@ def main(args=None):
         leaf_size = args.leaf_size
         parallel = args.parallel
         batch_size = args.batch_size
+        workers = args.workers
         threshold = args.threshold
         backup_keep = args.backup_keep
         backup_duplicate = args.backup_duplicate
         safe_deletion = args.safe_deletion
+        backup_method = args.backup_method
+        deletion_mode = args.deletion_mode
+        link_method = args.link_method
+        keep_policy = args.keep
+        priority_paths = args.priority_paths
+        group_format = args.stream_groups
         image_w = args.image_w
         image_h = args.image_h
+        memory_budget = args.memory_budget
+        prefix_length = args.prefix_length
+        group_level = args.group_level
+        window_size = args.window_size
+        window_seconds = args.window_seconds
+        timestamp_format = args.timestamp_format
 
-        df_dataset, img_file_list = ImageToHash(images_path, hash_size=hash_size, hash_algo=hash_algo) \
-            .build_dataset(parallel=parallel, batch_size=batch_size)
+        df_dataset, img_file_list = build_dataset(args)
 
         delete(df_dataset, img_file_list, output_path, hash_size, tree_type, distance_metric, nearest_neighbors,
                leaf_size, parallel, batch_size, threshold, backup_keep, backup_duplicate, safe_deletion, image_w,
-               image_h)
+               image_h, workers, memory_budget, prefix_length, group_level, window_size, window_seconds,
+               timestamp_format, backup_method, deletion_mode, link_method, keep_policy, priority_paths, group_format,
+               args.results_format, args.max_radius, args.forest)
 
     if args.command == "show":
-        # Config
-        images_path = args.images_path
-        hash_algo = args.hash_algorithm
-        hash_size = args.hash_size
-        parallel = args.parallel
-        batch_size = args.batch_size
+        df_dataset, _ = build_dataset(args)
 
-        df_dataset, _ = ImageToHash(images_path, hash_size=hash_size, hash_algo=hash_algo) \
-            .build_dataset(parallel=parallel, batch_size=batch_size)
-
-        show(df_dataset, output_path)
+        show(df_dataset, output_path, args.results_format)
 
     if args.command == "search":
         # Config
-        images_path = args.images_path
-        hash_algo = args.hash_algorithm
-        hash_size = args.hash_size
         tree_type = args.tree_type
         distance_metric = args.distance_metric
         nearest_neighbors = args.nearest_neighbors
         leaf_size = args.leaf_size
         parallel = args.parallel
         batch_size = args.batch_size
+        workers = args.workers
         threshold = args.threshold
         image_w = args.image_w
         image_h = args.image_h
         query = args.query
 
-        df_dataset, _ = ImageToHash(images_path, hash_size=hash_size, hash_algo=hash_algo) \
-            .build_dataset(parallel=parallel, batch_size=batch_size)
+        df_dataset, _ = build_dataset(args)
 
         search(df_dataset, output_path, tree_type, distance_metric, nearest_neighbors, leaf_size, parallel, batch_size,
-               threshold, image_w, image_h, query)
+               threshold, image_w, image_h, query, workers=workers)
+
+    if args.command == "join":
+        df_dataset, _ = build_dataset(args)
+        df_join_dataset = build_join_dataset(args, df_dataset)
+
+        join(df_dataset, df_join_dataset, output_path, args.tree_type, args.distance_metric, args.leaf_size,
+             args.batch_size, args.threshold, args.join_self, args.results_format)
+
+    if args.command == "shard-reduce":
+        shard_reduce(args.shards_path, output_path, args.hash_size, args.distance_metric, args.threshold,
+                     args.backup_keep, args.backup_duplicate, args.safe_deletion, args.leaf_size, args.backup_method,
+                     args.deletion_mode, args.results_format, args.keep, args.priority_paths)
 
 
 if __name__ == '__main__':
@@ -1,18 +1,48 @@
+import os
 import random
+from contextlib import ExitStack
 
-from deduplication.commands.helpers import build_tree, save_results
+import numpy as np
+
+from deduplication.commands.helpers import build_tree, keep_order, link_targets, save_results
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.duplicatefinder.GroupWriter import GroupWriter
 
 
 def delete(df_dataset, img_file_list, output_path, hash_size, tree_type, distance_metric, nearest_neighbors,
            leaf_size, parallel, batch_size, threshold, backup_keep, backup_duplicate, safe_deletion, image_w=128,
-           image_h=128):
+           image_h=128, workers=None, memory_budget=None, prefix_length=None, group_level=None,
+           window_size=None, window_seconds=None, timestamp_format=None, backup_method='auto',
+           deletion_mode='delete', link_method='hardlink', keep_policy='first', priority_paths=None,
+           group_format=None, results_format='csv', max_radius=None, forest_path=None):
+    # The finders keep the first image of each group: rank the images preferred by the keep policy first, the dataset
+    # isn't copied
+    dataset = HashDataset.wrap(df_dataset)
+    keep_ranks = np.argsort(keep_order(dataset, keep_policy, priority_paths)) if keep_policy != 'first' else None
     # Build the tree
-    near_duplicate_image_finder = build_tree(df_dataset, tree_type, distance_metric, leaf_size, parallel,
-                                             batch_size)
+    near_duplicate_image_finder = build_tree(dataset, tree_type, distance_metric, leaf_size, parallel,
+                                             batch_size, workers, memory_budget, prefix_length, group_level,
+                                             window_size, window_seconds, timestamp_format, max_radius, forest_path)
+    # The groups of every threshold of the forest
+    if max_radius is not None:
+        summary_path = os.path.join(output_path, "threshold_summary_{0}_radius_{1}.csv".format(
+            hash_size, near_duplicate_image_finder.max_radius))
+        near_duplicate_image_finder.write_summary(summary_path)
+    near_duplicate_image_finder.keep_ranks = keep_ranks
     # Find duplicates
-    to_keep, to_remove, dict_image_to_duplicates = near_duplicate_image_finder.find_all_near_duplicates(
-        nearest_neighbors,
-        threshold)
+    with ExitStack() as stack:
+        stack.callback(near_duplicate_image_finder.close)
+        # Stream the groups as they are selected, and track the image kept in place of each duplicate to link it
+        link = deletion_mode == 'link' and not safe_deletion
+        if group_format is not None or link:
+            groups_path = os.path.join(output_path, "duplicate_groups_{0}_dist_{1}.{2}".format(
+                hash_size, threshold, group_format)) if group_format is not None else None
+            near_duplicate_image_finder.group_writer = stack.enter_context(
+                GroupWriter(groups_path, near_duplicate_image_finder.dataset, distance_metric,
+                            group_format or 'jsonl', keep_targets=link))
+        to_keep, to_remove, dict_image_to_duplicates = near_duplicate_image_finder.find_all_near_duplicates(
+            nearest_neighbors,
+            threshold)
     print('We have found {0}/{1} duplicates in folder'.format(len(to_remove), len(img_file_list)))
     # Show a duplicate
     if len(dict_image_to_duplicates) > 0:
@@ -20,7 +50,12 @@ def delete(df_dataset, img_file_list, output_path, hash_size, tree_type, distanc
         near_duplicate_image_finder.show_an_image_duplicates(dict_image_to_duplicates, random_img, output_path,
                                                              image_w=image_w,
                                                              image_h=image_h)
+    # Link each duplicate to the image its group keeps
+    targets, file_stats = link_targets(near_duplicate_image_finder.dataset,
+                                       near_duplicate_image_finder.group_writer.kept_in_place, to_remove) \
+        if link else (None, None)
     # Save results
-    save_results(to_keep, to_remove, hash_size, threshold, output_path, backup_keep, backup_duplicate, safe_deletion)
+    save_results(to_keep, to_remove, hash_size, threshold, output_path, backup_keep, backup_duplicate, safe_deletion,
+                 backup_method, deletion_mode, targets, link_method, results_format, file_stats)
 
     return to_keep, to_remove
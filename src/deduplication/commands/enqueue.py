@@ -0,0 +1,22 @@
+from deduplication.dataset.ImageToHash import ImageToHash
+from deduplication.dataset.WorkQueue import WorkQueue
+
+
+def enqueue(images_path, queue_path, hash_size=8, hash_algo='phash', batch_size=1024):
+    """
+    Create a work queue with the images of images_path, to be hashed by the workers.
+    :param images_path: the directory containing the images.
+    :param queue_path: the directory of the queue, shared by the workers.
+    :param hash_size: the hash size used by every worker.
+    :param hash_algo: the hash algorithm used by every worker.
+    :param batch_size: the number of images claimed at once by a worker.
+    :return: the WorkQueue.
+    """
+    img_file_list = ImageToHash.get_images_table(images_path, natural_order=True)
+
+    work_queue = WorkQueue(queue_path)
+    work_queue.create(img_file_list, batch_size=batch_size, hash_size=hash_size, hash_algo=hash_algo,
+                      images_path=images_path)
+    print("{0} images enqueued into {1} ({2} batches)".format(len(img_file_list), queue_path,
+                                                              sum(work_queue.status().values())))
+    return work_queue
@@ -0,0 +1,145 @@
+import json
+import os
+
+import numpy as np
+from scipy.stats import norm
+
+from deduplication.dataset.ImageToHash import ImageToHash
+from deduplication.duplicatefinder.CollectionJoin import CollectionJoin
+
+
+def sample_blocks(size, sample_size, block_size, random_state):
+    """
+    Draw blocks of consecutive images at random, without replacement.
+    :param size: the number of images.
+    :param sample_size: the number of images to draw, rounded up to whole blocks.
+    :param block_size: the number of consecutive images of a block.
+    :param random_state: a numpy RandomState.
+    :return: the positions of the images drawn, sorted, the block of each of them and the number of blocks.
+    """
+    blocks = -(-size // block_size)
+    drawn = np.sort(random_state.choice(blocks, min(blocks, -(-sample_size // block_size)), replace=False))
+    positions = (drawn[:, None] * block_size + np.arange(0, block_size)).reshape(-1)
+    positions = positions[positions < size]
+    return positions, positions // block_size, blocks
+
+
+def ratio_estimate(values, blocks, sampled_blocks, total_blocks, confidence):
+    """
+    The mean of values over the images, estimated from a sample of blocks, and its confidence interval.
+    :param values: the value of each image of the sample.
+    :param blocks: the block of each image of the sample.
+    :param sampled_blocks: the number of blocks of the sample.
+    :param total_blocks: the number of blocks of the collection.
+    :param confidence: the confidence level of the interval.
+    :return: the estimate and the half width of its interval, normal with the finite population correction. The
+    blocks are the sampling units: the images of a block aren't independent.
+    """
+    _, block_ids = np.unique(blocks, return_inverse=True)
+    totals = np.bincount(block_ids, weights=values)
+    counts = np.bincount(block_ids)
+    estimate = totals.sum() / counts.sum()
+    if len(counts) < 2:
+        return estimate, np.nan
+    variance = (1 - sampled_blocks / total_blocks) * ((totals - estimate * counts) ** 2).sum() / (len(counts) - 1) / \
+        (len(counts) * counts.mean() ** 2)
+    return estimate, norm.ppf((1 + confidence) / 2) * np.sqrt(variance)
+
+
+def estimate(images_path, hash_size=8, hash_algo='phash', tree_type='KDTree', distance_metric='manhattan',
+             leaf_size=40, batch_size=32, threshold=10, sample_size=10000, block_size=32, confidence=0.95, seed=None,
+             parallel=False, workers=None, output_path=None, **image_to_hash_args):
+    """
+    Estimate the share of near duplicates of a collection and the bytes that a delete would reclaim, from a sample.
+
+    The images are listed in natural order and blocks of block_size consecutive images, e.g. the bursts of a folder,
+    are drawn at random. Only the sample is hashed and indexed, each image of the sample is queried against it: the
+    near duplicates of its own block are all found, the near duplicates in the other blocks are scaled by the
+    sampling rate of the blocks. An image with d near duplicates is removed with a share d / (d + 1) of its group, so
+    the estimated share of duplicates is the mean of d / (d + 1), and the reclaimable bytes weigh it by the size of
+    each image. The near duplicates far apart in the collection are rarely drawn together: a larger sample makes
+    their share more accurate.
+    :param images_path: the directory containing the images.
+    :param hash_size: the hash size.
+    :param hash_algo: the hash algorithm.
+    :param tree_type: the tree that indexes the sample.
+    :param distance_metric: the distance metric.
+    :param leaf_size: the leaf size of the tree.
+    :param batch_size: the number of images hashed by each task, and queried at once.
+    :param threshold: the maximum distance of the near duplicates.
+    :param sample_size: the number of images of the sample, rounded up to whole blocks.
+    :param block_size: the number of consecutive images drawn together, 1 draws single images.
+    :param confidence: the confidence level of the intervals.
+    :param seed: the seed of the sample, random by default.
+    :param parallel: whether to hash the sample using a pool of processes.
+    :param workers: the number of processes of the pool.
+    :param output_path: when set, the estimates are also written into estimate_<hash size>_dist_<threshold>.json.
+    :param image_to_hash_args: the other arguments of ImageToHash, e.g. the read rate limits.
+    :return: a dict of the estimates, the intervals are the half widths of the <name>_interval keys.
+    """
+    if block_size < 1 or sample_size < 1:
+        raise ValueError("The sample size and the block size must be greater than or equal to 1.")
+    img_file_list = ImageToHash.get_images_table(images_path, natural_order=True)
+    size = len(img_file_list)
+    positions, blocks, total_blocks = sample_blocks(size, sample_size, block_size, np.random.RandomState(seed))
+    sampled_blocks = len(np.unique(blocks))
+    print("Sampling {0} images in {1} blocks out of {2} images".format(len(positions), sampled_blocks, size))
+
+    sample = img_file_list.take(positions)
+    image_to_hash = ImageToHash(list(sample), hash_size=hash_size, hash_algo=hash_algo, natural_order=False,
+                                **image_to_hash_args)
+    dataset, _ = image_to_hash.build_dataset(parallel=parallel, batch_size=batch_size, workers=workers)
+    # The images that can't be hashed are left out of the sample.
+    block_of = dict(zip(sample, blocks))
+    blocks = np.fromiter((block_of[file] for file in dataset.files), dtype=np.int64, count=len(dataset))
+
+    # Query the sample against itself, every image is its own neighbor.
+    collection_join = CollectionJoin(tree_type=tree_type, distance_metric=distance_metric, leaf_size=leaf_size,
+                                     batch_size=batch_size)
+    tree = collection_join.build_index(dataset)
+    same_block = np.zeros(len(dataset))
+    other_blocks = np.zeros(len(dataset))
+    for row, ids, _ in collection_join.query(tree, len(dataset), dataset.hashes, threshold):
+        neighbors = ids[ids != row]
+        same_block[row] = (blocks[neighbors] == blocks[row]).sum()
+        other_blocks[row] = len(neighbors) - same_block[row]
+    # The other blocks of an image are sampled with a rate (sampled blocks - 1) / (blocks - 1).
+    scale = (total_blocks - 1) / (sampled_blocks - 1) if sampled_blocks > 1 else 0
+    near_duplicates = same_block + other_blocks * scale
+    removed = near_duplicates / (near_duplicates + 1)
+
+    file_size = dataset.metadata['file_size'].astype(np.float64)
+    duplicate_rate, duplicate_rate_interval = ratio_estimate(removed, blocks, sampled_blocks, total_blocks,
+                                                             confidence)
+    bytes_per_image, bytes_per_image_interval = ratio_estimate(removed * file_size, blocks, sampled_blocks,
+                                                               total_blocks, confidence)
+    mean_size, _ = ratio_estimate(file_size, blocks, sampled_blocks, total_blocks, confidence)
+    seconds_per_image = image_to_hash.stats['seconds'] / max(image_to_hash.stats['files'], 1)
+
+    results = {'images': size,
+               'sample': len(dataset),
+               'blocks': sampled_blocks,
+               'confidence': confidence,
+               'duplicate_rate': duplicate_rate,
+               'duplicate_rate_interval': duplicate_rate_interval,
+               'duplicates': duplicate_rate * size,
+               'duplicates_interval': duplicate_rate_interval * size,
+               'total_bytes': mean_size * size,
+               'reclaimable_bytes': bytes_per_image * size,
+               'reclaimable_bytes_interval': bytes_per_image_interval * size,
+               'hashing_seconds': seconds_per_image * size}
+
+    print("Estimates at {:.0%} confidence:".format(confidence))
+    print("\tNear duplicates: {0:.2%} +/- {1:.2%}, {2:.0f} +/- {3:.0f} images out of {4}".format(
+        duplicate_rate, duplicate_rate_interval, results['duplicates'], results['duplicates_interval'], size))
+    print("\tReclaimable: {0:.0f} +/- {1:.0f} bytes out of {2:.0f} bytes".format(
+        results['reclaimable_bytes'], results['reclaimable_bytes_interval'], results['total_bytes']))
+    print("\tHashing time of the whole collection: {:.0f} seconds".format(results['hashing_seconds']))
+
+    if output_path is not None:
+        estimate_path = os.path.join(output_path, "estimate_{0}_dist_{1}.json".format(hash_size, threshold))
+        with open(estimate_path, 'w') as f:
+            json.dump({name: None if np.isnan(value) else value for name, value in results.items()}, f, indent=2)
+        print("\tEstimates written into {}".format(estimate_path))
+
+    return results
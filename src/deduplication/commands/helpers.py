@@ -1,67 +1,435 @@
+import csv
 import os
+from collections import Counter
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
-import pandas as pd
+import numpy as np
 from tqdm import tqdm
 
+from deduplication.duplicatefinder.ExternalSortFinder import ExternalSortFinder
+from deduplication.duplicatefinder.GroupedFinder import GroupedFinder
 from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.duplicatefinder.ShardedFinder import ShardedFinder
+from deduplication.duplicatefinder.SingleLinkageFinder import SingleLinkageFinder
+from deduplication.duplicatefinder.WindowedFinder import WindowedFinder
 from deduplication.duplicatefinder.cKDTreeFinder import cKDTreeFinder
-from deduplication.utils.FileSystem import FileSystem
+from deduplication.utils.ArrowUtils import ArrowUtils
+from deduplication.utils.CpuUtils import CpuUtils
+from deduplication.utils.DeletionJournal import DeletionJournal, DONE
+from deduplication.utils.FileSystem import FileSystem, backup_methods
 
+# The number of threads that back the images up, the work is bound by the I/O.
+BACKUP_THREADS = 16
 
-def backup_images(df_results, output_path_in, column):
+# The duplicates moved by quarantine_images(), in the output directory of the run.
+QUARANTINE_DIR = 'quarantine'
+QUARANTINE_MANIFEST = 'quarantine_manifest.csv'
+
+# The write-ahead journal of the deletions, in the output directory of the run.
+DELETION_JOURNAL = 'deletion_journal.jsonl'
+
+deletion_modes = ['delete', 'quarantine', 'link']
+
+# The formats of the results files, parquet and arrow require pyarrow, see ArrowUtils.
+results_formats = ['csv', 'parquet', 'arrow']
+
+# The images kept among near duplicates, see keep_order(). first keeps the first image in the order of the dataset.
+keep_policies = ['first', 'largest', 'newest', 'oldest', 'highest-resolution', 'sharpest', 'path-priority']
+
+# The metadata required by each keep policy.
+keep_policy_metadata = {'first': [], 'largest': ['file_size'], 'newest': ['mtime', 'exif_time'],
+                        'oldest': ['mtime', 'exif_time'], 'highest-resolution': ['width', 'height', 'file_size'],
+                        'sharpest': ['sharpness', 'jpeg_quality', 'file_size'], 'path-priority': []}
+
+
+def keep_order(df_dataset, keep_policy='first', priority_paths=None):
+    """Order the images by preference of a keep policy.
+
+    The finders keep the first image of each group of near duplicates in the order of the dataset: the ranks of the
+    images in this order, see NearDuplicateImageFinder.keep_ranks, make them keep the preferred image instead. The
+    order is computed from the metadata recorded by the hashing pass, no image is opened again, and the ties follow
+    the order of the dataset.
+
+    Parameters
+    ----------
+    df_dataset
+        A HashDataset.
+    keep_policy
+        'first', 'largest' (file size), 'newest' or 'oldest' (EXIF capture time, else modification time),
+        'highest-resolution' (pixels, then file size), 'sharpest' (sharpness, then JPEG quality and file size, see
+        ImageToHash.img_hash()) or 'path-priority'.
+    priority_paths
+        With 'path-priority', the directories in order of preference, the images of the other directories come
+        last.
+
+    Returns
+    -------
+    The positions of the images, the preferred image first.
+    """
+    assert keep_policy in keep_policies, "{} isn't a valid keep policy.".format(keep_policy)
+    metadata = df_dataset.metadata
+    missing = [name for name in keep_policy_metadata[keep_policy] if name not in metadata]
+    if len(missing) > 0:
+        raise ValueError("The keep policy {0} requires the {1} metadata, hash the images again: the dataset has been "
+                         "built by a previous version.".format(keep_policy, ', '.join(missing)))
+
+    if keep_policy == 'first':
+        return np.arange(0, len(df_dataset))
+    if keep_policy == 'largest':
+        keys = (-np.asarray(metadata['file_size']),)
+    elif keep_policy in ['newest', 'oldest']:
+        exif_time = np.asarray(metadata['exif_time'])
+        capture_time = np.where(np.isnan(exif_time), np.asarray(metadata['mtime']), exif_time)
+        keys = (-capture_time if keep_policy == 'newest' else capture_time,)
+    elif keep_policy == 'highest-resolution':
+        pixels = np.asarray(metadata['width'], dtype=np.int64) * np.asarray(metadata['height'], dtype=np.int64)
+        keys = (-np.asarray(metadata['file_size']), -pixels)
+    elif keep_policy == 'sharpest':
+        sharpness = np.asarray(metadata['sharpness'])
+        if np.isnan(sharpness).all() and len(sharpness) > 0:
+            raise ValueError("The keep policy sharpest requires the images to be hashed with the quality score.")
+        keys = (-np.asarray(metadata['file_size']), -np.asarray(metadata['jpeg_quality']),
+                -np.where(np.isnan(sharpness), -np.inf, sharpness))
+    else:
+        if not priority_paths:
+            raise ValueError("The keep policy path-priority requires the priority paths.")
+        roots = [os.path.abspath(path) for path in priority_paths]
+        # The rank of each directory is computed once, not once per image.
+        directory_ranks = np.array([next((rank for rank, root in enumerate(roots)
+                                          if os.path.commonpath([root, os.path.abspath(directory)]) == root),
+                                         len(roots)) for directory in df_dataset.files.directories], dtype=np.int64)
+        keys = (directory_ranks[np.asarray(df_dataset.files.directory_ids)] if len(directory_ranks) > 0
+                else np.zeros(len(df_dataset), dtype=np.int64),)
+    # np.lexsort() sorts by the last key first and is stable.
+    return np.lexsort(keys)
+
+
+def destination_file(full_file_name, root):
+    """The path of an image copied or moved under root, e.g. root/home/images/a.png for /home/images/a.png."""
+    return os.path.join(root, os.path.dirname(full_file_name)[1:], os.path.basename(full_file_name))
+
+
+def map_in_threads(function, items, threads=BACKUP_THREADS):
+    """Apply a function to items in a pool of threads.
+
+    The items are submitted in chunks, the futures of the whole collection aren't held at once.
+
+    Parameters
+    ----------
+    function
+    items
+        An iterable, it's consumed once.
+    threads
+        The number of threads.
+
+    Returns
+    -------
+    A generator of the results, in the order of items.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        iter_items = iter(items)
+        for chunk in iter(lambda: list(islice(iter_items, threads * 64)), []):
+            for result in executor.map(function, chunk):
+                yield result
+
+
+def backup_images(files, output_path_in, column, backup_method='auto', threads=BACKUP_THREADS):
     """Backup the images into a folder.
 
+    The directories are created first, then the files are reflinked, hard linked or copied by a pool of threads,
+    see FileSystem.link_or_copy().
+
     Parameters
     ----------
-    df_results
+    files
+        The paths of the images, e.g. a PathTable. They are resolved one at a time.
     output_path_in
     column
+    backup_method
+        'auto' (reflink, else hard link, else copy), 'reflink', 'hardlink' or 'copy'. The links and the reflinks
+        fall back to a copy when the filesystem can't make them.
+    threads
+        The number of threads.
 
     Returns
     -------
-
+    A Counter of the files by method ('reflink', 'hardlink', 'copy', 'missing' and 'error') and of the 'bytes'
+    copied.
     """
     print("Backuping images...")
-    with tqdm(total=len(df_results)) as pbar:
-        for index, row in df_results.iterrows():
+    dest_path = os.path.join(output_path_in, column)
+
+    # Each directory is created once, not once per file.
+    for dstdir in {os.path.dirname(destination_file(full_file_name, dest_path)) for full_file_name in files}:
+        os.makedirs(dstdir, exist_ok=True)
+
+    methods = backup_methods[backup_method]
+    # The methods that fail on this filesystem aren't tried again for the next files.
+    unsupported = set()
 
-            full_file_name = row[column]
+    def backup(full_file_name):
+        if not os.path.isfile(full_file_name):
+            return 'missing', 0
+        try:
+            return FileSystem.link_or_copy(full_file_name, destination_file(full_file_name, dest_path), methods,
+                                           unsupported)
+        except OSError as e:
+            print("Unable to copy file. %s" % e)
+            return 'error', 0
 
-            dest_path = os.path.join(output_path_in, column)
-            dstdir = os.path.join(dest_path, os.path.dirname(full_file_name)[1:])
-            if not os.path.exists(dstdir):
-                os.makedirs(dstdir)  # create all directories
-            FileSystem.copy_file(full_file_name, dstdir)
+    counts = Counter()
+    with tqdm(total=len(files)) as pbar:
+        for method, copied in map_in_threads(backup, files, threads):
+            counts[method] += 1
+            counts['bytes'] += copied
             pbar.update(1)
 
+    print("\t{0} reflinked, {1} hard linked, {2} copied ({3} bytes), {4} missing, {5} errors".format(
+        counts['reflink'], counts['hardlink'], counts['copy'], counts['bytes'], counts['missing'], counts['error']))
+    return counts
 
-def delete_images(df_results, column):
-    """Delete the images.
+
+def link_targets(dataset, kept_in_place, to_remove):
+    """Find the image kept in place of each duplicate, the image its group keeps.
 
     Parameters
     ----------
-    df_results
-    column
+    dataset
+        The HashDataset of the finder.
+    kept_in_place
+        The dict image removed -> image kept of the GroupWriter of the finder, see GroupWriter.kept_in_place.
+    to_remove
+        The paths of the images to remove.
 
     Returns
     -------
+    A list of the path of the image kept in place of each image of to_remove, and a dict path -> (size, modification
+    time) of these images and their targets, as the hashing recorded them, see FileSystem.replace_with_link(). The
+    dict is None without the file sizes in the metadata. Raise a ValueError listing the images without a target,
+    none of the images is linked then.
+    """
+    targets = {dataset.file(image): kept for image, kept in kept_in_place.items()}
+    unlinked = [path for path in to_remove if path not in targets]
+    if len(unlinked) > 0:
+        raise ValueError("{0} images to remove have no image kept in their place: {1}".format(
+            len(unlinked), ', '.join(unlinked[:10])))
 
+    file_stats = None
+    if 'file_size' in dataset.metadata:
+        mtime = dataset.metadata.get('mtime', np.full(len(dataset), np.nan))
+        file_stats = {dataset.file(image): (int(dataset.metadata['file_size'][image]),
+                                            None if np.isnan(mtime[image]) else float(mtime[image]))
+                      for image in set(kept_in_place) | set(kept_in_place.values())}
+    return [dataset.file(targets[path]) for path in to_remove], file_stats
+
+
+def deletion_entries(files, output_path_in, deletion_mode='delete', backup_column=None, targets=None,
+                     link_method='hardlink', file_stats=None):
+    """The intents of the deletion journal of a run, see DeletionJournal.plan().
+
+    Parameters
+    ----------
+    files
+        The paths of the images to remove.
+    output_path_in
+        The output directory of the run.
+    deletion_mode
+        'delete', 'quarantine' or 'link'.
+    backup_column
+        The folder of the backup of the images, None if they aren't backed up.
+    targets
+        With the 'link' mode, the image kept in place of each image, see link_targets().
+    link_method
+        With the 'link' mode, 'hardlink', 'reflink' or 'symlink'.
+    file_stats
+        With the 'link' mode, the dict path -> (size, modification time) that the images and their targets must
+        still have, see link_targets(). None to skip the check.
+
+    Returns
+    -------
+    A generator of the intents.
     """
-    print("Deleting images...")
-    with tqdm(total=len(df_results)) as pbar:
-        for index, row in df_results.iterrows():
-            full_file_name = row[column]
-            FileSystem.remove_file(full_file_name)
+    for i, full_file_name in enumerate(files):
+        entry = {'file': full_file_name, 'action': deletion_mode,
+                 'backup': destination_file(full_file_name, os.path.join(output_path_in, backup_column))
+                 if backup_column is not None else None,
+                 'quarantined': destination_file(full_file_name, os.path.join(output_path_in, QUARANTINE_DIR))
+                 if deletion_mode == 'quarantine' else None}
+        if deletion_mode == 'link':
+            entry.update(target=targets[i], link_method=link_method,
+                         file_stat=file_stats.get(full_file_name) if file_stats is not None else None,
+                         target_stat=file_stats.get(targets[i]) if file_stats is not None else None)
+        yield entry
+
+
+def run_journal(output_path_in, threads=BACKUP_THREADS):
+    """Delete or quarantine the images of the deletion journal of a run that aren't done yet.
+
+    The quarantined images are renamed, which is immediate on the same filesystem, or copied and removed across
+    filesystems, see FileSystem.move_file(). Each move is also appended to the quarantine manifest with columns
+    'original' and 'quarantined', see purge(). An image that fails stays pending in the journal, the images restored
+    by undo() aren't removed again.
+
+    In the 'link' mode each image is replaced by a link to the image kept in its place, see
+    FileSystem.replace_with_link(): the link is renamed over the image, which is never missing.
+
+    Parameters
+    ----------
+    output_path_in
+        The output directory of the run, it contains the journal.
+    threads
+        The number of threads.
+
+    Returns
+    -------
+    A Counter of the files by method ('delete', 'rename', 'copy', 'link', 'missing' and 'error'), of the 'bytes'
+    copied and of the bytes replaced by links ('linked_bytes').
+    """
+    journal = DeletionJournal(os.path.join(output_path_in, DELETION_JOURNAL))
+    intents, done, undone = journal.load()
+    pending = [entry for entry in intents if entry['file'] not in done and entry['file'] not in undone]
+
+    for dstdir in {os.path.dirname(entry['quarantined']) for entry in pending if entry['quarantined'] is not None}:
+        os.makedirs(dstdir, exist_ok=True)
+
+    def apply(entry):
+        full_file_name = entry['file']
+        if not os.path.isfile(full_file_name):
+            # Already deleted or moved, e.g. before a crash.
+            return entry, 'missing', 0
+        try:
+            if entry['action'] == 'quarantine':
+                return (entry,) + FileSystem.move_file(full_file_name, entry['quarantined'])
+            if entry['action'] == 'link':
+                if os.path.samefile(full_file_name, entry['target']):
+                    # Already linked, e.g. before a crash.
+                    return entry, 'missing', 0
+                return entry, 'link', FileSystem.replace_with_link(entry['target'], full_file_name,
+                                                                   entry['link_method'], entry.get('file_stat'),
+                                                                   entry.get('target_stat'))
+            os.remove(full_file_name)
+            return entry, 'delete', 0
+        except OSError as e:
+            print("Unable to remove file. %s" % e)
+            return entry, 'error', 0
+
+    counts = Counter()
+    with ExitStack() as stack:
+        record = stack.enter_context(journal.recorder())
+        pbar = stack.enter_context(tqdm(total=len(pending)))
+        manifest = None
+        if any(entry['quarantined'] is not None for entry in intents):
+            f = stack.enter_context(open(os.path.join(output_path_in, QUARANTINE_MANIFEST), 'a', newline=''))
+            manifest = csv.writer(f, lineterminator='\n')
+            if f.tell() == 0:
+                manifest.writerow(['original', 'quarantined'])
+
+        for entry, method, copied in map_in_threads(apply, pending, threads):
+            if method != 'error':
+                if manifest is not None and os.path.isfile(entry['quarantined']):
+                    manifest.writerow([entry['file'], entry['quarantined']])
+                    # The manifest is written before the image is recorded as done.
+                    f.flush()
+                record(DONE, entry['file'])
+            counts[method] += 1
+            counts['linked_bytes' if method == 'link' else 'bytes'] += copied
             pbar.update(1)
 
+    print("\t{0} deleted, {1} renamed, {2} copied across filesystems ({3} bytes), {4} replaced by links ({5} bytes "
+          "freed), {6} missing, {7} errors".format(counts['delete'], counts['rename'], counts['copy'], counts['bytes'],
+                                                  counts['link'], counts['linked_bytes'], counts['missing'],
+                                                  counts['error']))
+    return counts
+
+
+def delete_images(files, output_path_in, deletion_mode='delete', backup_column=None, threads=BACKUP_THREADS,
+                  targets=None, link_method='hardlink', file_stats=None):
+    """Delete, quarantine or link the images, through the deletion journal of the run.
+
+    The intents are synced to the journal before any image is touched, so resume() finishes the deletion after a
+    crash and undo() restores the images from the quarantine or from the backup.
+
+    Parameters
+    ----------
+    files
+        The paths of the images, e.g. a PathTable. They are resolved one at a time.
+    output_path_in
+        The output directory of the run.
+    deletion_mode
+        'delete', 'quarantine': the images are moved into the quarantine directory of the run instead of being
+        deleted, or 'link': the images are replaced by links to their targets.
+    backup_column
+        The folder of the backup of the images, None if they aren't backed up.
+    threads
+        The number of threads.
+    targets
+        With the 'link' mode, the image kept in place of each image.
+    link_method
+        With the 'link' mode, 'hardlink', 'reflink' or 'symlink'.
+    file_stats
+        With the 'link' mode, the size and modification time of the images and their targets, see deletion_entries().
+
+    Returns
+    -------
+    The Counter of run_journal().
+    """
+    print({'delete': "Deleting images...", 'quarantine': "Quarantining images...",
+           'link': "Replacing images by links..."}[deletion_mode])
+    os.makedirs(output_path_in, exist_ok=True)
+    journal = DeletionJournal(os.path.join(output_path_in, DELETION_JOURNAL))
+    journal.plan(deletion_entries(files, output_path_in, deletion_mode, backup_column, targets, link_method,
+                                  file_stats))
+    return run_journal(output_path_in, threads)
+
+
+def quarantine_images(files, output_path_in, threads=BACKUP_THREADS):
+    """Move the images into the quarantine directory of the run instead of deleting them, see delete_images()."""
+    return delete_images(files, output_path_in, 'quarantine', threads=threads)
+
+
+def write_results(files, column, hash_size_in, threshold_in, results_path, results_format='csv'):
+    """Write the results into a CSV file with columns column, 'hash_size' and 'threshold'.
+
+    The rows are written one at a time, so the paths are never all materialized.
+
+    Parameters
+    ----------
+    files
+        The paths of the images, e.g. a PathTable.
+    column
+    hash_size_in
+    threshold_in
+    results_path
+    results_format
+        'csv', or 'parquet' and 'arrow': the columns <column>_directory, dictionary-encoded, and <column>_name, the
+        hash size and the threshold are stored once in the metadata of the schema.
+
+    Returns
+    -------
+
+    """
+    if results_format != 'csv':
+        table = ArrowUtils.table(ArrowUtils.paths_columns(files, prefix=column + '_'),
+                                 {'hash_size': hash_size_in, 'threshold': threshold_in})
+        ArrowUtils.write_table(table, results_path, results_format)
+        return
+
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow([column, 'hash_size', 'threshold'])
+        for full_file_name in files:
+            writer.writerow([full_file_name, hash_size_in, threshold_in])
+
 
 def save_results(to_keep_in, to_remove_in, hash_size_in, threshold_in, output_path_in, backup_keep=True,
-                 backup_duplicate=True, safe_deletion=False):
+                 backup_duplicate=True, safe_deletion=False, backup_method='auto', deletion_mode='delete', targets=None,
+                 link_method='hardlink', results_format='csv', file_stats=None):
     """
 
     Parameters
     ----------
-    copy_delete
     to_keep_in
     to_remove_in
     hash_size_in
@@ -69,6 +437,21 @@ def save_results(to_keep_in, to_remove_in, hash_size_in, threshold_in, output_pa
     output_path_in
     backup_keep
     backup_duplicate
+    safe_deletion
+    backup_method
+        How the images are backed up, see backup_images().
+    deletion_mode
+        'delete', 'quarantine': the duplicates are moved into the output directory by quarantine_images(), they
+        aren't backed up since the quarantine keeps them, or 'link': the duplicates are replaced by links to the
+        images kept in their place, given by targets.
+    targets
+        With the 'link' mode, the image kept in place of each duplicate, see link_targets().
+    link_method
+        With the 'link' mode, 'hardlink', 'reflink' or 'symlink'.
+    results_format
+        The format of the results files, see write_results().
+    file_stats
+        With the 'link' mode, the size and modification time of the duplicates and their targets, see link_targets().
 
     Returns
     -------
@@ -76,31 +459,29 @@ def save_results(to_keep_in, to_remove_in, hash_size_in, threshold_in, output_pa
     """
     if len(to_keep_in) > 0:
         to_keep_path = os.path.join(output_path_in,
-                                    "duplicates_keep_" + str(hash_size_in) + "_dist_" + str(threshold_in) + ".csv")
-
-        duplicates_keep_df = pd.DataFrame(to_keep_in)
-        duplicates_keep_df.columns = ['keep']
-        duplicates_keep_df['hash_size'] = hash_size_in
-        duplicates_keep_df['threshold'] = threshold_in
-        duplicates_keep_df.to_csv(to_keep_path, index=False)
+                                    "duplicates_keep_" + str(hash_size_in) + "_dist_" + str(threshold_in) + "." +
+                                    results_format)
+        write_results(to_keep_in, 'keep', hash_size_in, threshold_in, to_keep_path, results_format)
         if backup_keep:
-            backup_images(duplicates_keep_df, output_path_in, 'keep')
+            backup_images(to_keep_in, output_path_in, 'keep', backup_method)
 
     if len(to_remove_in) > 0:
         to_remove_path = os.path.join(output_path_in,
-                                      "duplicates_remove_" + str(hash_size_in) + "_dist_" + str(threshold_in) + ".csv")
-        duplicates_remove_df = pd.DataFrame(to_remove_in)
-        duplicates_remove_df.columns = ['remove']
-        duplicates_remove_df['hash_size'] = hash_size_in
-        duplicates_remove_df['threshold'] = threshold_in
-        duplicates_remove_df.to_csv(to_remove_path, index=False)
-        if backup_duplicate:
-            backup_images(duplicates_remove_df, output_path_in, 'remove')
+                                      "duplicates_remove_" + str(hash_size_in) + "_dist_" + str(threshold_in) + "." +
+                                      results_format)
+        write_results(to_remove_in, 'remove', hash_size_in, threshold_in, to_remove_path, results_format)
+        quarantine = deletion_mode == 'quarantine' and not safe_deletion
+        if backup_duplicate and not quarantine:
+            backup_images(to_remove_in, output_path_in, 'remove', backup_method)
         if not safe_deletion:
-            delete_images(duplicates_remove_df, 'remove')
+            delete_images(to_remove_in, output_path_in, deletion_mode,
+                          'remove' if backup_duplicate and not quarantine else None, targets=targets,
+                          link_method=link_method, file_stats=file_stats)
 
 
-def build_tree(df_dataset, tree_type, distance_metric_in, leaf_size_in, parallel_in, batch_size_in):
+def build_tree(df_dataset, tree_type, distance_metric_in, leaf_size_in, parallel_in, batch_size_in, workers_in=None,
+               memory_budget_in=None, prefix_length_in=None, group_level_in=None, window_size_in=None,
+               window_seconds_in=None, timestamp_format_in=None, max_radius_in=None, forest_path_in=None):
     """
 
     Parameters
@@ -111,18 +492,67 @@ def build_tree(df_dataset, tree_type, distance_metric_in, leaf_size_in, parallel
     leaf_size_in
     parallel_in
     batch_size_in
+    workers_in
+    memory_budget_in
+        When set, the duplicates are found out of core by an ExternalSortFinder bounded by this number of bytes,
+        instead of the tree.
+    prefix_length_in
+        The number of hexadecimal digits shared by the candidates of the ExternalSortFinder, all by default.
+    group_level_in
+        When set, only the images of different groups are compared by a GroupedFinder, the group of an image is its
+        directory at this level.
+    window_size_in
+        When set, each image is only compared with this number of images before it by a WindowedFinder.
+    window_seconds_in
+        When set, each image is only compared with the images captured this number of seconds before it by a
+        WindowedFinder.
+    timestamp_format_in
+        The strptime() format of the capture time in the file names, required by window_seconds_in.
+    max_radius_in
+        When set, the duplicates are the groups of a SingleLinkageFinder: the minimum spanning forest of the near
+        duplicates within this radius, cut at the threshold.
+    forest_path_in
+        The file where the forest of the SingleLinkageFinder is saved, and reused by the next runs.
+
+    When parallel_in is set, the cKDTree is queried by the threads of cKDTree.query(workers=N) and the KDTree is
+    sharded among the workers, see ShardedFinder: sending the shards of a cKDTree back from the workers costs about
+    as much as building it.
 
     Returns
     -------
 
     """
+    if memory_budget_in is not None:
+        return ExternalSortFinder(df_dataset, distance_metric=distance_metric_in, memory_budget=memory_budget_in,
+                                  prefix_length=prefix_length_in)
+
+    if max_radius_in is not None:
+        return SingleLinkageFinder(df_dataset, tree_type=tree_type, distance_metric=distance_metric_in,
+                                   leaf_size=leaf_size_in, batch_size=batch_size_in, max_radius=max_radius_in,
+                                   forest_path=forest_path_in)
+
+    if window_size_in is not None or window_seconds_in is not None:
+        return WindowedFinder(df_dataset, distance_metric=distance_metric_in, window_size=window_size_in,
+                              window_seconds=window_seconds_in, timestamp_format=timestamp_format_in)
+
+    if group_level_in is not None:
+        return GroupedFinder(df_dataset, tree_type=tree_type, distance_metric=distance_metric_in,
+                             leaf_size=leaf_size_in, batch_size=batch_size_in, group_level=group_level_in)
+
+    # With a single worker the KDTreeFinder falls back to the serial mode, see NearDuplicateImageFinder.
+    if parallel_in and tree_type == 'KDTree' and CpuUtils.number_of_workers(workers_in) >= 2:
+        return ShardedFinder(df_dataset, tree_type=tree_type, distance_metric=distance_metric_in,
+                             leaf_size=leaf_size_in, batch_size=batch_size_in, workers=workers_in)
+
     if tree_type == 'cKDTree':
         near_duplicate_image_finder = cKDTreeFinder(df_dataset, distance_metric=distance_metric_in,
                                                     leaf_size=leaf_size_in,
-                                                    parallel=parallel_in, batch_size=batch_size_in)
+                                                    parallel=parallel_in, batch_size=batch_size_in,
+                                                    workers=workers_in)
     elif tree_type == 'KDTree':
         near_duplicate_image_finder = KDTreeFinder(df_dataset, distance_metric=distance_metric_in,
                                                    leaf_size=leaf_size_in,
-                                                   parallel=parallel_in, batch_size=batch_size_in)
+                                                   parallel=parallel_in, batch_size=batch_size_in,
+                                                   workers=workers_in)
 
     return near_duplicate_image_finder
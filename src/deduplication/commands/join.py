@@ -0,0 +1,92 @@
+import csv
+import os
+from itertools import islice
+
+import numpy as np
+
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.duplicatefinder.CollectionJoin import CollectionJoin
+from deduplication.utils.ArrowUtils import ArrowUtils, BatchWriter, BATCH_ROWS, pa
+
+
+def write_pairs(pairs, dataset_a, dataset_b, columns, results_path, results_format='csv', metadata=None):
+    """
+    Write pairs of images into a results file as they are found.
+    :param pairs: a generator of (position in dataset_a, position in dataset_b, distance).
+    :param dataset_a: the dataset of the first image.
+    :param dataset_b: the dataset of the second image.
+    :param columns: the header of the file.
+    :param results_path: the results file.
+    :param results_format: 'csv', or 'parquet' and 'arrow': the paths <column>_path are written as the columns
+    <column>_directory and <column>_name, see ArrowUtils, in record batches of BATCH_ROWS pairs.
+    :param metadata: the settings stored in the metadata of the schema of a Parquet or Arrow file.
+    :return: the number of pairs.
+    """
+    count = 0
+    if results_format != 'csv':
+        prefixes = [column[:-len('path')] for column in columns[:2]]
+        names_types = [ArrowUtils.names_type(dataset.files) for dataset in [dataset_a, dataset_b]]
+        fields = ArrowUtils.paths_fields(dataset_a.files, prefixes[0], names_types[0]) + \
+            ArrowUtils.paths_fields(dataset_b.files, prefixes[1], names_types[1]) + [pa.field(columns[2], pa.float64())]
+        schema = pa.schema(fields, metadata={str(key): str(value) for key, value in (metadata or {}).items()})
+        pairs = iter(pairs)
+        with BatchWriter(results_path, schema, results_format) as writer:
+            for batch in iter(lambda: list(islice(pairs, BATCH_ROWS)), []):
+                a, b, distances = (np.array(values) for values in zip(*batch))
+                batch_columns = ArrowUtils.paths_columns(dataset_a.files, a, prefixes[0], names_types[0])
+                batch_columns.update(ArrowUtils.paths_columns(dataset_b.files, b, prefixes[1], names_types[1]))
+                batch_columns[columns[2]] = pa.array(distances.astype(np.float64))
+                writer.write_columns(batch_columns)
+                count += len(batch)
+        return count
+
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        for a, b, distance in pairs:
+            writer.writerow([dataset_a.file(a), dataset_b.file(b), distance])
+            count += 1
+    return count
+
+
+def join(df_dataset_a, df_dataset_b, output_path, tree_type, distance_metric, leaf_size, batch_size, threshold,
+         self_join=False, results_format='csv'):
+    """
+    Find the images of the collection A that near-duplicate images of the collection B.
+    :param df_dataset_a: the collection A, e.g. the new images.
+    :param df_dataset_b: the collection B, e.g. the directory of the saved dataset of the archive.
+    :param output_path: the directory of the results.
+    :param tree_type: the tree that indexes the larger collection.
+    :param distance_metric: the distance metric.
+    :param leaf_size: the leaf size of the tree.
+    :param batch_size: the number of images of the smaller collection queried at once.
+    :param threshold: the maximum distance of the near duplicates.
+    :param self_join: whether to also write the near duplicates within A.
+    :param results_format: the format of the pairs files, see write_pairs().
+    :return: the number of pairs between A and B.
+    """
+    dataset_a = HashDataset.wrap(df_dataset_a)
+    dataset_b = HashDataset.wrap(df_dataset_b)
+    collection_join = CollectionJoin(tree_type=tree_type, distance_metric=distance_metric, leaf_size=leaf_size,
+                                     batch_size=batch_size)
+    hash_size = dataset_a.hash_size
+    metadata = {'hash_size': hash_size, 'threshold': threshold}
+
+    join_path = os.path.join(output_path, "join_" + str(hash_size) + "_dist_" + str(threshold) + "." + results_format)
+    count = write_pairs(collection_join.join(dataset_a, dataset_b, threshold), dataset_a, dataset_b,
+                        ['a_path', 'b_path', 'distance'], join_path, results_format, metadata)
+    print('We have found {0} pairs of near duplicates between {1} and {2} images'.format(count, len(dataset_a),
+                                                                                        len(dataset_b)))
+    print("\tPairs written into {}".format(join_path))
+
+    if self_join:
+        self_join_path = os.path.join(output_path,
+                                      "join_self_" + str(hash_size) + "_dist_" + str(threshold) + "." +
+                                      results_format)
+        self_count = write_pairs(collection_join.self_pairs(dataset_a, threshold), dataset_a, dataset_a,
+                                 ['a_path', 'a_duplicate_path', 'distance'], self_join_path, results_format,
+                                 metadata)
+        print('We have found {} pairs of near duplicates within A'.format(self_count))
+        print("\tPairs written into {}".format(self_join_path))
+
+    return count
@@ -0,0 +1,26 @@
+from deduplication.dataset.Quarantine import Quarantine
+from deduplication.dataset.WorkQueue import WorkQueue
+
+
+def merge(queue_path, dataset_path, allow_partial=False, quarantine_path=None):
+    """
+    Assemble the shards written by the workers into a dataset, see HashDataset.save().
+    :param queue_path: the directory of the queue.
+    :param dataset_path: the directory of the dataset.
+    :param allow_partial: merge the batches already done even if other batches are still pending.
+    :param quarantine_path: append the images that can't be hashed to this quarantine file.
+    :return: the HashDataset.
+    """
+    work_queue = WorkQueue(queue_path)
+    print("Merging {0}: {1}".format(queue_path, work_queue.status()))
+
+    dataset, quarantined = work_queue.merge(allow_partial=allow_partial)
+    dataset.save(dataset_path)
+    print("\t{0} images saved into {1}".format(len(dataset), dataset_path))
+
+    if len(quarantined) > 0:
+        print("\t{} images can't be hashed and have been quarantined".format(len(quarantined)))
+        if quarantine_path is not None:
+            Quarantine(quarantine_path).append(quarantined)
+
+    return dataset
@@ -0,0 +1,47 @@
+import csv
+import os
+
+from tqdm import tqdm
+
+from deduplication.commands.helpers import QUARANTINE_DIR, QUARANTINE_MANIFEST
+
+# The manifest is renamed once the quarantine has been purged.
+PURGED_MANIFEST = 'quarantine_purged.csv'
+
+
+def purge(run_path):
+    """
+    Delete the images quarantined by a previous run, see helpers.quarantine_images(). Only the files of the
+    manifest that are inside the quarantine directory are deleted, then the empty directories are removed.
+    :param run_path: the output directory of the run, it contains the quarantine directory and the manifest.
+    :return: the number of files and of bytes deleted.
+    """
+    quarantine_path = os.path.realpath(os.path.join(run_path, QUARANTINE_DIR))
+    manifest_path = os.path.join(run_path, QUARANTINE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise ValueError("{} doesn't contain a quarantine manifest.".format(run_path))
+
+    with open(manifest_path, newline='') as f:
+        quarantined = [row['quarantined'] for row in csv.DictReader(f)]
+
+    print("Purging {}...".format(quarantine_path))
+    files = 0
+    freed = 0
+    with tqdm(total=len(quarantined)) as pbar:
+        for file_path in quarantined:
+            real_path = os.path.realpath(file_path)
+            if os.path.commonpath([real_path, quarantine_path]) != quarantine_path:
+                print("\t{} isn't in the quarantine, it's kept.".format(file_path))
+            elif os.path.isfile(real_path):
+                freed += os.path.getsize(real_path)
+                os.remove(real_path)
+                files += 1
+            pbar.update(1)
+
+    for directory, _, _ in sorted(os.walk(quarantine_path), key=lambda entry: len(entry[0]), reverse=True):
+        if len(os.listdir(directory)) == 0:
+            os.rmdir(directory)
+    os.replace(manifest_path, os.path.join(run_path, PURGED_MANIFEST))
+
+    print("\t{0} files deleted, {1} bytes freed".format(files, freed))
+    return files, freed
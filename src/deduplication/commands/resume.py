@@ -0,0 +1,13 @@
+import os
+
+from deduplication.commands.helpers import DELETION_JOURNAL, run_journal
+
+
+def resume(run_path):
+    """
+    Finish the deletions of a run that has been interrupted, from its deletion journal.
+    :param run_path: the output directory of the run.
+    :return: the Counter of helpers.run_journal().
+    """
+    print("Resuming the deletions of {}...".format(os.path.join(run_path, DELETION_JOURNAL)))
+    return run_journal(run_path)
@@ -4,37 +4,44 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from deduplication.commands.helpers import build_tree
+from deduplication.dataset.HashDataset import HashDataset
 from deduplication.utils.ImgUtils import ImgUtils
 
 
 def search(df_dataset, output_path, tree_type, distance_metric, nearest_neighbors, leaf_size, parallel, batch_size,
-           threshold, image_w, image_h, query=None, show=True):
+           threshold, image_w, image_h, query=None, show=True, workers=None):
 
     assert query is not None, "Query can't be None"
 
+    dataset = HashDataset.wrap(df_dataset)
+
     # Build the tree
-    near_duplicate_image_finder = build_tree(df_dataset, tree_type, distance_metric, leaf_size, parallel,
-                                             batch_size)
+    near_duplicate_image_finder = build_tree(dataset, tree_type, distance_metric, leaf_size, parallel,
+                                             batch_size, workers)
     # Get the image's id
-    df_image = df_dataset[df_dataset['file'] == query]
-    if df_image.empty:
+    image_id = dataset.index_of(query)
+    if image_id is None:
+        near_duplicate_image_finder.close()
         print("The image doesn't have near duplicates.")
         return [], []
     else:
-        image_id = df_image.index.values.astype(int)[0]
         # Find the images's near duplicates
-        distances, indices = near_duplicate_image_finder.find_near_duplicates(image_id, nearest_neighbors, threshold)
+        try:
+            distances, indices = near_duplicate_image_finder.find_near_duplicates(image_id, nearest_neighbors,
+                                                                                  threshold)
+        finally:
+            near_duplicate_image_finder.close()
         # Show the near duplicates
         if len(distances) > 0 and len(indices) > 0:
 
             for distance, idx in zip(distances, indices):
-                print("{0} distance:{1}".format(df_dataset.iloc[idx]['file'], distance))
+                print("{0} distance:{1}".format(dataset.file(idx), distance))
 
-            image_path = df_dataset.iloc[image_id]['file']
+            image_path = dataset.file(image_id)
             files_to_show = []
             files_to_show.append(ImgUtils.scale(ImgUtils.read_image_numpy(image_path, image_w, image_h)))
 
-            duplicates_path = [f for f in list(df_dataset.iloc[indices]['file'])]
+            duplicates_path = dataset.files_at(indices)
             duplicates_arr = [ImgUtils.scale(ImgUtils.read_image_numpy(f, image_w, image_h)) for f in duplicates_path]
             files_to_show.extend(duplicates_arr)
             fig_acc = plt.figure(figsize=(10, len(files_to_show) * 5))
@@ -0,0 +1,19 @@
+from deduplication.duplicatefinder.PartitionedFinder import PartitionedFinder
+
+
+def shard_map(df_dataset, shards_path, shards, shard_id, distance_metric, threshold, leaf_size=40):
+    """
+    Find the near duplicates within a shard of the dataset, see PartitionedFinder.map_shard().
+    :param df_dataset: the whole dataset, e.g. the directory of a saved dataset.
+    :param shards_path: the directory of the shards, shared by the map and the reduce.
+    :param shards: the number of shards.
+    :param shard_id: the shard of this run.
+    :param distance_metric: the distance metric.
+    :param threshold: the maximum distance of the near duplicates.
+    :param leaf_size: the leaf size of the tree.
+    :return: the directory of the shard.
+    """
+    finder = PartitionedFinder(shards_path, distance_metric=distance_metric, leaf_size=leaf_size)
+    shard_path = finder.map_shard(df_dataset, shards, shard_id, threshold)
+    print("\tShard written into {}".format(shard_path))
+    return shard_path
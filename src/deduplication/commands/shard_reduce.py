@@ -0,0 +1,41 @@
+import numpy as np
+
+from deduplication.commands.helpers import keep_order, save_results
+from deduplication.duplicatefinder.PartitionedFinder import PartitionedFinder
+
+
+def shard_reduce(shards_path, output_path, hash_size, distance_metric, threshold, backup_keep, backup_duplicate,
+                 safe_deletion, leaf_size=40, backup_method='auto', deletion_mode='delete', results_format='csv',
+                 keep_policy='first', priority_paths=None):
+    """
+    Reconcile the shards written by shard_map() and process the duplicates like delete().
+    :param shards_path: the directory of the shards.
+    :param output_path: the directory of the results.
+    :param hash_size: the hash size, used in the names of the results.
+    :param distance_metric: the distance metric of the map.
+    :param threshold: the threshold of the map.
+    :param backup_keep: whether to copy the images to keep into output_path.
+    :param backup_duplicate: whether to copy the duplicates into output_path.
+    :param safe_deletion: whether to keep the duplicates on disk.
+    :param leaf_size: the leaf size of the trees.
+    :param backup_method: how the images are backed up, see helpers.backup_images().
+    :param deletion_mode: 'delete' or 'quarantine', see helpers.save_results(). 'link' isn't supported: the shards
+    don't record the image kept in place of each duplicate.
+    :param results_format: the format of the results files, see helpers.write_results().
+    :param keep_policy: the image kept in each group, see helpers.keep_order(). The order is computed from the
+    metadata saved with the shards.
+    :param priority_paths: the folders in order of preference of the 'path-priority' policy.
+    :return: the images to keep and the images to remove.
+    """
+    if deletion_mode == 'link':
+        raise ValueError("The link mode isn't supported by shard_reduce().")
+    finder = PartitionedFinder(shards_path, distance_metric=distance_metric, leaf_size=leaf_size)
+    keep_ranks = np.argsort(keep_order(finder.dataset(threshold), keep_policy, priority_paths)) \
+        if keep_policy != 'first' else None
+    to_keep, to_remove, _ = finder.reduce_shards(threshold, keep_ranks)
+    print('We have found {0}/{1} duplicates in the shards'.format(len(to_remove), len(to_keep) + len(to_remove)))
+
+    save_results(to_keep, to_remove, hash_size, threshold, output_path, backup_keep, backup_duplicate, safe_deletion,
+                 backup_method, deletion_mode, results_format=results_format)
+
+    return to_keep, to_remove
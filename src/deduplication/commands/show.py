@@ -2,17 +2,22 @@ import os
 
 from sklearn.manifold import TSNE
 
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.utils.ArrowUtils import ArrowUtils
 from deduplication.utils.PlotUtils import PlotUtils
 
 
 def show(df_dataset,
-         output_path):
+         output_path,
+         results_format='csv'):
     """
     Generating a t-SNE (t-distributed Stochastic Neighbor Embedding) of a set of images, using a feature vector for
     each image derived from the pHash function.
     :param df_dataset:
     :param images_path:
     :param output_path:
+    :param results_format: the format of images_tsne: csv, or parquet and arrow with the paths, the packed hashes
+    and the metadata of the dataset, see ArrowUtils.dataset_table().
     :param hash_algo:
     :param hash_size:
     :param parallel:
@@ -20,20 +25,26 @@ def show(df_dataset,
     :return:
     """
 
-    hash_str_len = len(df_dataset.at[0, 'hash_list'])
+    dataset = HashDataset.wrap(df_dataset)
 
     # The default of 1,000 iterations gives fine results, but I'm training for longer just to eke
     # out some marginal improvements. NB: This takes almost an hour!
     tsne = TSNE(random_state=1, n_iter=15000, metric="cosine")
 
-    embs = tsne.fit_transform(df_dataset[[str(i) for i in range(0, hash_str_len)]])
+    embs = tsne.fit_transform(dataset.hashes)
 
     # Add to dataframe for convenience
+    df_dataset = dataset.to_pandas()
     df_dataset['x'] = embs[:, 0]
     df_dataset['y'] = embs[:, 1]
 
     # Save a copy of our t-SNE mapping data for later use
-    df_dataset.to_csv(os.path.join(output_path, 'images_tsne.csv'))
+    tsne_path = os.path.join(output_path, 'images_tsne.' + results_format)
+    if results_format == 'csv':
+        df_dataset.to_csv(tsne_path)
+    else:
+        ArrowUtils.write_table(ArrowUtils.dataset_table(dataset, {'x': embs[:, 0], 'y': embs[:, 1]}), tsne_path,
+                               results_format)
 
     PlotUtils.plot_images_cluster(df_dataset, embs, output_path, width=4000, height=3000, max_dim=100)
     # TODO: image neigbours
@@ -0,0 +1,67 @@
+import os
+from collections import Counter
+
+from tqdm import tqdm
+
+from deduplication.commands.helpers import DELETION_JOURNAL, BACKUP_THREADS, map_in_threads
+from deduplication.utils.DeletionJournal import DeletionJournal, UNDONE
+from deduplication.utils.FileSystem import FileSystem, backup_methods
+
+
+def undo(run_path, threads=BACKUP_THREADS):
+    """
+    Restore the images removed by a run, from its deletion journal: the quarantined images are moved back, the
+    deleted images are restored from their backup and the images replaced by links are replaced back by their
+    backup. The images of the journal that are still in place are left untouched and won't be removed by a later
+    resume.
+    :param run_path: the output directory of the run.
+    :param threads: the number of threads.
+    :return: a Counter of the images by outcome: 'unquarantined', 'restored', 'present', 'lost' (deleted without
+    backup or purged) and 'error'.
+    """
+    journal = DeletionJournal(os.path.join(run_path, DELETION_JOURNAL))
+    intents, _, undone = journal.load()
+    todo = [entry for entry in intents if entry['file'] not in undone]
+    print("Restoring the images of {}...".format(journal.journal_path))
+
+    def restore(entry):
+        full_file_name = entry['file']
+        try:
+            linked = entry['action'] == 'link' and os.path.lexists(full_file_name) and \
+                (os.path.islink(full_file_name) or os.path.samefile(full_file_name, entry['target']))
+            if os.path.lexists(full_file_name) and not linked:
+                return entry, 'present'
+            if linked:
+                if entry['backup'] is None or not os.path.isfile(entry['backup']):
+                    return entry, 'lost'
+                # The link is replaced with a rename, as it was made.
+                directory, name = os.path.split(full_file_name)
+                tmp_path = os.path.join(directory, '.{}.undo.tmp'.format(name))
+                FileSystem.link_or_copy(entry['backup'], tmp_path, backup_methods['auto'])
+                os.replace(tmp_path, full_file_name)
+                return entry, 'restored'
+            if entry['quarantined'] is not None and os.path.isfile(entry['quarantined']):
+                os.makedirs(os.path.dirname(full_file_name), exist_ok=True)
+                FileSystem.move_file(entry['quarantined'], full_file_name)
+                return entry, 'unquarantined'
+            if entry['backup'] is not None and os.path.isfile(entry['backup']):
+                os.makedirs(os.path.dirname(full_file_name), exist_ok=True)
+                FileSystem.link_or_copy(entry['backup'], full_file_name, backup_methods['auto'])
+                return entry, 'restored'
+        except OSError as e:
+            print("Unable to restore file. %s" % e)
+            return entry, 'error'
+        return entry, 'lost'
+
+    counts = Counter()
+    with journal.recorder() as record, tqdm(total=len(todo)) as pbar:
+        for entry, outcome in map_in_threads(restore, todo, threads):
+            if outcome in ['unquarantined', 'restored', 'present']:
+                record(UNDONE, entry['file'])
+            counts[outcome] += 1
+            pbar.update(1)
+
+    print("\t{0} moved back from the quarantine, {1} restored from the backup, {2} still in place, {3} lost, "
+          "{4} errors".format(counts['unquarantined'], counts['restored'], counts['present'], counts['lost'],
+                              counts['error']))
+    return counts
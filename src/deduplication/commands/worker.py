@@ -0,0 +1,73 @@
+import os
+import socket
+import threading
+import time
+
+from deduplication.dataset.ImageToHash import ImageToHash
+from deduplication.dataset.PathTable import PathTable
+from deduplication.dataset.WorkQueue import WorkQueue
+
+
+def worker(queue_path, worker_id=None, lease_seconds=600, poll_interval=5, parallel=False, batch_size=32, workers=None,
+           **image_to_hash_args):
+    """
+    Hash the batches of a work queue until every batch is done.
+
+    The lease of the current batch is renewed by a background thread, a worker that dies loses its lease and the
+    batch is hashed again by another worker.
+    :param queue_path: the directory of the queue, see enqueue().
+    :param worker_id: the id of the worker, by default host:pid.
+    :param lease_seconds: the duration of the leases.
+    :param poll_interval: the seconds waited before looking for an expired lease, when no batch is pending.
+    :param parallel: whether each batch is hashed by a pool of processes.
+    :param batch_size: the number of images hashed by each task of the pool.
+    :param workers: the number of processes of the pool.
+    :param image_to_hash_args: the other arguments of ImageToHash (read rate limits, timeouts, ...).
+    :return: the number of batches hashed by the worker.
+    """
+    work_queue = WorkQueue(queue_path)
+    settings = work_queue.settings()
+    if worker_id is None:
+        worker_id = "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+    hashed_batches = 0
+    while True:
+        claimed = work_queue.claim(worker_id, lease_seconds)
+        if claimed is None:
+            status = work_queue.status()
+            if status['pending'] + status['leased'] + status['expired'] == 0:
+                break
+            # The other batches are being hashed, wait for one of them to expire.
+            time.sleep(poll_interval)
+            continue
+
+        batch_id, paths = claimed
+        print("Worker {0}: batch {1} ({2} images)".format(worker_id, batch_id, len(paths)))
+
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(lease_seconds / 3):
+                work_queue.renew(batch_id, worker_id, lease_seconds)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            image_to_hash = ImageToHash(paths, hash_size=settings['hash_size'], hash_algo=settings['hash_algo'],
+                                        natural_order=False, **image_to_hash_args)
+            dataset, _ = image_to_hash.build_dataset(parallel=parallel, batch_size=batch_size, workers=workers)
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+
+        paths = PathTable.from_paths(paths)
+        if work_queue.complete(batch_id, worker_id, dataset.hashes, [paths.index_of(file) for file in dataset.files],
+                               dataset.metadata['file_size'], image_to_hash.quarantined,
+                               {name: values for name, values in dataset.metadata.items() if name != 'file_size'}):
+            hashed_batches += 1
+        else:
+            print("Worker {0}: the lease of batch {1} has expired, the result is discarded".format(worker_id,
+                                                                                                    batch_id))
+
+    print("Worker {0}: {1} batches hashed".format(worker_id, hashed_batches))
+    return hashed_batches
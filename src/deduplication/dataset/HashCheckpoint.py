@@ -0,0 +1,77 @@
+import json
+import os
+
+import pandas as pd
+
+from deduplication.dataset.PathTable import PathTable
+
+
+class HashCheckpoint(object):
+    """
+    Append-only checkpoint of the hashes computed by ImageToHash.
+
+    The checkpoint is a JSON Lines file: the first line records the hash settings, every other line records an
+    hashed image. The completed batches are appended and synced to disk as soon as they are available, so a run
+    that has been interrupted can skip the images already hashed.
+    """
+
+    def __init__(self, checkpoint_path, hash_size=8, hash_algo='phash', metadata_names=()):
+        self.checkpoint_path = checkpoint_path
+        self.header = {'hash_algo': hash_algo, 'hash_size': hash_size}
+        # The metadata recorded with each image, the records of the previous versions don't have them.
+        self.metadata_names = list(metadata_names)
+
+    def load(self, img_file_list):
+        """
+        Load the hashes of the checkpoint.
+        :param img_file_list: the images of the current run (a PathTable), the other images of the checkpoint are
+        ignored.
+        :return: a Pandas DataFrame with the same columns of ImageToHash.build_hash_to_image_dataframe(), the missing
+        metadata are NaN.
+        """
+        rows = []
+        if os.path.exists(self.checkpoint_path):
+            img_file_list = PathTable.from_paths(img_file_list)
+            complete = 0
+            with open(self.checkpoint_path, 'rb') as f:
+                for i, line in enumerate(f):
+                    # The last line is truncated if the process has been killed while writing it.
+                    if not line.endswith(b'\n'):
+                        break
+                    complete += len(line)
+                    record = json.loads(line.decode('utf-8'))
+                    if i == 0:
+                        if record != self.header:
+                            raise ValueError("The checkpoint {0} has been created with {1}, not {2}.".format(
+                                self.checkpoint_path, record, self.header))
+                        continue
+                    position = img_file_list.index_of(record['file'])
+                    if position is not None:
+                        rows.append([position, record['hash'], record['file_size'], 0.0] +
+                                    [record.get(name) for name in self.metadata_names])
+
+            # Drop the truncated line, so the next batches are appended after the last complete line.
+            if complete < os.path.getsize(self.checkpoint_path):
+                os.truncate(self.checkpoint_path, complete)
+
+        return pd.DataFrame(rows, columns=['position', 'hash', 'file_size', 'throttle_wait'] + self.metadata_names)
+
+    def append(self, result):
+        """
+        Append a batch of hashes to the checkpoint and sync it to disk.
+        :param result: a dict of lists with 'file', 'hash', 'file_size' and metadata keys,
+        see ImageToHash.multiprocessing_img_hash().
+        """
+        lines = []
+        if not os.path.exists(self.checkpoint_path) or os.path.getsize(self.checkpoint_path) == 0:
+            lines.append(json.dumps(self.header))
+        for i, (file, hash_code, file_size) in enumerate(zip(result['file'], result['hash'], result['file_size'])):
+            record = {'file': file, 'hash': str(hash_code), 'file_size': int(file_size)}
+            # NaN is written as a JSON extension, json.loads() reads it back.
+            record.update((name, result[name][i]) for name in self.metadata_names)
+            lines.append(json.dumps(record))
+
+        with open(self.checkpoint_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
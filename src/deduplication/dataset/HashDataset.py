@@ -0,0 +1,253 @@
+import json
+import os
+import shutil
+
+import imagehash
+import numpy as np
+import pandas as pd
+
+from deduplication.dataset.PathTable import PathTable
+
+# Identifies the directories written by HashDataset.save().
+STORE_FORMAT = 'deduplication-hash-store'
+STORE_VERSION = 2
+
+
+class HashDataset(object):
+    """
+    Struct-of-arrays container of hashed images.
+
+    - hashes: a C-contiguous uint8 matrix N x L, where N is the number of images and L the number of hexadecimal
+      digits of the hash. Each element is a digit of the hash (0-15).
+    - files: a PathTable of the image's file paths, hashes[i] is the hash of files[i].
+    - metadata: optional dict name -> numpy array of length N (e.g. 'file_size').
+
+    A HashDataset can be saved into a directory and opened back, see save() and load().
+    """
+
+    def __init__(self, hashes, files, metadata=None, hash_size=8, hash_algo='phash'):
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint8)
+        self.files = PathTable.from_paths(files)
+        self.metadata = metadata if metadata is not None else {}
+        self.hash_size = hash_size
+        self.hash_algo = hash_algo
+
+        assert self.hashes.ndim == 2 and self.hashes.shape[0] == len(self.files), \
+            "The hashes and the files must have the same length."
+
+    def __len__(self):
+        return self.hashes.shape[0]
+
+    @property
+    def hash_length(self):
+        """ The number of hexadecimal digits of a hash. """
+        return self.hashes.shape[1]
+
+    def file(self, i):
+        return self.files[int(i)]
+
+    def files_at(self, indices):
+        return self.files.take(indices)
+
+    def take(self, indices):
+        """
+        Select some images.
+        :param indices: the positions of the images.
+        :return: a HashDataset with their hashes, files and metadata.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        return HashDataset(self.hashes[indices], self.files.take(indices),
+                           metadata={name: np.asarray(values)[indices] for name, values in self.metadata.items()},
+                           hash_size=self.hash_size, hash_algo=self.hash_algo)
+
+    def index_of(self, file):
+        """
+        Retrieve the position of an image.
+        :param file: the image's file path.
+        :return: the position of the image or None if the image isn't in the dataset.
+        """
+        return self.files.index_of(file)
+
+    def hash(self, i):
+        """ The ImageHash of the i-th image. """
+        return imagehash.hex_to_hash(HashDataset.digits_to_hex(self.hashes[int(i)]))
+
+    @staticmethod
+    def hex_to_digits(hex_hashes, hash_length=None):
+        """
+        Convert hexadecimal hashes into a matrix of digits, without looping in Python.
+        :param hex_hashes: a list of hexadecimal strings of the same length.
+        :param hash_length: the length of the strings, needed when hex_hashes is empty.
+        :return: a uint8 matrix len(hex_hashes) x hash_length.
+        """
+        if len(hex_hashes) == 0:
+            return np.zeros((0, hash_length or 0), dtype=np.uint8)
+
+        ascii_codes = np.frombuffer(''.join(hex_hashes).encode('ascii'), dtype=np.uint8)
+        # '0'-'9' -> 0-9, 'a'-'f' -> 10-15
+        digits = np.where(ascii_codes >= ord('a'), ascii_codes - (ord('a') - 10), ascii_codes - ord('0'))
+        return digits.astype(np.uint8).reshape(len(hex_hashes), -1)
+
+    @staticmethod
+    def pack_digits(digits):
+        """
+        Pack two hexadecimal digits per byte, the first digit in the high nibble.
+        :param digits: a uint8 matrix N x L.
+        :return: a uint8 matrix N x ceil(L / 2).
+        """
+        digits = np.asarray(digits, dtype=np.uint8)
+        if digits.shape[1] % 2 == 1:
+            digits = np.concatenate([digits, np.zeros((digits.shape[0], 1), dtype=np.uint8)], axis=1)
+        return (digits[:, 0::2] << 4) | digits[:, 1::2]
+
+    @staticmethod
+    def unpack_digits(packed, hash_length):
+        """
+        The inverse of pack_digits().
+        :param packed: a uint8 matrix N x ceil(L / 2).
+        :param hash_length: the number of digits L.
+        :return: a uint8 matrix N x L.
+        """
+        packed = np.asarray(packed, dtype=np.uint8)
+        digits = np.empty((packed.shape[0], packed.shape[1] * 2), dtype=np.uint8)
+        digits[:, 0::2] = packed >> 4
+        digits[:, 1::2] = packed & 0xF
+        return digits[:, :hash_length]
+
+    @staticmethod
+    def digits_to_hex(digits):
+        return ''.join('{:x}'.format(d) for d in digits)
+
+    @staticmethod
+    def from_pandas(df_dataset, hash_size=8, hash_algo='phash'):
+        """
+        Build a HashDataset from a Pandas DataFrame with columns 'file', '0', '1', ..., 'L-1'.
+        """
+        hash_length = len([c for c in df_dataset.columns if str(c).isdigit()])
+        hashes = df_dataset[[str(i) for i in range(0, hash_length)]].to_numpy()
+        return HashDataset(hashes, df_dataset['file'], hash_size=hash_size, hash_algo=hash_algo)
+
+    @staticmethod
+    def wrap(dataset):
+        """
+        Return dataset as a HashDataset.
+        :param dataset: a HashDataset, the directory of a saved HashDataset or a Pandas DataFrame built by the
+        previous versions of ImageToHash.
+        """
+        if isinstance(dataset, HashDataset):
+            return dataset
+        if isinstance(dataset, str):
+            return HashDataset.load(dataset)
+        if isinstance(dataset, pd.DataFrame):
+            return HashDataset.from_pandas(dataset)
+        raise TypeError("{} can't be converted to a HashDataset.".format(type(dataset)))
+
+    def to_pandas(self):
+        """
+        A Pandas DataFrame with columns 'file', 'short_file', 'hash', 'hash_list', '0', '1', ..., 'L-1' and the
+        metadata. The hash columns are a view of the hashes matrix, they aren't copied.
+        """
+        df_dataset = pd.DataFrame(self.hashes, columns=[str(i) for i in range(0, self.hash_length)], copy=False)
+
+        hex_hashes = [HashDataset.digits_to_hex(digits) for digits in self.hashes]
+        df_dataset.insert(0, 'file', list(self.files))
+        df_dataset.insert(1, 'short_file', [self.files.name(i) for i in range(0, len(self))])
+        df_dataset.insert(2, 'hash', [imagehash.hex_to_hash(h) for h in hex_hashes])
+        df_dataset.insert(3, 'hash_list', [list(h) for h in hex_hashes])
+        for name, values in self.metadata.items():
+            df_dataset[name] = values
+
+        return df_dataset
+
+    def save(self, path):
+        """
+        Write the dataset into a directory:
+        - header.json: the format, the hash settings, the number of images and the metadata names.
+        - hashes.npy: the hashes matrix packed two digits per byte, N x ceil(L / 2), see pack_digits().
+        - paths_*: the PathTable, see PathTable.save().
+        - metadata_<name>.npy: a file for each metadata.
+        The directory is written aside and renamed at the end. An existing dataset is replaced, any other existing
+        file or directory raises a ValueError.
+        :param path: the directory.
+        """
+        path = os.path.abspath(path)
+        if os.path.lexists(path) and not HashDataset.is_saved_dataset(path):
+            raise ValueError("{} exists and isn't a saved dataset, it won't be replaced.".format(path))
+        tmp_path = path + '.tmp'
+        if os.path.lexists(tmp_path):
+            # Left by an interrupted save(): it doesn't have a header yet.
+            if not os.path.isdir(tmp_path) or os.path.islink(tmp_path) or \
+                    not set(os.listdir(tmp_path)) <= HashDataset.store_files(tmp_path):
+                raise ValueError("{} exists and isn't a partially saved dataset, it won't be replaced."
+                                 .format(tmp_path))
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        np.save(os.path.join(tmp_path, 'hashes.npy'), HashDataset.pack_digits(self.hashes))
+        self.files.save(tmp_path, prefix='paths')
+        for name, values in self.metadata.items():
+            np.save(os.path.join(tmp_path, 'metadata_' + name + '.npy'), np.asarray(values))
+        header = {'format': STORE_FORMAT, 'version': STORE_VERSION, 'hash_size': self.hash_size,
+                  'hash_algo': self.hash_algo, 'images': len(self), 'hash_length': self.hash_length,
+                  'metadata': list(self.metadata.keys())}
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=2)
+
+        if os.path.lexists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def is_saved_dataset(path):
+        """
+        :param path: a path.
+        :return: True if path is a directory written by save(), i.e. it has a header.json of the store format.
+        """
+        if not os.path.isdir(path) or os.path.islink(path):
+            return False
+        try:
+            with open(os.path.join(path, 'header.json')) as f:
+                header = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return isinstance(header, dict) and header.get('format') == STORE_FORMAT
+
+    @staticmethod
+    def store_files(path):
+        """
+        :param path: a directory.
+        :return: the names of its files that save() may write, whatever the metadata.
+        """
+        names = {'hashes.npy', 'header.json', 'paths_directories.json', 'paths_directory_ids.npy',
+                 'paths_offsets.npy', 'paths_names.bin'}
+        return names | {name for name in os.listdir(path) if name.startswith('metadata_') and name.endswith('.npy')}
+
+    @staticmethod
+    def load(path, mmap_mode='r'):
+        """
+        Open a dataset written by save(). By default the paths and the metadata are memory-mapped: the processes that
+        open the same dataset share the page cache instead of holding their own copy. The packed hashes are read
+        through the page cache too and unpacked in memory, L bytes per image. The datasets of the version 1 hold the
+        unpacked hashes, they're still opened.
+        :param path: the directory.
+        :param mmap_mode: the mmap_mode of np.load(), None to read the dataset in memory.
+        :return: a HashDataset.
+        """
+        header_path = os.path.join(path, 'header.json')
+        if not os.path.exists(header_path):
+            raise ValueError("{} isn't a saved dataset.".format(path))
+        with open(header_path) as f:
+            header = json.load(f)
+        if header.get('format') != STORE_FORMAT or header.get('version') not in [1, STORE_VERSION]:
+            raise ValueError("{0} has an unsupported format: {1} version {2}.".format(path, header.get('format'),
+                                                                                      header.get('version')))
+
+        hashes = np.load(os.path.join(path, 'hashes.npy'), mmap_mode=mmap_mode)
+        if header['version'] > 1:
+            hashes = HashDataset.unpack_digits(hashes, header['hash_length'])
+        files = PathTable.load(path, prefix='paths', mmap_mode=mmap_mode)
+        metadata = {name: np.load(os.path.join(path, 'metadata_' + name + '.npy'), mmap_mode=mmap_mode)
+                    for name in header['metadata']}
+
+        return HashDataset(hashes, files, metadata=metadata, hash_size=header['hash_size'],
+                           hash_algo=header['hash_algo'])
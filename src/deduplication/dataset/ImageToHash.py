@@ -1,13 +1,28 @@
+import datetime
 import multiprocessing
 import os
+import signal
+import threading
 import time
+import warnings
+from collections import deque
+from contextlib import contextmanager
 
 import imagehash
+import numpy as np
 import pandas as pd
 from PIL import Image
-from natsort import natsorted
+from natsort import index_natsorted, natsorted
 from tqdm import tqdm
 
+from deduplication.dataset.HashCheckpoint import HashCheckpoint
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.dataset.PathTable import PathTable
+from deduplication.dataset.Quarantine import Quarantine
+from deduplication.utils.CpuUtils import CpuUtils
+from deduplication.utils.FileSystem import FileSystem
+from deduplication.utils.RateLimiter import RateLimiter
+
 hash_algo_dict = {'average_hash': imagehash.average_hash, 'dhash': imagehash.dhash, 'phash': imagehash.phash,
                   'whash': imagehash.whash}
 
@@ -15,21 +30,169 @@ hash_algo_dict = {'average_hash': imagehash.average_hash, 'dhash': imagehash.dha
 image_extensions = ['.bmp', '.jp2', 'pcx', '.jpe', '.jpg', '.jpeg', '.tif', '.gif', '.tiff', '.rgb', '.png', 'x-ms-bmp',
                     'x-portable-pixmap', 'x-xbitmap']
 
+# The metadata recorded by the hashing pass, besides the file size, as name -> (dtype, value when it's unknown):
+# - width, height: the pixel dimensions.
+# - format: the format detected by Pillow, e.g. 'JPEG'.
+# - mtime: the modification time of the file, in seconds since the epoch.
+# - exif_time: the EXIF capture time (DateTimeOriginal, else DateTime) taken as UTC, NaN without EXIF.
+# - jpeg_quality: the quality (1-100) estimated from the quantization table of a JPEG, 0 for the other formats.
+# - sharpness: the variance of the Laplacian of the downscaled grayscale image, NaN unless the quality score is on.
+image_metadata = {'width': (np.int64, 0), 'height': (np.int64, 0), 'format': (str, ''),
+                  'mtime': (np.float64, np.nan), 'exif_time': (np.float64, np.nan), 'jpeg_quality': (np.int64, 0),
+                  'sharpness': (np.float64, np.nan)}
+
+# The largest side of the grayscale image whose sharpness is measured.
+SHARPNESS_SIZE = 512
+
+# The luminance quantization table of the IJG reference encoder at quality 50. Only its sum is used by the quality
+# estimate, so the order of the coefficients doesn't matter.
+IJG_LUMINANCE_TABLE = [16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55, 14, 13, 16, 24, 40, 57, 69, 56,
+                       14, 17, 22, 29, 51, 87, 80, 62, 18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113,
+                       92, 49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99]
+
+# EXIF tags of the capture time.
+EXIF_IFD = 0x8769
+EXIF_DATE_TIME_ORIGINAL = 36867
+EXIF_DATE_TIME = 306
+
+# Orders in which the images can be read from disk.
+# - natural: the order of img_file_list.
+# - inode: sorted by inode number.
+# - fiemap: sorted by the physical offset of the first extent (Linux only), falling back to inode.
+scheduling_orders = ['natural', 'inode', 'fiemap']
+
+# The read rate limiter of the current process, see ImageToHash.init_worker().
+_rate_limiter = RateLimiter()
+
+# Extra time given to a batch of images, on top of image_timeout for each image, before its worker is considered
+# stuck and the pool is replaced.
+WATCHDOG_GRACE_SECONDS = 10
+
+# Interval between two checks of the workers of the pool, a batch whose worker has died is submitted again.
+WATCHDOG_POLL_SECONDS = 1
+
+# The queue where the workers of the pool report (batch id, pid) when they start a batch, see
+# ImageToHash.init_worker().
+_started_batches = None
+
+
+def _on_image_timeout(signum, frame):
+    raise TimeoutError("Decoding timed out")
+
 
 class ImageToHash(object):
 
-    def __init__(self, images_path, hash_size=8, hash_algo='phash', natural_order=True, verbose=0):
+    def __init__(self, images_path, hash_size=8, hash_algo='phash', natural_order=True, verbose=0,
+                 scheduling_order='natural', max_bytes_per_second=None, max_files_per_second=None,
+                 worker_priority='normal', checkpoint_path=None, image_timeout=None, max_image_pixels=None,
+                 max_worker_memory=None, quarantine_path=None, quality_score=False):
+        assert scheduling_order in scheduling_orders, "{} isn't a valid scheduling order.".format(scheduling_order)
 
         self.hash_size = hash_size
         self.hash_algo = hash_algo
         self.verbose = verbose
-        self.df_dataset = None
+        # Whether the sharpness of each image is measured while it's hashed.
+        self.quality_score = quality_score
+        self.dataset = None
+
+        # Read throttling, shared among the workers when parallel is enabled.
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_files_per_second = max_files_per_second
+        self.worker_priority = worker_priority
+        # Statistics of the last build_dataset() call.
+        self.stats = {}
+
+        # The hashes are appended to the checkpoint as they are computed, so an interrupted run can be resumed.
+        self.checkpoint = HashCheckpoint(checkpoint_path, hash_size=hash_size, hash_algo=hash_algo,
+                                         metadata_names=image_metadata) if checkpoint_path is not None else None
+
+        # Protection against pathological images: decoding time, decoded size and memory of the workers.
+        self.image_timeout = image_timeout
+        self.max_image_pixels = max_image_pixels
+        self.max_worker_memory = max_worker_memory
+        # The images that can't be hashed, as (image's file path, reason), and the list of the previous runs.
+        self.quarantined = []
+        self.quarantine = Quarantine(quarantine_path) if quarantine_path is not None else None
+
+        # Retrieve the images contained in images_path, images_path can also be a list of images. The paths are kept
+        # in a PathTable, the pipeline refers to the images by their position in img_file_list.
+        skipped = self.quarantine.load() if self.quarantine is not None else set()
+        if len(skipped) > 0:
+            print("Skipping {0} images in quarantine ({1})".format(len(skipped), self.quarantine.quarantine_path))
+        if isinstance(images_path, (list, tuple, PathTable)):
+            directory_file_list = [image for image in images_path if image not in skipped]
+            order = index_natsorted(directory_file_list) if natural_order else range(0, len(directory_file_list))
+            self.img_file_list = PathTable.from_paths(directory_file_list[i] for i in order)
+        else:
+            self.img_file_list = ImageToHash.get_images_table(images_path, natural_order=natural_order,
+                                                              skipped=skipped)
+
+        # The order in which the images are read, as positions in img_file_list. The results are always reported
+        # following img_file_list.
+        if scheduling_order == 'natural':
+            self.schedule = np.arange(0, len(self.img_file_list))
+        else:
+            self.schedule = np.asarray(FileSystem.disk_locality_order(self.img_file_list, method=scheduling_order,
+                                                                      return_indices=True), dtype=np.int64)
 
-        # Retrieve the images contained in images_path.
-        self.img_file_list = ImageToHash.get_images_list(images_path, natural_order=natural_order)
+    def __getstate__(self):
+        # The pool's tasks are bound methods: the workers don't need the list of images nor the dataset.
+        state = self.__dict__.copy()
+        for name in ['img_file_list', 'schedule', 'dataset', 'quarantined']:
+            state.pop(name, None)
+        return state
+
+    @property
+    def scheduled_file_list(self):
+        """ The images in the order in which they are read. """
+        return self.img_file_list.take(self.schedule)
+
+    @staticmethod
+    def init_worker(max_bytes_per_second=None, max_files_per_second=None, worker_priority='normal',
+                    max_image_pixels=None, max_worker_memory=None, started_batches=None):
+        """
+        Initialize a process that hashes images: set its read rate limits, its scheduling priority and its limits.
+        :param max_bytes_per_second: The maximum number of bytes read per second by the process.
+        :param max_files_per_second: The maximum number of files read per second by the process.
+        :param worker_priority: The scheduling priority of the process.
+        :param max_image_pixels: The images with more pixels are rejected as decompression bombs.
+        :param max_worker_memory: The maximum address space of the process in bytes (Unix only).
+        :param started_batches: a multiprocessing SimpleQueue where the process reports the batches it starts.
+        """
+        global _rate_limiter, _started_batches
+        _rate_limiter = RateLimiter(bytes_per_second=max_bytes_per_second, files_per_second=max_files_per_second)
+        _started_batches = started_batches
+        CpuUtils.set_priority(worker_priority)
+
+        if max_image_pixels is not None:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
+            # By default Pillow only warns below 2 * MAX_IMAGE_PIXELS.
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+        if max_worker_memory is not None:
+            import resource
+            resource.setrlimit(resource.RLIMIT_AS, (max_worker_memory, max_worker_memory))
+
+    @contextmanager
+    def worker_limits(self):
+        """
+        Apply the read rate limits and the decompression bomb limit of init_worker() to the current process, they
+        are restored on exit. The memory limit and the priority are only applied to the child processes.
+        """
+        global _rate_limiter
+        previous_rate_limiter = _rate_limiter
+        previous_max_image_pixels = Image.MAX_IMAGE_PIXELS
+        with warnings.catch_warnings():
+            try:
+                ImageToHash.init_worker(self.max_bytes_per_second, self.max_files_per_second, 'normal',
+                                        self.max_image_pixels)
+                yield
+            finally:
+                _rate_limiter = previous_rate_limiter
+                Image.MAX_IMAGE_PIXELS = previous_max_image_pixels
 
     @staticmethod
-    def img_hash(image_path, hash_size=8, hash_algo='phash'):
+    def img_hash(image_path, hash_size=8, hash_algo='phash', quality_score=False):
         """
 
         Hash computation.
@@ -39,9 +202,74 @@ class ImageToHash(object):
         :param image_path: A filename (string).
         :param hash_size: The size of hash.
         :param hash_algo: The hash algorithm.
-        :return: an ImageHash.
+        :param quality_score: Whether to measure the sharpness of the image, on the grayscale image decoded for the
+        hash.
+        :return: an ImageHash and a dict of the metadata of the image, see image_metadata.
+        """
+        image = Image.open(image_path)
+        metadata = ImageToHash.read_metadata(image)
+        # Every hash algorithm starts from the grayscale image, it's decoded once and shared with the sharpness.
+        gray = image.convert('L')
+        if quality_score:
+            metadata['sharpness'] = ImageToHash.sharpness(gray)
+        return hash_algo_dict[hash_algo](gray, hash_size=hash_size), metadata
+
+    @staticmethod
+    def sharpness(gray):
+        """
+        The variance of the Laplacian of a grayscale image, downscaled to SHARPNESS_SIZE: the blurred frames of a
+        burst have a lower variance.
+        :param gray: a PIL Image in mode 'L'.
+        :return: the variance.
+        """
+        scale = SHARPNESS_SIZE / max(gray.size)
+        if scale < 1:
+            gray = gray.resize((max(1, round(gray.size[0] * scale)), max(1, round(gray.size[1] * scale))),
+                               Image.BILINEAR)
+        pixels = np.asarray(gray, dtype=np.float32)
+        if pixels.shape[0] < 3 or pixels.shape[1] < 3:
+            return 0.0
+        laplacian = pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:] - 4 * pixels[1:-1, 1:-1]
+        return float(laplacian.var())
+
+    @staticmethod
+    def jpeg_quality(image):
+        """
+        Estimate the quality setting of a JPEG from its luminance quantization table, as the inverse of the scaling
+        of the IJG reference encoder. Only the header is read.
+        :param image: a PIL Image.
+        :return: the quality between 1 and 100, 0 if the image isn't a JPEG.
         """
-        return hash_algo_dict[hash_algo](Image.open(image_path), hash_size=hash_size)
+        tables = getattr(image, 'quantization', None)
+        if image.format != 'JPEG' or not tables:
+            return 0
+        # The scaling factor of the reference table, in percent.
+        scale = sum(tables[min(tables)]) * 100 / sum(IJG_LUMINANCE_TABLE)
+        quality = 5000 / scale if scale > 100 else (200 - scale) / 2
+        return int(min(100, max(1, round(quality))))
+
+    @staticmethod
+    def read_metadata(image):
+        """
+        The metadata of an opened image, only its header is read.
+        :param image: a PIL Image.
+        :return: a dict with 'width', 'height', 'format', 'exif_time', 'jpeg_quality' and 'sharpness' (NaN) keys.
+        """
+        width, height = image.size
+        exif_time = np.nan
+        try:
+            exif = image.getexif()
+            # Pillow >= 8.2 only reads the Exif IFD on request.
+            exif_ifd = exif.get_ifd(EXIF_IFD) if hasattr(exif, 'get_ifd') else exif
+            capture_time = exif_ifd.get(EXIF_DATE_TIME_ORIGINAL) or exif.get(EXIF_DATE_TIME)
+            if capture_time:
+                exif_time = datetime.datetime.strptime(str(capture_time).strip('\x00 '), '%Y:%m:%d %H:%M:%S') \
+                    .replace(tzinfo=datetime.timezone.utc).timestamp()
+        except Exception:
+            # Missing or corrupt EXIF data doesn't prevent the hashing.
+            pass
+        return {'width': width, 'height': height, 'format': image.format or '', 'exif_time': exif_time,
+                'jpeg_quality': ImageToHash.jpeg_quality(image), 'sharpness': np.nan}
 
     @staticmethod
     def get_images_list(path, natural_order=True):
@@ -63,132 +291,451 @@ class ImageToHash(object):
 
         return images_file_list
 
-    def build_dataset(self, parallel=False, batch_size=32):
+    @staticmethod
+    def get_images_table(path, natural_order=True, skipped=()):
+        """
+        Retrieve the images contained in a path into a PathTable, built while the directories are walked: only the
+        names of the directories being walked are held as Python strings.
+        :param path: path of directory containing images.
+        :param natural_order: Enable Natural sort: the images are in the natural order of their full paths, as
+        get_images_list() sorts them. The files and the subdirectories of each directory are sorted together, a
+        subdirectory takes the place of its path followed by a separator.
+        :param skipped: the images to leave out, e.g. the quarantined images.
+        :return: a PathTable.
+        """
+        def images(directory):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                # os.walk() skips the directories that can't be listed too.
+                return
+            # (sort key, path, is a directory), the symbolic links to directories aren't followed, as by os.walk().
+            items = [(entry.name + os.sep, entry.path, True) if entry.is_dir() else (entry.name, entry.path, False)
+                     for entry in entries if not (entry.is_dir() and entry.is_symlink())]
+            for _, item, is_directory in (natsorted(items, key=lambda item: item[0]) if natural_order else items):
+                if is_directory:
+                    yield from images(item)
+                elif any([item.lower().endswith(extension) for extension in image_extensions]) and \
+                        item not in skipped:
+                    yield item
+
+        images_table = PathTable.from_paths(images(path))
+
+        assert len(images_table) > 0, "The path doesn't contain images."
+
+        return images_table
+
+    def build_dataset(self, parallel=False, batch_size=32, workers=None):
         """
         Build the dataset.
+        :param parallel: Whether to hash the images using a pool of processes.
+        :param batch_size: The number of images hashed by each task of the pool.
+        :param workers: The number of processes of the pool, by default the CPUs available to the process.
+        :return: a HashDataset and the list of images (a PathTable).
         """
 
         print('Building the dataset...')
 
+        # Skip the images that have already been hashed by an interrupted run.
+        positions = self.schedule
+        df_checkpoint = None
+        if self.checkpoint is not None:
+            df_checkpoint = self.checkpoint.load(self.img_file_list)
+            if len(df_checkpoint) > 0:
+                print("\tResuming from {0}: {1} images already hashed".format(self.checkpoint.checkpoint_path,
+                                                                           len(df_checkpoint)))
+                positions = positions[~np.isin(positions, df_checkpoint['position'].to_numpy())]
+
         if parallel:
             print('\tParallel mode has been enabled...')
-            number_of_cpu = multiprocessing.cpu_count()
+            number_of_cpu = CpuUtils.number_of_workers(workers)
             print("\tCPU: {}".format(number_of_cpu))
 
             if number_of_cpu >= 2:
                 self.number_of_cpu = number_of_cpu
             else:
-                raise ValueError("Number of CPU must greater than or equal to 2.")
-            df_hashes = self.parallel_build_hash_to_image_dataframe(batch_size=batch_size)
+                # e.g. --workers 1 or a container limited to a single CPU.
+                warnings.warn("A single worker is available, the images are hashed serially.")
+                parallel = False
+        if parallel:
+            start_time = time.time()
+            df_hashes = self.parallel_build_hash_to_image_dataframe(batch_size=batch_size, positions=positions)
         else:
-            df_hashes = self.build_hash_to_image_dataframe()
+            start_time = time.time()
+            if self.worker_priority != 'normal':
+                # The priority of a process can't be raised back: a single child process hashes the images, so the
+                # command keeps its own priority.
+                self.number_of_cpu = 1
+                df_hashes = self.parallel_build_hash_to_image_dataframe(batch_size=batch_size, positions=positions)
+            else:
+                with self.worker_limits():
+                    df_hashes = self.build_hash_to_image_dataframe(batch_size=batch_size, positions=positions)
+
+        self.update_stats(df_hashes, time.time() - start_time)
+
+        if len(self.quarantined) > 0:
+            print("\t{} images can't be hashed and have been quarantined".format(len(self.quarantined)))
+            if self.verbose == 2:
+                for image, reason in self.quarantined:
+                    print("\t\t{0}: {1}".format(image, reason))
+
+        if df_checkpoint is not None and len(df_checkpoint) > 0:
+            df_hashes = pd.concat([df_checkpoint, df_hashes], ignore_index=True, sort=False)
+
+        df_hashes = self.sort_as_img_file_list(df_hashes)
+
+        # The hashes are stored once in a matrix, one column for each hexadecimal digit.
+        self.dataset = HashDataset(HashDataset.hex_to_digits(list(df_hashes['hash']), -(-self.hash_size ** 2 // 4)),
+                                   self.img_file_list.take(df_hashes['position'].to_numpy(dtype=np.int64)),
+                                   metadata=ImageToHash.metadata_arrays(df_hashes),
+                                   hash_size=self.hash_size,
+                                   hash_algo=self.hash_algo)
+        return self.dataset, self.img_file_list
+
+    @staticmethod
+    def metadata_arrays(df_hashes):
+        """
+        The metadata of the dataset.
+        :param df_hashes: a Pandas DataFrame with the columns of build_hash_to_image_dataframe().
+        :return: a dict name -> numpy array, the unknown values are replaced by the defaults of image_metadata.
+        """
+        metadata = {'file_size': df_hashes['file_size'].to_numpy(dtype=np.int64)}
+        for name, (dtype, default) in image_metadata.items():
+            metadata[name] = df_hashes[name].fillna(default).to_numpy(dtype=dtype) if name in df_hashes \
+                else np.full(len(df_hashes), default, dtype=dtype)
+        return metadata
 
-        df_hashes = df_hashes[['file', 'short_file', 'hash', 'hash_list']]
-        lambdafunc = lambda x: pd.Series([int(i, 16) for key, i in zip(range(0, len(x['hash_list'])), x['hash_list'])])
-        newcols = df_hashes.apply(lambdafunc, axis=1)
-        newcols.columns = [str(i) for i in range(0, len(df_hashes.iloc[0]['hash_list']))]
+    def save_dataset(self, dataset_path):
+        """
+        Write the dataset built by build_dataset(), see HashDataset.save().
+        :param dataset_path: the directory of the dataset.
+        """
+        assert self.dataset is not None, "The dataset hasn't been built yet."
+        self.dataset.save(dataset_path)
+        print("\tDataset saved into {}".format(dataset_path))
+
+    def update_stats(self, df_hashes, elapsed):
+        """
+        Compute and print the throughput of the hashing and the time spent waiting for the read rate limits.
+        :param df_hashes: a Pandas DataFrame with 'file_size' and 'throttle_wait' columns.
+        :param elapsed: the duration of the hashing in seconds.
+        """
+        elapsed = max(elapsed, 1e-9)
+        self.stats = {'files': len(df_hashes),
+                      'bytes': int(df_hashes['file_size'].sum()),
+                      'seconds': elapsed,
+                      'throttle_wait': float(df_hashes['throttle_wait'].sum())}
+
+        print("\tThroughput: {0:.1f} files/s, {1:.2f} MB/s".format(self.stats['files'] / elapsed,
+                                                                   self.stats['bytes'] / elapsed / 1024 ** 2))
+        if self.max_bytes_per_second or self.max_files_per_second:
+            print("\tThrottle wait: {0:.2f} seconds".format(self.stats['throttle_wait']))
+
+    def sort_as_img_file_list(self, df_hashes):
+        """
+        Sort the hashes following img_file_list, whatever the order in which the images have been read.
+        :param df_hashes: a Pandas DataFrame with a 'position' column.
+        :return: the sorted Pandas DataFrame.
+        """
+        order = np.argsort(df_hashes['position'].to_numpy(dtype=np.int64), kind='stable')
+        return df_hashes.iloc[order].reset_index(drop=True)
 
-        # df_dataset's columns: 'file', 'hash', 'hash_list', '0', '1', '2', ..., 'N'
-        self.df_dataset = df_hashes.join(newcols)
-        return self.df_dataset, self.img_file_list
+    def append_to_checkpoint(self, result):
+        """
+        Append a batch of hashes to the checkpoint, the paths are resolved from img_file_list.
+        :param result: a dict of lists with 'position', 'hash', 'file_size' and metadata keys.
+        """
+        self.checkpoint.append(dict(result, file=[self.img_file_list[p] for p in result['position']]))
 
-    def build_hash_to_image_dataframe(self):
+    def build_hash_to_image_dataframe(self, batch_size=32, positions=None):
         """
         For each image calculate the phash and store it in a Pandas DataFrame.
 
+        :param batch_size: the number of images appended to the checkpoint at once.
+        :param positions: the positions in img_file_list of the images to hash, by default all the images in
+        scheduling order.
+
         :return: a Pandas DataFrame with columns:
-        - file(image's file path)
-        - hash(hash code associated to image),
-        - hash_list(list of all hash code's elements)
+        - position(position of the image in img_file_list)
+        - hash(hexadecimal hash code associated to image),
+        - file_size(size of the image's file in bytes)
+        - throttle_wait(time waited for the read rate limits in seconds)
+        - the metadata of image_metadata
         """
 
-        # df_hashes's columns: file, hash, hash_list
-        # file -> image's file path
-        # hash -> hash code associated to image
-        # hash_list -> list of all hash code's elements
-        df_hashes = pd.DataFrame()
+        if positions is None:
+            positions = self.schedule
+
+        columns = ['position', 'hash', 'file_size', 'throttle_wait'] + list(image_metadata)
+        hashes = {column: [] for column in columns}
         already_exist_counter = 0
-        # hash code -> image's file path
+        # hash code -> positions of the images
         dict_hash_to_images = {}
+        # number of results not yet appended to the checkpoint
+        pending = 0
 
         # For each image calculate the phash and store it in a DataFrame
-        for image in tqdm(self.img_file_list):
-
-            hash_code = self.img_hash(image, self.hash_size, self.hash_algo)
-
-            result = {'file': image, 'short_file': image.split(os.sep)[-1], 'hash': hash_code,
-                      'hash_list': list(str(hash_code))}
-            df_hashes = df_hashes.append(result, ignore_index=True)
+        for position in tqdm(positions):
+            position = int(position)
+            image = self.img_file_list[position]
+
+            try:
+                hash_code, file_size, throttle_wait, metadata = self.throttled_img_hash(image)
+            except Exception as e:
+                self.add_to_quarantine([(image, "{0}: {1}".format(type(e).__name__, e))])
+                continue
+
+            hash_code = str(hash_code)
+            for column, value in zip(columns, [position, hash_code, file_size, throttle_wait]):
+                hashes[column].append(value)
+            for name in image_metadata:
+                hashes[name].append(metadata[name])
+
+            if self.checkpoint is not None:
+                pending += 1
+                if pending == batch_size:
+                    self.append_to_checkpoint({column: values[-pending:] for column, values in hashes.items()})
+                    pending = 0
 
             if hash_code in dict_hash_to_images:
                 if self.verbose == 2:
-                    print(image, '  already exists as', ' '.join(dict_hash_to_images[hash_code]))
+                    print(image, '  already exists as',
+                          ' '.join(self.img_file_list[p] for p in dict_hash_to_images[hash_code]))
                 already_exist_counter += 1
 
-            dict_hash_to_images[hash_code] = dict_hash_to_images.get(hash_code, []) + [image]
+            dict_hash_to_images.setdefault(hash_code, []).append(position)
+
+        if pending > 0:
+            self.append_to_checkpoint({column: values[-pending:] for column, values in hashes.items()})
 
         # Are there any duplicates in terms of hashes of size 'hash_size'?
-        print("{0} out to {1}".format(already_exist_counter, len(self.img_file_list)))
+        print("{0} out to {1}".format(already_exist_counter, len(positions)))
         # TODO warning
         # assert already_exist_counter == 0, "it actually can only represent 16^" + str(self.hash_size) + \
         #                                  " values let's try with a bigger hash."
 
-        return df_hashes
+        return pd.DataFrame(hashes, columns=columns)
 
-    def multiprocessing_img_hash(self, block):
+    def throttled_img_hash(self, image):
         """
-        Hash a block of images.
-        :param block: a block containing the path of images.
-        :return: a dict containing the corresponding hashes.
+        Hash an image once the read rate limits of the process allow it.
+        :param image: A filename (string).
+        :return: the ImageHash, the size of the file in bytes, the time waited in seconds and the metadata of the
+        image, see image_metadata.
         """
+        stat = os.stat(image)
+        file_size = stat.st_size
+        throttle_wait = _rate_limiter.acquire(file_size)
+
+        # The alarm interrupts the decoding of the image in the worker, a worker stuck in native code is replaced
+        # by parallel_build_hash_to_image_dataframe().
+        alarm = self.image_timeout is not None and hasattr(signal, 'setitimer') and \
+            threading.current_thread() is threading.main_thread()
+        if alarm:
+            previous_handler = signal.signal(signal.SIGALRM, _on_image_timeout)
+            signal.setitimer(signal.ITIMER_REAL, self.image_timeout)
+        try:
+            if self.quality_score:
+                hash_code, metadata = self.img_hash(image, self.hash_size, self.hash_algo, quality_score=True)
+            else:
+                hash_code, metadata = self.img_hash(image, self.hash_size, self.hash_algo)
+        finally:
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, previous_handler)
 
-        result = {}
+        return hash_code, file_size, throttle_wait, dict(metadata, mtime=stat.st_mtime)
 
-        for image in block:
-            hash_code = self.img_hash(image, self.hash_size, self.hash_algo)
-            result['file'] = result.get('file', []) + [image]
-            result['short_file'] = result.get('short_file', []) + [image.split(os.sep)[-1]]
-            result['hash'] = result.get('hash', []) + [hash_code]
-            result['hash_list'] = result.get('hash_list', []) + [list(str(hash_code))]
+    def add_to_quarantine(self, failures):
+        """
+        Quarantine the images that can't be hashed.
+        :param failures: a list of (image's file path, reason).
+        """
+        self.quarantined.extend(failures)
+        if self.quarantine is not None:
+            self.quarantine.append(failures)
+
+    def multiprocessing_img_hash(self, block, batch_id=None):
+        """
+        Hash a block of images.
+        :param block: a block of (position of the image in img_file_list, path of the image).
+        :param batch_id: the id of the block, reported to the parent process with the pid of the worker.
+        :return: a dict containing the corresponding hashes, the images that can't be hashed are listed under the
+        'quarantined' key as (image's file path, reason).
+        """
+        if _started_batches is not None and batch_id is not None:
+            _started_batches.put((batch_id, os.getpid()))
+
+        result = {'position': [], 'hash': [], 'file_size': [], 'throttle_wait': [], 'quarantined': []}
+        result.update((name, []) for name in image_metadata)
+
+        for position, image in block:
+            try:
+                hash_code, file_size, throttle_wait, metadata = self.throttled_img_hash(image)
+            except Exception as e:
+                result['quarantined'].append((image, "{0}: {1}".format(type(e).__name__, e)))
+                continue
+            result['position'].append(position)
+            result['hash'].append(str(hash_code))
+            result['file_size'].append(file_size)
+            result['throttle_wait'].append(throttle_wait)
+            for name in image_metadata:
+                result[name].append(metadata[name])
 
         return result
 
-    def parallel_build_hash_to_image_dataframe(self, batch_size):
+    def parallel_build_hash_to_image_dataframe(self, batch_size, positions=None):
         """
         For each image calculate the phash and store it in a Pandas DataFrame.
 
-        :return: a Pandas DataFrame with columns:
-        - file(image's file path)
-        - hash(hash code associated to image),
-        - hash_list(list of all hash code's elements)
+        :param batch_size: the number of images hashed by each task of the pool.
+        :param positions: the positions in img_file_list of the images to hash, by default all the images in
+        scheduling order.
+
+        :return: a Pandas DataFrame with the columns of build_hash_to_image_dataframe().
         """
-        df_hashes = pd.DataFrame()
+        if positions is None:
+            positions = self.schedule
+
+        columns = ['position', 'hash', 'file_size', 'throttle_wait'] + list(image_metadata)
+        df_hashes_list = [pd.DataFrame(columns=columns)]
+
+        positions = [int(p) for p in positions]
+        batches = deque(positions[i:i + batch_size] for i in range(0, len(positions), batch_size))
+        # The batches running in the pool, as (batch id, batch, AsyncResult, deadline). There is at most one batch per
+        # worker, so a batch starts as soon as it's submitted and a batch still running after its deadline is stuck.
+        running = []
+        next_batch_id = 0
+        # batch id -> pid of the worker that runs it, reported by the workers through started_batches.
+        started_batches = multiprocessing.SimpleQueue()
+        worker_of = {}
+        # The pids of the workers of the pool, and (time, next batch id) when a worker was last found dead.
+        workers = set()
+        last_death = None
+        # The tasks of the dead workers are never done: the pool must be terminated, it can't be joined.
+        lost_tasks = False
+        # Set by the pool each time a batch is done.
+        batch_done = threading.Event()
+
+        def on_batch_done(_):
+            batch_done.set()
+
+        def collect(batch_result):
+            quarantined = batch_result.pop('quarantined')
+            if len(quarantined) > 0:
+                self.add_to_quarantine(quarantined)
+            if len(batch_result['position']) > 0:
+                # each batch is appended to the checkpoint as soon as it's done
+                if self.checkpoint is not None:
+                    self.append_to_checkpoint(batch_result)
+                df_hashes_list.append(pd.DataFrame(batch_result, columns=columns))
+
+        def retry(batch, reason):
+            # Submit the batch again, split in single images so only the offending image is quarantined.
+            if len(batch) > 1:
+                batches.extendleft([position] for position in reversed(batch))
+            else:
+                self.add_to_quarantine([(self.img_file_list[batch[0]], reason)])
+                pbar.update(1)
 
-        result_list = []
-        # initialise the pool outside the loop
-        pool = multiprocessing.Pool(processes=self.number_of_cpu)
+        pool = self.create_pool(started_batches)
+        workers = set(process.pid for process in multiprocessing.active_children())
         # For each image calculate the phash and store it in a DataFrame
         print("\tdelegate work...")
-        for i in tqdm(range(0, len(self.img_file_list), batch_size)):
-            # delegate work inside the loop
-            r = pool.apply_async(self.multiprocessing_img_hash, args=(self.img_file_list[i:i + batch_size],))
-            result_list.append(r)
+        with tqdm(total=len(positions)) as pbar:
+            while len(batches) > 0 or len(running) > 0:
+                # delegate work inside the loop, only the paths of the batch are sent to the worker
+                while len(batches) > 0 and len(running) < self.number_of_cpu:
+                    batch = batches.popleft()
+                    deadline = time.time() + self.image_timeout * len(batch) + WATCHDOG_GRACE_SECONDS \
+                        if self.image_timeout is not None else None
+                    block = [(p, self.img_file_list[p]) for p in batch]
+                    r = pool.apply_async(self.multiprocessing_img_hash, args=(block, next_batch_id),
+                                         callback=on_batch_done, error_callback=on_batch_done)
+                    running.append((next_batch_id, batch, r, deadline))
+                    next_batch_id += 1
+
+                # get the results
+                for task in [task for task in running if task[2].ready()]:
+                    running.remove(task)
+                    worker_of.pop(task[0], None)
+                    collect(task[2].get())
+                    pbar.update(len(task[1]))
+
+                # A worker killed while it hashes a batch (e.g. by the OOM killer or a crash in native code) is
+                # replaced by the pool, but its batch is lost: submit it again.
+                while not started_batches.empty():
+                    batch_id, pid = started_batches.get()
+                    worker_of[batch_id] = pid
+                alive = set(process.pid for process in multiprocessing.active_children())
+                for task in [task for task in running if task[0] in worker_of and worker_of[task[0]] not in alive]:
+                    if task[2].ready():
+                        continue
+                    running.remove(task)
+                    del worker_of[task[0]]
+                    lost_tasks = True
+                    retry(task[1], "Crash: the worker has died")
+                # A worker killed before it reported its batch: the other batches are reported by the live workers
+                # and the replacement worker within the grace period, the batches submitted before the death and
+                # still not reported after it are lost.
+                if len(workers - alive) > 0:
+                    last_death = (time.time(), next_batch_id)
+                workers = alive
+                if last_death is not None and time.time() > last_death[0] + WATCHDOG_GRACE_SECONDS:
+                    for task in [task for task in running if task[0] < last_death[1] and task[0] not in worker_of]:
+                        if task[2].ready():
+                            continue
+                        running.remove(task)
+                        lost_tasks = True
+                        retry(task[1], "Crash: the worker has died")
+                    last_death = None
+
+                deadlines = [task[3] for task in running if task[3] is not None]
+                if len(deadlines) > 0 and time.time() > min(deadlines):
+                    # A worker is stuck in native code: replace the pool. The finished batches are kept, the others
+                    # are submitted again and the expired batches are split in single images, so only the offending
+                    # images are quarantined.
+                    pool.terminate()
+                    pool.join()
+                    pool = self.create_pool(started_batches)
+                    workers = set(process.pid for process in multiprocessing.active_children())
+                    last_death = None
+                    for batch_id, batch, r, deadline in running:
+                        if r.ready() and r.successful():
+                            collect(r.get())
+                            pbar.update(len(batch))
+                        elif time.time() <= deadline:
+                            batches.appendleft(batch)
+                        else:
+                            retry(batch, "Timeout: the worker has been replaced")
+                    running = []
+                    worker_of = {}
+                elif len(running) > 0:
+                    timeout = min(deadlines) - time.time() if len(deadlines) > 0 else WATCHDOG_POLL_SECONDS
+                    batch_done.wait(max(0.0, min(timeout, WATCHDOG_POLL_SECONDS)))
+                    batch_done.clear()
 
         # shut down the pool
-        pool.close()
+        if lost_tasks:
+            pool.terminate()
+        else:
+            pool.close()
         pool.join()
 
-        # get the results
-        time.sleep(0.01)
-        print("\tget the results...")
-        with tqdm(total=len(result_list)) as pbar:
-            for i, sublist in enumerate(result_list):
-                row = sublist.get()
-                if i == 0:
-                    df_hashes = pd.DataFrame(row)
-                else:
-                    temp = pd.DataFrame(row)
-                    df_hashes = df_hashes.append(temp, ignore_index=True)
-                pbar.update(1)
+        return pd.concat(df_hashes_list, ignore_index=True, sort=False)
 
-        return df_hashes
+    def create_pool(self, started_batches=None):
+        """
+        Create the pool of processes that hash the images, the read rate limits are evenly split among the workers.
+        :param started_batches: a multiprocessing SimpleQueue where the workers report the batches they start.
+        :return: a multiprocessing Pool.
+        """
+        return multiprocessing.Pool(processes=self.number_of_cpu, initializer=ImageToHash.init_worker,
+                                    initargs=(self.max_bytes_per_second / self.number_of_cpu
+                                              if self.max_bytes_per_second else None,
+                                              self.max_files_per_second / self.number_of_cpu
+                                              if self.max_files_per_second else None,
+                                              self.worker_priority,
+                                              self.max_image_pixels,
+                                              self.max_worker_memory,
+                                              started_batches))
@@ -0,0 +1,233 @@
+import json
+import mmap
+import os
+from array import array
+
+import numpy as np
+
+
+class PathTable(object):
+    """
+    Compact, read-only list of file paths.
+
+    Each directory is stored once, the basenames are concatenated in a single bytes buffer:
+    - directories: the list of the distinct directories.
+    - directory_ids: a uint32 array, directories[directory_ids[i]] is the directory of the i-th path.
+    - names: the basenames encoded with os.fsencode(), one after the other.
+    - offsets: an int64 array of length N + 1, names[offsets[i]:offsets[i + 1]] is the basename of the i-th path.
+
+    The paths are rebuilt as Python strings only when they are accessed.
+    """
+
+    def __init__(self, directories, directory_ids, names, offsets):
+        self.directories = directories
+        self.directory_ids = directory_ids
+        self.names = names
+        self.offsets = offsets
+        # directory -> id, built on the first lookup
+        self._directory_index = None
+        # (sorted hashes of the paths, their positions), see build_index()
+        self._index = None
+
+        assert len(self.offsets) == len(self.directory_ids) + 1, \
+            "The offsets must have one element more than the directory ids."
+
+    @staticmethod
+    def from_paths(paths):
+        """
+        Build a PathTable.
+        :param paths: an iterable of file paths, it's consumed once.
+        :return: a PathTable.
+        """
+        if isinstance(paths, PathTable):
+            return paths
+
+        directories = []
+        directory_index = {}
+        directory_ids = array('I')
+        names = bytearray()
+        offsets = array('q', [0])
+
+        for path in paths:
+            directory, name = os.path.split(path)
+            directory_id = directory_index.get(directory)
+            if directory_id is None:
+                directory_id = directory_index[directory] = len(directories)
+                directories.append(directory)
+            directory_ids.append(directory_id)
+            names += os.fsencode(name)
+            offsets.append(len(names))
+
+        table = PathTable(directories, np.frombuffer(directory_ids, dtype=np.uint32).copy(), bytes(names),
+                          np.frombuffer(offsets, dtype=np.int64).copy())
+        table._directory_index = directory_index
+        return table
+
+    def __getstate__(self):
+        # The hashes of the index are salted differently in each process.
+        state = self.__dict__.copy()
+        state['_index'] = None
+        return state
+
+    def __len__(self):
+        return len(self.directory_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.path(j) for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("PathTable index out of range")
+        return self.path(i)
+
+    def __iter__(self):
+        for i in range(0, len(self)):
+            yield self.path(i)
+
+    def __eq__(self, other):
+        if isinstance(other, (PathTable, list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return "PathTable({0} paths, {1} directories)".format(len(self), len(self.directories))
+
+    def path(self, i):
+        return os.path.join(self.directories[self.directory_ids[i]], self.name(i))
+
+    def name(self, i):
+        """ The basename of the i-th path. """
+        return os.fsdecode(self.names[self.offsets[i]:self.offsets[i + 1]])
+
+    def directory(self, i):
+        return self.directories[self.directory_ids[i]]
+
+    def take(self, indices):
+        """
+        Select some paths, the directories are shared with this table.
+        :param indices: the positions of the paths.
+        :return: a PathTable.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        lengths = (self.offsets[1:] - self.offsets[:-1])[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        names = b''.join(self.names[self.offsets[i]:self.offsets[i + 1]] for i in indices)
+
+        table = PathTable(self.directories, self.directory_ids[indices], names, offsets)
+        table._directory_index = self._directory_index
+        return table
+
+    def groups(self, level=1):
+        """
+        Label the paths by their directory at a given depth below the common directory of all the paths, e.g. with
+        level=1 'potatoes_multi_folder/v1/a.png' and 'potatoes_multi_folder/v2/b.png' are in the groups 'v1' and
+        'v2'. The paths of the common directory itself form the group ''.
+        :param level: the number of directory levels of the label.
+        :return: an int64 array of the group of each path and the list of the names of the groups.
+        """
+        assert level >= 1, "The level must be greater than or equal to 1."
+        if len(self.directories) == 0:
+            return np.zeros(len(self), dtype=np.int64), []
+        root = os.path.commonpath([os.path.abspath(directory) for directory in self.directories])
+
+        names = []
+        name_index = {}
+        directory_groups = np.empty(len(self.directories), dtype=np.int64)
+        for directory_id, directory in enumerate(self.directories):
+            relative = os.path.relpath(os.path.abspath(directory), root)
+            parts = [] if relative == os.curdir else relative.split(os.sep)
+            name = os.path.join(*parts[:level]) if len(parts) > 0 else ''
+            if name not in name_index:
+                name_index[name] = len(names)
+                names.append(name)
+            directory_groups[directory_id] = name_index[name]
+
+        return directory_groups[self.directory_ids], names
+
+    def build_index(self):
+        """
+        Index the paths for index_of(): the hashes of the (directory id, basename) pairs are sorted, a lookup is a
+        binary search. The index takes 16 bytes per path, no Python string is kept.
+        """
+        if self._directory_index is None:
+            self._directory_index = {directory: i for i, directory in enumerate(self.directories)}
+
+        names = self.names
+        offsets = self.offsets.tolist()
+        keys = np.fromiter((hash((directory_id, names[offsets[i]:offsets[i + 1]]))
+                            for i, directory_id in enumerate(self.directory_ids.tolist())),
+                           dtype=np.int64, count=len(self))
+        order = np.argsort(keys, kind='stable')
+        self._index = (keys[order], order)
+
+    def index_of(self, path):
+        """
+        Retrieve the position of a path, the index is built on the first call.
+        :param path: a file path.
+        :return: the position of the first occurrence of the path or None if the path isn't in the table.
+        """
+        if self._index is None:
+            self.build_index()
+
+        directory, name = os.path.split(path)
+        directory_id = self._directory_index.get(directory)
+        if directory_id is None:
+            return None
+
+        name = os.fsencode(name)
+        keys, order = self._index
+        key = hash((directory_id, name))
+        # The candidates are in ascending order of position, the hashes can collide.
+        for i in order[np.searchsorted(keys, key, side='left'):np.searchsorted(keys, key, side='right')]:
+            if self.directory_ids[i] == directory_id and self.names[self.offsets[i]:self.offsets[i + 1]] == name:
+                return int(i)
+        return None
+
+    def nbytes(self):
+        """ The approximate memory used by the table, in bytes. """
+        return len(self.names) + self.offsets.nbytes + self.directory_ids.nbytes + \
+            sum(len(directory) for directory in self.directories)
+
+    def save(self, path, prefix='paths'):
+        """
+        Write the table into a directory:
+        - <prefix>_directories.json: the list of directories.
+        - <prefix>_directory_ids.npy, <prefix>_offsets.npy: the arrays.
+        - <prefix>_names.bin: the basenames buffer.
+        :param path: an existing directory.
+        :param prefix: the prefix of the file names.
+        """
+        with open(os.path.join(path, prefix + '_directories.json'), 'w') as f:
+            json.dump(self.directories, f)
+        np.save(os.path.join(path, prefix + '_directory_ids.npy'), self.directory_ids)
+        np.save(os.path.join(path, prefix + '_offsets.npy'), self.offsets)
+        with open(os.path.join(path, prefix + '_names.bin'), 'wb') as f:
+            f.write(self.names)
+
+    @staticmethod
+    def load(path, prefix='paths', mmap_mode='r'):
+        """
+        Read a table written by save(). The arrays and the basenames buffer are memory-mapped, so the processes that
+        open the same table share the page cache.
+        :param path: the directory.
+        :param prefix: the prefix of the file names.
+        :param mmap_mode: the mmap_mode of np.load(), None to read the table in memory.
+        :return: a PathTable.
+        """
+        with open(os.path.join(path, prefix + '_directories.json')) as f:
+            directories = json.load(f)
+        directory_ids = np.load(os.path.join(path, prefix + '_directory_ids.npy'), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, prefix + '_offsets.npy'), mmap_mode=mmap_mode)
+
+        names_path = os.path.join(path, prefix + '_names.bin')
+        if mmap_mode is None or os.path.getsize(names_path) == 0:
+            with open(names_path, 'rb') as f:
+                names = f.read()
+        else:
+            with open(names_path, 'rb') as f:
+                names = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return PathTable(directories, directory_ids, names, offsets)
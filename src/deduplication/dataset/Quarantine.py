@@ -0,0 +1,41 @@
+import os
+
+
+class Quarantine(object):
+    """
+    List of the images that can't be hashed (corrupt files, decompression bombs, decoding timeouts, ...).
+
+    The list is a tab separated file with the path of the image and the reason of the failure. The images in the
+    list are skipped by the next runs.
+    """
+
+    def __init__(self, quarantine_path):
+        self.quarantine_path = quarantine_path
+
+    def load(self):
+        """
+        Load the quarantined images.
+        :return: a dict image's file path -> reason.
+        """
+        quarantined = {}
+        if os.path.exists(self.quarantine_path):
+            with open(self.quarantine_path) as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        path, _, reason = line[:-1].partition('\t')
+                        quarantined[path] = reason
+        return quarantined
+
+    def append(self, failures):
+        """
+        Append images to the quarantine.
+        :param failures: a list of (image's file path, reason).
+        """
+        if len(failures) == 0:
+            return
+
+        with open(self.quarantine_path, 'a') as f:
+            for path, reason in failures:
+                f.write("{0}\t{1}\n".format(path, ' '.join(str(reason).split())))
+            f.flush()
+            os.fsync(f.fileno())
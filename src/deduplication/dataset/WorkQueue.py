@@ -0,0 +1,230 @@
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.dataset.PathTable import PathTable
+
+QUEUE_DB = 'queue.sqlite'
+SHARDS_DIR = 'shards'
+
+# States of a batch.
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+class WorkQueue(object):
+    """
+    Work queue of batches of images, shared by the hashing workers of several machines through a shared directory.
+
+    The queue is a SQLite database in queue_dir: a worker claims a batch with a lease, renews the lease while it
+    hashes the images and writes the hashes into a shard file of queue_dir/shards. A batch whose lease has expired
+    (e.g. its worker has been killed) is claimed again by another worker. merge() assembles the shards into a
+    HashDataset, in the order of the batches.
+
+    SQLite relies on the file locks of the filesystem: the shared filesystem must support them (e.g. NFSv4 with
+    locking enabled).
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.db_path = os.path.join(queue_dir, QUEUE_DB)
+        self.shards_dir = os.path.join(queue_dir, SHARDS_DIR)
+
+    def connect(self):
+        # Autocommit mode: the transactions are started explicitly with BEGIN IMMEDIATE.
+        return sqlite3.connect(self.db_path, timeout=120, isolation_level=None)
+
+    def create(self, file_list, batch_size=1024, hash_size=8, hash_algo='phash', images_path=None):
+        """
+        Create the queue.
+        :param file_list: the images to hash, in the order of the dataset.
+        :param batch_size: the number of images of each batch.
+        :param hash_size: the hash size used by every worker.
+        :param hash_algo: the hash algorithm used by every worker.
+        :param images_path: the directory of the images, for information only.
+        """
+        if os.path.exists(self.db_path):
+            raise ValueError("The queue {} already exists.".format(self.queue_dir))
+        os.makedirs(self.shards_dir, exist_ok=True)
+
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT)")
+            connection.execute("CREATE TABLE batches (id INTEGER PRIMARY KEY, paths TEXT, state TEXT, worker TEXT, "
+                               "lease_expires REAL, attempts INTEGER DEFAULT 0)")
+            connection.execute("CREATE TABLE quarantined (path TEXT, reason TEXT)")
+            connection.execute("CREATE INDEX batches_state ON batches (state, lease_expires)")
+            connection.executemany("INSERT INTO settings VALUES (?, ?)",
+                                   [('hash_size', json.dumps(hash_size)), ('hash_algo', json.dumps(hash_algo)),
+                                    ('images_path', json.dumps(images_path))])
+
+            batch = []
+            batch_id = 0
+            for path in file_list:
+                batch.append(path)
+                if len(batch) == batch_size:
+                    connection.execute("INSERT INTO batches (id, paths, state) VALUES (?, ?, ?)",
+                                       (batch_id, json.dumps(batch), PENDING))
+                    batch_id += 1
+                    batch = []
+            if len(batch) > 0:
+                connection.execute("INSERT INTO batches (id, paths, state) VALUES (?, ?, ?)",
+                                   (batch_id, json.dumps(batch), PENDING))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def settings(self):
+        """ The hash settings of the queue, as a dict. """
+        connection = self.connect()
+        try:
+            return {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM settings")}
+        finally:
+            connection.close()
+
+    def claim(self, worker, lease_seconds=600):
+        """
+        Claim a pending batch or a batch whose lease has expired.
+        :param worker: the id of the worker.
+        :param lease_seconds: the duration of the lease.
+        :return: (batch id, list of paths) or None if no batch can be claimed now.
+        """
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = connection.execute("SELECT id, paths FROM batches "
+                                     "WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                                     (PENDING, LEASED, now)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE batches SET state = ?, worker = ?, lease_expires = ?, "
+                                   "attempts = attempts + 1 WHERE id = ?", (LEASED, worker, now + lease_seconds,
+                                                                           row[0]))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def renew(self, batch_id, worker, lease_seconds=600):
+        """
+        Extend the lease of a batch.
+        :return: False if the batch isn't leased by the worker anymore.
+        """
+        connection = self.connect()
+        try:
+            cursor = connection.execute("UPDATE batches SET lease_expires = ? "
+                                        "WHERE id = ? AND state = ? AND worker = ?",
+                                        (time.time() + lease_seconds, batch_id, LEASED, worker))
+            return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+    def shard_path(self, batch_id):
+        return os.path.join(self.shards_dir, 'batch-{:08d}.npz'.format(batch_id))
+
+    def complete(self, batch_id, worker, hashes, index, file_sizes, quarantined=(), metadata=None):
+        """
+        Write the shard of a batch and mark it as done.
+        :param batch_id: the batch.
+        :param worker: the id of the worker.
+        :param hashes: the uint8 matrix of the hashes of the images that have been hashed, the shard stores two
+        digits per byte.
+        :param index: the positions of these images in the batch.
+        :param file_sizes: the sizes of their files.
+        :param quarantined: the images that can't be hashed, as (image's file path, reason).
+        :param metadata: the other metadata of these images, a dict name -> array.
+        :return: False if the lease has been lost, the shard is discarded.
+        """
+        shard_path = self.shard_path(batch_id)
+        tmp_path = '{0}.{1}.tmp.npz'.format(shard_path[:-len('.npz')], os.getpid())
+        np.savez(tmp_path, hashes=HashDataset.pack_digits(hashes), index=np.asarray(index, dtype=np.int64),
+                 file_size=np.asarray(file_sizes, dtype=np.int64),
+                 **{'metadata_' + name: np.asarray(values) for name, values in (metadata or {}).items()})
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT state, worker FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            owned = row is not None and row[0] == LEASED and row[1] == worker
+            if owned:
+                os.replace(tmp_path, shard_path)
+                connection.executemany("INSERT INTO quarantined VALUES (?, ?)", list(quarantined))
+                connection.execute("UPDATE batches SET state = ?, lease_expires = NULL WHERE id = ?", (DONE, batch_id))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return owned
+
+    def status(self):
+        """
+        Count the batches by state.
+        :return: a dict with 'pending', 'leased', 'expired' and 'done' keys.
+        """
+        connection = self.connect()
+        try:
+            now = time.time()
+            counts = {PENDING: 0, LEASED: 0, 'expired': 0, DONE: 0}
+            for state, expired, count in connection.execute(
+                    "SELECT state, lease_expires < ?, COUNT(*) FROM batches GROUP BY state, lease_expires < ?",
+                    (now, now)):
+                counts['expired' if state == LEASED and expired else state] += count
+            return counts
+        finally:
+            connection.close()
+
+    def merge(self, allow_partial=False):
+        """
+        Assemble the shards into a HashDataset, in the order of the batches.
+        :param allow_partial: skip the batches that aren't done instead of raising a ValueError.
+        :return: a HashDataset and the list of the quarantined images as (image's file path, reason).
+        """
+        settings = self.settings()
+        status = self.status()
+        if not allow_partial and status[DONE] < sum(status.values()):
+            raise ValueError("{0} batches of {1} aren't done yet: {2}".format(sum(status.values()) - status[DONE],
+                                                                              self.queue_dir, status))
+
+        hash_length = -(-settings['hash_size'] ** 2 // 4)
+        hashes = []
+        file_sizes = []
+        # name -> the arrays of the shards
+        metadata = {}
+        connection = self.connect()
+        try:
+            def files():
+                for batch_id, paths in connection.execute("SELECT id, paths FROM batches WHERE state = ? ORDER BY id",
+                                                          (DONE,)):
+                    with np.load(self.shard_path(batch_id)) as shard:
+                        hashes.append(HashDataset.unpack_digits(shard['hashes'], hash_length))
+                        file_sizes.append(shard['file_size'])
+                        for key in shard.files:
+                            if key.startswith('metadata_'):
+                                metadata.setdefault(key[len('metadata_'):], []).append(shard[key])
+                        index = shard['index']
+                    paths = json.loads(paths)
+                    for i in index:
+                        yield paths[i]
+
+            file_list = PathTable.from_paths(files())
+            quarantined = [tuple(row) for row in connection.execute("SELECT path, reason FROM quarantined")]
+        finally:
+            connection.close()
+
+        # The metadata missing from some shards, e.g. written by a previous version of the workers, are dropped.
+        metadata = {name: np.concatenate(arrays) for name, arrays in metadata.items() if len(arrays) == len(hashes)}
+        metadata['file_size'] = np.concatenate(file_sizes) if len(file_sizes) > 0 else np.zeros(0, dtype=np.int64)
+        dataset = HashDataset(np.concatenate(hashes) if len(hashes) > 0 else np.zeros((0, hash_length)), file_list,
+                              metadata=metadata, hash_size=settings['hash_size'], hash_algo=settings['hash_algo'])
+        return dataset, quarantined
@@ -0,0 +1,100 @@
+import numpy as np
+from tqdm import tqdm
+
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.duplicatefinder.ShardedFinder import ShardedFinder, _build_shard
+from deduplication.duplicatefinder.cKDTreeFinder import cKDTreeFinder
+
+
+class CollectionJoin(object):
+    """
+    Near duplicates between two collections of images, e.g. the new images A and the archive B.
+
+    Only the larger collection is indexed by a tree, the smaller one is streamed through it batch by batch: the two
+    collections are never concatenated and the images of A aren't compared with each other unless self_pairs() is
+    asked.
+    """
+
+    def __init__(self, tree_type='KDTree', distance_metric='manhattan', leaf_size=40, batch_size=1024):
+        valid_metrics = cKDTreeFinder.valid_metrics if tree_type == 'cKDTree' else KDTreeFinder.valid_metrics
+        assert tree_type in ['KDTree', 'cKDTree'], "{} isn't a valid tree type.".format(tree_type)
+        assert distance_metric in valid_metrics, "{0} isn't a valid metric for {1}.".format(distance_metric,
+                                                                                            tree_type)
+        self.tree_type = tree_type
+        self.distance_metric = distance_metric
+        self.leaf_size = leaf_size
+        self.batch_size = batch_size
+
+    @staticmethod
+    def check_compatible(dataset_a, dataset_b):
+        """ The hashes of the two collections can only be compared if they have been computed the same way. """
+        settings_a = (dataset_a.hash_algo, dataset_a.hash_size, dataset_a.hash_length)
+        settings_b = (dataset_b.hash_algo, dataset_b.hash_size, dataset_b.hash_length)
+        if len(dataset_a) > 0 and len(dataset_b) > 0 and settings_a != settings_b:
+            raise ValueError("The collections have been hashed with different settings (algorithm, hash size, "
+                             "digits): {0} and {1}.".format(settings_a, settings_b))
+
+    def build_index(self, dataset):
+        print('Building the {0} of {1} images...'.format(self.tree_type, len(dataset)))
+        return _build_shard((self.tree_type, dataset.hashes, self.distance_metric, self.leaf_size))
+
+    def query(self, tree, size, hashes, threshold, after_only=False):
+        """
+        Stream some hashes through a tree, batch by batch.
+        :param tree: the tree built by build_index().
+        :param size: the number of images of the tree.
+        :param hashes: the hashes to look up.
+        :param threshold: the maximum distance.
+        :param after_only: keep only the neighbors with a greater position, when hashes are the ones of the tree.
+        :return: a generator of (row of hashes, positions in the tree, distances), sorted by distance and position,
+        for the rows that have neighbors within the threshold.
+        """
+        with tqdm(total=len(hashes)) as pbar:
+            for start in range(0, len(hashes), self.batch_size):
+                batch = np.asarray(hashes[start:start + self.batch_size])
+                results = ShardedFinder.query_radius_shards([tree], [0, size], self.tree_type, self.distance_metric,
+                                                            batch, threshold)
+                for row, (distances, ids) in enumerate(results, start=start):
+                    if after_only:
+                        distances, ids = distances[ids > row], ids[ids > row]
+                    if len(ids) > 0:
+                        yield row, ids, distances
+                pbar.update(len(batch))
+
+    def join(self, df_dataset_a, df_dataset_b, threshold):
+        """
+        Find the pairs of near duplicates between the two collections.
+        :param df_dataset_a: the first collection, e.g. a saved dataset.
+        :param df_dataset_b: the second collection.
+        :param threshold: the maximum distance.
+        :return: a generator of (position in A, position in B, distance).
+        """
+        dataset_a = HashDataset.wrap(df_dataset_a)
+        dataset_b = HashDataset.wrap(df_dataset_b)
+        CollectionJoin.check_compatible(dataset_a, dataset_b)
+        if len(dataset_a) == 0 or len(dataset_b) == 0:
+            return
+
+        # The larger collection is indexed, the smaller one is streamed.
+        swapped = len(dataset_a) > len(dataset_b)
+        indexed, streamed = (dataset_a, dataset_b) if swapped else (dataset_b, dataset_a)
+        tree = self.build_index(indexed)
+        print('Joining {0} images with {1} images...'.format(len(streamed), len(indexed)))
+        for row, ids, distances in self.query(tree, len(indexed), streamed.hashes, threshold):
+            for i, distance in zip(ids, distances):
+                yield (int(i), row, distance) if swapped else (row, int(i), distance)
+
+    def self_pairs(self, df_dataset, threshold):
+        """
+        Find the pairs of near duplicates within a collection.
+        :return: a generator of (position, greater position, distance).
+        """
+        dataset = HashDataset.wrap(df_dataset)
+        if len(dataset) == 0:
+            return
+        tree = self.build_index(dataset)
+        print('Joining {} images with themselves...'.format(len(dataset)))
+        for row, ids, distances in self.query(tree, len(dataset), dataset.hashes, threshold, after_only=True):
+            for i, distance in zip(ids, distances):
+                yield row, int(i), distance
@@ -0,0 +1,297 @@
+import heapq
+import os
+import shutil
+import tempfile
+import time
+from array import array
+
+import numpy as np
+from scipy.spatial.distance import cdist
+from tqdm import tqdm
+
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+
+# Distance metrics of the tree finders -> metric of scipy.spatial.distance.cdist.
+cdist_metrics = {'euclidean': 'euclidean', 'l2': 'euclidean', 'minkowski': 'euclidean', 'p': 'euclidean',
+                 'manhattan': 'cityblock', 'cityblock': 'cityblock', 'l1': 'cityblock', 'chebyshev': 'chebyshev',
+                 'infinity': 'chebyshev'}
+
+# Approximate size in bytes of a record once converted to a Python tuple during the merge, per 64-bit word.
+MERGE_BYTES_PER_WORD = 48
+
+# Bytes per record of a run besides the records: the int64 sort permutation and the two uint64 columns of pack().
+RUN_BYTES_PER_ROW = 8 + 2 * 8
+
+
+class ExternalSortFinder(NearDuplicateImageFinder):
+    """
+    Out-of-core finder for collections larger than RAM.
+
+    build_tree() reads the hashes chunk by chunk and spills sorted runs of (packed hash, image id) records to disk,
+    find_all_near_duplicates() merges the runs and streams the groups of images whose hashes are identical or share
+    their first prefix_length hexadecimal digits. Only the records of the current chunk, a block of each run, the
+    ids of the current group and a tile of its distances are held in memory, the total is bounded by memory_budget.
+
+    With prefix_length=None the groups are the exact duplicates. Otherwise each group is a candidate set: its near
+    duplicates are found with the distance metric and the threshold, the near duplicates whose hashes differ in the
+    prefix aren't found.
+    """
+
+    def __init__(self, df_dataset, distance_metric='manhattan', memory_budget=256 * 1024 ** 2, prefix_length=None,
+                 tmp_dir=None, verbose=0):
+        assert distance_metric in cdist_metrics, "{} isn't a valid metric.".format(distance_metric)
+        self.distance_metric = distance_metric
+        self.memory_budget = memory_budget
+        self.prefix_length = prefix_length
+        self.tmp_dir = tmp_dir
+        self.runs = []
+        self.runs_dir = None
+        super().__init__(df_dataset, parallel=False, verbose=verbose)
+
+        if self.prefix_length is not None and not 0 < self.prefix_length <= self.dataset.hash_length:
+            raise ValueError("The prefix length must be between 1 and {}.".format(self.dataset.hash_length))
+
+    @property
+    def words(self):
+        """ The number of 64-bit words of a packed hash. """
+        return (self.dataset.hash_length + 15) // 16
+
+    @property
+    def record_dtype(self):
+        return np.dtype([('w{}'.format(w), '<u8') for w in range(0, self.words)] + [('id', '<u8')])
+
+    def pack(self, digits):
+        """
+        Pack a matrix of hexadecimal digits into 64-bit words, the first digit in the most significant bits, so the
+        order of the words is the lexicographic order of the hashes. The digits are packed one column at a time, the
+        only temporaries are two uint64 columns.
+        :param digits: a uint8 matrix N x L.
+        :return: an array of record_dtype, the ids aren't set.
+        """
+        records = np.zeros(digits.shape[0], dtype=self.record_dtype)
+        for digit in range(0, digits.shape[1]):
+            records['w{}'.format(digit // 16)] |= \
+                np.asarray(digits[:, digit], dtype=np.uint64) << np.uint64(60 - 4 * (digit % 16))
+        return records
+
+    def prefix_mask(self):
+        """ The masks of the words that keep the first prefix_length digits. """
+        mask = np.zeros(self.words, dtype=np.uint64)
+        for digit in range(0, self.prefix_length if self.prefix_length is not None else self.dataset.hash_length):
+            mask[digit // 16] |= np.uint64(0xF) << np.uint64(60 - 4 * (digit % 16))
+        return mask
+
+    def build_tree(self):
+        print('Spilling the sorted runs...')
+        record_dtype = self.record_dtype
+        # The records of the chunk, their sort permutation and the sorted copy are in memory at the same time, the
+        # two uint64 columns of pack() before them.
+        run_rows = max(1, self.memory_budget // (2 * record_dtype.itemsize + RUN_BYTES_PER_ROW))
+
+        self.runs_dir = tempfile.mkdtemp(prefix='deduplication-runs-', dir=self.tmp_dir)
+        self.runs = []
+        for start in tqdm(range(0, len(self.dataset), run_rows)):
+            end = min(start + run_rows, len(self.dataset))
+            records = self.pack(self.dataset.hashes[start:end])
+            records['id'] = np.arange(start, end, dtype=np.uint64)
+            # np.lexsort sorts by the last key first.
+            order = np.lexsort([records['id']] + [records['w{}'.format(w)] for w in reversed(range(0, self.words))])
+
+            run_path = os.path.join(self.runs_dir, 'run-{}.npy'.format(len(self.runs)))
+            np.save(run_path, records[order])
+            self.runs.append(run_path)
+
+        print("\t{0} runs of at most {1} records".format(len(self.runs), run_rows))
+
+    def records(self):
+        """
+        Merge the runs.
+        :return: a generator of the records (word 0, ..., word W-1, image id) sorted by hash and image id.
+        """
+        # A block of each run is converted to Python tuples at the same time.
+        block_rows = max(1, self.memory_budget // (MERGE_BYTES_PER_WORD * (self.words + 1) * max(1, len(self.runs))))
+
+        def read_run(run_path):
+            run = np.load(run_path, mmap_mode='r')
+            for start in range(0, len(run), block_rows):
+                for record in np.array(run[start:start + block_rows]).tolist():
+                    yield record
+
+        if len(self.runs) == 1:
+            return read_run(self.runs[0])
+        return heapq.merge(*[read_run(run_path) for run_path in self.runs])
+
+    def groups(self, min_group_size=2):
+        """
+        Stream the groups of images whose hashes share the first prefix_length digits (all the digits by default).
+        :param min_group_size: the smaller groups are skipped.
+        :return: a generator of numpy arrays of image ids, sorted in ascending order.
+        """
+        mask = [int(m) for m in self.prefix_mask()]
+        group_key = None
+        group = []
+        for record in self.records():
+            key = tuple(word & m for word, m in zip(record[:-1], mask))
+            if key != group_key:
+                if len(group) >= min_group_size:
+                    yield np.sort(np.asarray(group, dtype=np.int64))
+                group_key = key
+                group = []
+            group.append(record[-1])
+        if len(group) >= min_group_size:
+            yield np.sort(np.asarray(group, dtype=np.int64))
+
+    def tile_size(self):
+        """
+        The side of the square tiles of distances computed at once: the float64 distances, the boolean mask of the
+        pairs within the threshold and the float64 copies of the hashes of the tile fit the memory budget.
+        """
+        return max(1, int(np.sqrt(self.memory_budget / (9 + 16 * self.dataset.hash_length))))
+
+    def near_duplicates_in_group(self, group, threshold):
+        """
+        Compare the images of a group tile by tile.
+        :param group: the ids of the images, in the order of the visit: ascending, or the keep order.
+        :param threshold: the maximum distance.
+        :return: a generator of (image id, ids of its near duplicates after it in the group), in the order of the
+        group. Only the images that have near duplicates are generated.
+        """
+        metric = cdist_metrics[self.distance_metric]
+        tile = self.tile_size()
+        for start in range(0, len(group) - 1, tile):
+            end = min(start + tile, len(group))
+            rows = self.dataset.hashes[group[start:end]]
+            neighbors = [[] for _ in range(start, end)]
+            # Only the images after the first image of the rows.
+            for column in range(start, len(group), tile):
+                columns = group[column:min(column + tile, len(group))]
+                i, j = np.nonzero(cdist(rows, self.dataset.hashes[columns], metric=metric) <= threshold)
+                after = column + j > start + i
+                for row, neighbor in zip(i[after].tolist(), columns[j[after]].tolist()):
+                    neighbors[row].append(neighbor)
+            for row, duplicates in enumerate(neighbors):
+                if len(duplicates) > 0:
+                    yield int(group[start + row]), duplicates
+
+    def nearest_in(self, rows, ids, nearest_neighbors):
+        """
+        The nearest neighbors of some images among other images, tile by tile.
+        :param rows: the ids of the queried images.
+        :param ids: the ids of the candidates, sorted in ascending order.
+        :param nearest_neighbors: the number of neighbors.
+        :return: the distances and the ids of the nearest neighbors of each queried image, sorted by distance and id.
+        """
+        metric = cdist_metrics[self.distance_metric]
+        tile = self.tile_size()
+        hashes = self.dataset.hashes[rows]
+        distances = np.zeros((len(rows), 0))
+        indices = np.zeros((len(rows), 0), dtype=np.int64)
+        for column in range(0, len(ids), tile):
+            columns = ids[column:column + tile]
+            distances = np.concatenate([distances, cdist(hashes, self.dataset.hashes[columns], metric=metric)], axis=1)
+            indices = np.concatenate([indices, np.broadcast_to(columns, (len(rows), len(columns)))], axis=1)
+            order = np.lexsort((indices, distances), axis=-1)[:, :nearest_neighbors]
+            distances = np.take_along_axis(distances, order, axis=1)
+            indices = np.take_along_axis(indices, order, axis=1)
+        return distances, indices
+
+    def _find(self, image_id, nearest_neighbors=5, threshold=10):
+        # Every image is a candidate, not only the group of the image.
+        return self.nearest_in(np.asarray([image_id]), np.arange(0, len(self.dataset)), nearest_neighbors)
+
+    def _find_all(self, nearest_neighbors=5, threshold=10):
+        """
+        The nearest neighbors of each image within its group, see the class documentation. The missing neighbors have
+        an infinite distance and the id len(dataset), as with ShardedFinder.
+        """
+        distances = np.full((len(self.dataset), nearest_neighbors), np.inf)
+        indices = np.full((len(self.dataset), nearest_neighbors), len(self.dataset), dtype=np.int64)
+        distances[:, 0] = 0
+        indices[:, 0] = np.arange(0, len(self.dataset))
+        tile = self.tile_size()
+        for group in self.groups():
+            for start in range(0, len(group), tile):
+                rows = group[start:start + tile]
+                group_distances, group_indices = self.nearest_in(rows, group, nearest_neighbors)
+                # The image itself first, even if other images have the same hash.
+                for row, image in enumerate(rows):
+                    others = group_indices[row] != image
+                    neighbors = min(nearest_neighbors - 1, int(others.sum()))
+                    indices[image, 1:neighbors + 1] = group_indices[row][others][:neighbors]
+                    distances[image, 1:neighbors + 1] = group_distances[row][others][:neighbors]
+        return distances, indices
+
+    def find_all_near_duplicates(self, nearest_neighbors=5, threshold=10):
+        """Find all duplicate and/or near duplicated images, one group at a time.
+
+        The groups are disjoint, so the images to keep and to remove are chosen group by group while the runs are
+        merged: neither the pairs of near duplicates nor the distances of a whole group are held in memory.
+
+        Parameters
+        ----------
+        nearest_neighbors
+            Unused, every pair of images of a group is compared.
+        threshold
+
+        Returns
+        -------
+        The same results of NearDuplicateImageFinder.find_all_near_duplicates(), except that the dict maps each image
+        to keep to the near duplicates removed because of it.
+        """
+        print('Finding duplicates and/or near duplicates out of core...')
+        start_time = time.time()
+
+        keep = array('q')
+        remove = array('q')
+        dict_image_to_duplicates = {}
+        number_of_groups = 0
+        try:
+            for group in self.groups():
+                number_of_groups += 1
+                if self.keep_ranks is not None:
+                    # The images are visited in the keep order.
+                    group = group[np.argsort(self.keep_ranks[group], kind='stable')]
+                if self.prefix_length is None:
+                    # Identical hashes: the first image of the group is near duplicate of the others.
+                    near_duplicates = [(int(group[0]), group[1:].tolist())]
+                else:
+                    near_duplicates = self.near_duplicates_in_group(group, threshold)
+
+                group_keep = []
+                group_remove = []
+                # The removed images of the current group, the other groups can't have pairs with them.
+                removed = set()
+                for image, duplicates in near_duplicates:
+                    new_elements = NearDuplicateImageFinder.select_duplicate(image, duplicates, group_keep,
+                                                                             group_remove, removed,
+                                                                             self.group_writer)
+                    if image not in removed and len(new_elements) > 0:
+                        dict_image_to_duplicates.setdefault(image, []).extend(new_elements)
+                keep.extend(group_keep)
+                remove.extend(group_remove)
+                if self.group_writer is not None:
+                    # The groups of candidates are disjoint, the group is complete.
+                    for image in group.tolist():
+                        self.group_writer.forget(image)
+        finally:
+            self.close()
+        print("\t {} groups of candidates".format(number_of_groups))
+
+        files_to_remove = self.dataset.files_at(np.frombuffer(remove, dtype=np.int64))
+        print("\t number of files to remove: {}".format(len(files_to_remove)))
+
+        files_to_keep = self.dataset.files_at(np.sort(np.frombuffer(keep, dtype=np.int64)))
+        print("\t number of files to keep: {}".format(len(files_to_keep)))
+
+        end_time = time.time()
+        print("{0} duplicates or near duplicates has been founded in {1} seconds".format(len(files_to_remove),
+                                                                                         end_time - start_time))
+
+        return files_to_keep, files_to_remove, dict_image_to_duplicates
+
+    def close(self):
+        """ Remove the runs from the disk. """
+        if self.runs_dir is not None:
+            shutil.rmtree(self.runs_dir, ignore_errors=True)
+            self.runs_dir = None
+            self.runs = []
@@ -0,0 +1,138 @@
+import csv
+import json
+from array import array
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from deduplication.duplicatefinder.ExternalSortFinder import cdist_metrics
+from deduplication.utils.ArrowUtils import ArrowUtils, BatchWriter, BATCH_ROWS, pa
+
+# The formats of the stream, parquet and arrow require pyarrow.
+group_formats = ['jsonl', 'csv', 'parquet', 'arrow']
+
+
+class GroupWriter(object):
+    """
+    Stream of the groups of near duplicates, written while the finders select the images to keep.
+
+    A group is an image kept and the images removed in its place, including the images removed because of an image
+    of the group that was itself removed. Each time the selection removes images, a row is appended and flushed:
+    - jsonl: {"group": id, "keep": path, "remove": [paths], "distances": [distances to the image kept]}.
+    - csv: the columns group, keep, remove and distance, one row for each image removed.
+    - parquet and arrow: the same rows as csv, the paths split into <column>_directory and <column>_name, see
+    ArrowUtils. The rows are written in record batches of BATCH_ROWS rows and the file can only be read once closed.
+    The rows of a group can be interleaved with the rows of other groups, every row is final once written, so the
+    jsonl and csv streams can be read while the run is going on.
+
+    With path None nothing is written: the writer only tracks the image kept in place of each image removed, e.g. for
+    the targets of the links, see kept_in_place.
+    """
+
+    def __init__(self, path, dataset, distance_metric='manhattan', output_format='jsonl', keep_targets=False):
+        assert output_format in group_formats, "{} isn't a valid format.".format(output_format)
+        assert distance_metric in cdist_metrics, "{} isn't a valid metric.".format(distance_metric)
+        self.path = path
+        self.dataset = dataset
+        self.metric = cdist_metrics[distance_metric]
+        self.output_format = output_format
+        # image -> the image kept in its place, see forget().
+        self.owners = {}
+        # With keep_targets, image removed -> the image kept in its place, never forgotten.
+        self.kept_in_place = {} if keep_targets else None
+        # image kept -> group id
+        self.group_ids = {}
+        self.file = None
+        self.writer = None
+        self.rows = 0
+        # The rows of the next record batch of the columnar formats: group, image kept, image removed, distance.
+        self.batch = (array('q'), array('q'), array('q'), array('d'))
+        self.names_type = None
+
+    def __enter__(self):
+        if self.path is None:
+            return self
+        if self.output_format in ['parquet', 'arrow']:
+            self.names_type = ArrowUtils.names_type(self.dataset.files)
+            schema = pa.schema([pa.field('group', pa.int64())] +
+                               ArrowUtils.paths_fields(self.dataset.files, 'keep_', self.names_type) +
+                               ArrowUtils.paths_fields(self.dataset.files, 'remove_', self.names_type) +
+                               [pa.field('distance', pa.float64())])
+            self.writer = BatchWriter(self.path, schema, self.output_format).__enter__()
+            return self
+        self.file = open(self.path, 'w', newline='')
+        if self.output_format == 'csv':
+            self.writer = csv.writer(self.file, lineterminator='\n')
+            self.writer.writerow(['group', 'keep', 'remove', 'distance'])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.path is None:
+            return
+        if self.file is None:
+            self.flush_batch()
+            self.writer.__exit__(exc_type, exc_value, traceback)
+        else:
+            self.file.close()
+
+    def flush_batch(self):
+        """ Write the rows of the columnar formats buffered so far as a record batch. """
+        groups, keeps, removes, distances = (np.frombuffer(values, dtype=values.typecode) for values in self.batch)
+        if len(groups) == 0:
+            return
+        columns = {'group': pa.array(groups)}
+        columns.update(ArrowUtils.paths_columns(self.dataset.files, keeps, 'keep_', self.names_type))
+        columns.update(ArrowUtils.paths_columns(self.dataset.files, removes, 'remove_', self.names_type))
+        columns['distance'] = pa.array(distances)
+        self.writer.write_columns(columns)
+        self.batch = (array('q'), array('q'), array('q'), array('d'))
+
+    def owner(self, image):
+        """ The image kept in place of a removed image. """
+        return self.owners[image]
+
+    def write(self, kept, images):
+        """
+        Append images to the group of an image kept.
+        :param kept: the id of the image kept.
+        :param images: the ids of the images removed in its place.
+        """
+        self.owners[kept] = kept
+        if len(images) == 0:
+            return
+        group = self.group_ids.setdefault(kept, len(self.group_ids))
+        for image in images:
+            self.owners[image] = kept
+        if self.kept_in_place is not None:
+            self.kept_in_place.update(dict.fromkeys(images, kept))
+        if self.path is None:
+            return
+
+        distances = cdist(self.dataset.hashes[[kept]].astype(np.float64),
+                          self.dataset.hashes[list(images)].astype(np.float64), metric=self.metric)[0]
+        if self.file is None:
+            groups, keeps, removes, batch_distances = self.batch
+            groups.extend([group] * len(images))
+            keeps.extend([kept] * len(images))
+            removes.extend(images)
+            batch_distances.extend(distances)
+            if len(groups) >= BATCH_ROWS:
+                self.flush_batch()
+            self.rows += 1
+            return
+
+        keep_file = self.dataset.file(kept)
+        remove_files = [self.dataset.file(image) for image in images]
+        if self.output_format == 'jsonl':
+            self.file.write(json.dumps({'group': group, 'keep': keep_file, 'remove': remove_files,
+                                        'distances': distances.tolist()}) + '\n')
+        else:
+            self.writer.writerows([group, keep_file, remove_file, distance]
+                                  for remove_file, distance in zip(remove_files, distances.tolist()))
+        # Every row is final, the readers of the stream see it at once.
+        self.file.flush()
+        self.rows += 1
+
+    def forget(self, image):
+        """ Release an image that can't be part of a later row, e.g. when it leaves the window of the finder. """
+        self.owners.pop(image, None)
@@ -0,0 +1,89 @@
+import numpy as np
+from tqdm import tqdm
+
+from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+from deduplication.duplicatefinder.ShardedFinder import ShardedFinder, _build_shard
+from deduplication.duplicatefinder.cKDTreeFinder import cKDTreeFinder
+
+
+class GroupedFinder(NearDuplicateImageFinder):
+    """
+    Finder of the near duplicates across groups of images only, e.g. across the version folders v1, v2, ... of a
+    collection: the pairs of images of the same group are never compared.
+
+    The group of an image is its directory at group_level below the common directory of the dataset, see
+    PathTable.groups(). A tree is built for each group and queried by the images of the other groups, so the work
+    saved is the share of the pairs within the groups.
+    """
+
+    def __init__(self, df_dataset, tree_type='KDTree', distance_metric='manhattan', leaf_size=40, batch_size=32,
+                 verbose=0, group_level=1):
+        valid_metrics = cKDTreeFinder.valid_metrics if tree_type == 'cKDTree' else KDTreeFinder.valid_metrics
+        assert tree_type in ['KDTree', 'cKDTree'], "{} isn't a valid tree type.".format(tree_type)
+        assert distance_metric in valid_metrics, "{0} isn't a valid metric for {1}.".format(distance_metric,
+                                                                                            tree_type)
+        self.tree_type = tree_type
+        self.distance_metric = distance_metric
+        self.group_level = group_level
+        self.groups = None
+        self.group_names = None
+        # (positions of the images of the group, tree of their hashes) for each group.
+        self.group_trees = []
+        super().__init__(df_dataset, leaf_size, parallel=False, batch_size=batch_size, verbose=verbose)
+
+    def build_tree(self):
+        self.groups, self.group_names = self.dataset.files.groups(self.group_level)
+        print('Building {0} {1}s, one for each group: {2}'.format(len(self.group_names), self.tree_type,
+                                                                  ', '.join(self.group_names)))
+        self.group_trees = []
+        for group in range(0, len(self.group_names)):
+            ids = np.flatnonzero(self.groups == group)
+            # A subset of a dataset may not have any image in some of its directories.
+            tree = _build_shard((self.tree_type, self.dataset.hashes[ids], self.distance_metric, self.leaf_size)) \
+                if len(ids) > 0 else None
+            self.group_trees.append((ids, tree))
+
+    def query_other_groups(self, rows, k, threshold):
+        """
+        The k nearest neighbors of some images among the images of the other groups.
+        :param rows: the positions of the images.
+        :return: the distances and the ids of the neighbors, sorted by distance and id. The missing neighbors have
+        an infinite distance and the id len(dataset).
+        """
+        distances = np.full((len(rows), k), np.inf)
+        indices = np.full((len(rows), k), len(self.dataset), dtype=np.int64)
+        for group, (ids, tree) in enumerate(self.group_trees):
+            others = np.flatnonzero(self.groups[rows] != group)
+            if len(others) == 0 or k == 0 or tree is None:
+                continue
+            group_distances, group_indices = ShardedFinder.query_shards(
+                [tree], [0, len(ids)], self.tree_type, self.distance_metric, self.dataset.hashes[rows[others]], k,
+                threshold)
+            group_indices = np.where(group_indices < len(ids), ids[np.minimum(group_indices, len(ids) - 1)],
+                                     len(self.dataset))
+            merged_distances = np.concatenate([distances[others], group_distances], axis=1)
+            merged_indices = np.concatenate([indices[others], group_indices], axis=1)
+            order = np.lexsort((merged_indices, merged_distances), axis=-1)[:, :k]
+            distances[others] = np.take_along_axis(merged_distances, order, axis=1)
+            indices[others] = np.take_along_axis(merged_indices, order, axis=1)
+        return distances, indices
+
+    def _find_all(self, nearest_neighbors=5, threshold=10):
+        # As with the other finders the first neighbor of an image is the image itself, the others come from the
+        # other groups.
+        rows = np.arange(0, len(self.dataset))
+        distances = np.zeros((len(rows), nearest_neighbors))
+        indices = np.zeros((len(rows), nearest_neighbors), dtype=np.int64)
+        indices[:, 0] = rows
+        with tqdm(total=len(rows)) as pbar:
+            for start in range(0, len(rows), self.batch_size):
+                batch = rows[start:start + self.batch_size]
+                distances[batch, 1:], indices[batch, 1:] = self.query_other_groups(batch, nearest_neighbors - 1,
+                                                                                   threshold)
+                pbar.update(len(batch))
+        return distances, indices
+
+    def _find(self, image_id, nearest_neighbors=5, threshold=10):
+        distances, indices = self.query_other_groups(np.array([image_id]), nearest_neighbors, threshold)
+        return distances, indices
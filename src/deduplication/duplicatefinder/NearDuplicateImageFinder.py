@@ -1,12 +1,13 @@
-import multiprocessing
 import os
-import sys
 import time
+import warnings
 
 import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
 
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.utils.CpuUtils import CpuUtils
 from deduplication.utils.ImgUtils import ImgUtils
 
 """
@@ -16,37 +17,39 @@ from deduplication.utils.ImgUtils import ImgUtils
 
 class NearDuplicateImageFinder(object):
 
-    def __init__(self, df_dataset, leaf_size=40, parallel=False, batch_size=32, verbose=0):
+    def __init__(self, df_dataset, leaf_size=40, parallel=False, batch_size=32, verbose=0, workers=None):
 
         self.leaf_size = leaf_size
         self.parallel = parallel
         self.batch_size = batch_size
         self.verbose = verbose
 
-        self.df_dataset = df_dataset
+        # The finders work directly on the hashes matrix of the dataset.
+        self.dataset = HashDataset.wrap(df_dataset)
         self.tree = None
+        # When set, the groups of near duplicates are streamed to this GroupWriter as they are selected.
+        self.group_writer = None
+        # When set, the rank of each image in the order of preference of a keep policy: each group keeps its image
+        # of lowest rank instead of its image of lowest index, see select_duplicates().
+        self.keep_ranks = None
 
         if self.parallel:
-            number_of_cpu = multiprocessing.cpu_count()
+            self.number_of_cpu = CpuUtils.number_of_workers(workers)
 
-            if number_of_cpu >= 2:
-                self.number_of_cpu = number_of_cpu
-            else:
-                raise ValueError("Number of CPU must be greater than or equal to 2.")
+            if self.number_of_cpu < 2:
+                # e.g. --workers 1 or a container limited to a single CPU.
+                warnings.warn("A single worker is available, the parallel mode is disabled.")
+                self.parallel = False
 
         self.build_tree()
 
-    @staticmethod
-    def __getThreads():
-        """ Returns the number of available threads on a posix/win based system """
-        if sys.platform == 'win32':
-            return (int)(os.environ['NUMBER_OF_PROCESSORS'])
-        else:
-            return (int)(os.popen('grep -c cores /proc/cpuinfo').read())
-
     def build_tree(self):
         raise NotImplementedError('subclasses must override build_tree()!')
 
+    def close(self):
+        """Release the resources of the finder (processes, temporary files)."""
+        pass
+
     def _find(self, image_id, nearest_neighbors=5, threshold=10):
         raise NotImplementedError('subclasses must override find()!')
 
@@ -105,9 +108,6 @@ class NearDuplicateImageFinder(object):
         print('Finding duplicates and/or near duplicates...')
         start_time = time.time()
 
-        dict_image_to_duplicates = dict()
-        keep = []
-        remove = []
         # 'distances' is a matrix NxM where N is the number of images and M is the value of nearest_neighbors_in.
         # For each image it contains an array containing the distances of k-nearest neighbors.
         # 'indices' is a matrix NxM where N is the number of images and M is the value of nearest_neighbors_in.
@@ -128,12 +128,56 @@ class NearDuplicateImageFinder(object):
         # Example:
         # <class 'set'>: {(0, 1), (1, 2), (1, 3), (4, 6), (4, 5), (5, 6), (2, 3), (0, 3), (7, 8), (0, 2)}
 
-        pair_sorted_by_first = sorted(list(pairs_of_indexes_of_duplicate_images), key=lambda tup: (tup[0], tup[1]))
+        keep, remove, dict_image_to_duplicates = NearDuplicateImageFinder.select_duplicates(
+            pairs_of_indexes_of_duplicate_images, self.group_writer, self.keep_ranks)
+
+        files_to_remove = self.dataset.files_at(remove)
+        print("\t number of files to remove: {}".format(len(files_to_remove)))
+
+        files_to_keep = self.dataset.files_at(keep)
+        print("\t number of files to keep: {}".format(len(files_to_keep)))
+
+        end_time = time.time()
+        print("{0} duplicates or near duplicates has been founded in {1} seconds".format(len(files_to_remove),
+                                                                                         end_time - start_time))
+
+        return files_to_keep, files_to_remove, dict_image_to_duplicates
+
+    @staticmethod
+    def select_duplicates(pairs, group_writer=None, ranks=None):
+        """Choose the images to keep and the images to remove.
+
+        Parameters
+        ----------
+        pairs
+            The pairs (i, j) of near duplicate images, with i < j.
+        group_writer
+            When set, the GroupWriter where the groups are streamed, see select_duplicate().
+        ranks
+            When set, the rank of each image: the images are visited by ascending rank instead of ascending index,
+            the image of lowest rank of a group is kept.
+
+        Returns
+        -------
+        The list of images to keep, the list of images to remove and a dict image -> list of its near duplicates
+        with a greater index, or a greater rank.
+        """
+        dict_image_to_duplicates = dict()
+        keep = []
+        remove = []
+        # The same elements of remove, for the membership tests.
+        removed = set()
+
+        if ranks is None:
+            pair_sorted_by_first = sorted(list(pairs), key=lambda tup: (tup[0], tup[1]))
+        else:
+            pair_sorted_by_first = sorted(((i, j) if ranks[i] < ranks[j] else (j, i) for i, j in pairs),
+                                          key=lambda tup: (ranks[tup[0]], ranks[tup[1]]))
         # Example:
         # <class 'list'>: [(0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3), (4, 5), (4, 6), (5, 6), (7, 8)]
 
-        [dict_image_to_duplicates[t[0]].append(t[1]) if t[0] in list(dict_image_to_duplicates.keys())
-         else dict_image_to_duplicates.update({t[0]: [t[1]]}) for t in pair_sorted_by_first]
+        for t in pair_sorted_by_first:
+            dict_image_to_duplicates.setdefault(t[0], []).append(t[1])
         # Example:
         # <class 'dict'>: {
         # 0: [1, 2, 3],
@@ -147,37 +191,63 @@ class NearDuplicateImageFinder(object):
         # remove = [1, 2, 3, 5, 6, 8]
 
         with tqdm(total=len(dict_image_to_duplicates.items())) as pbar:
-            for k, (key, value) in enumerate(dict_image_to_duplicates.items()):
-                if k == 0:
-                    if key not in keep:
-                        keep.append(key)
-                    remove.extend(value)
-                else:
-                    if key not in remove:
-                        # I keep the key if and only if it doesn't have neighbors in common
-                        # to the previously removed keys (so is a different image).
-                        # Otherwise remove the key.
-                        if not any(elem in remove for elem in value):
-                            keep.append(key)
-                        else:
-                            if key not in remove:
-                                remove.append(key)
-                    # Either key is or isn't in remove, I remove the key's neighbors that hasn't removed yet.
-                    if not all(elem in remove for elem in value):
-                        remove.extend(list(set(value).difference(set(remove))))
+            for key, value in dict_image_to_duplicates.items():
+                NearDuplicateImageFinder.select_duplicate(key, value, keep, remove, removed, group_writer)
                 pbar.update(1)
 
-        files_to_remove = [f for f in list(self.df_dataset.iloc[remove]['file'])]
-        print("\t number of files to remove: {}".format(len(files_to_remove)))
+        return keep, remove, dict_image_to_duplicates
 
-        files_to_keep = [f for f in list(self.df_dataset.iloc[keep]['file'])]
-        print("\t number of files to keep: {}".format(len(files_to_keep)))
+    @staticmethod
+    def select_duplicate(key, value, keep, remove, removed, group_writer=None):
+        """Decide whether to keep an image and remove its near duplicates, the images must be visited in ascending
+        order.
 
-        end_time = time.time()
-        print("{0} duplicates or near duplicates has been founded in {1} seconds".format(len(files_to_remove),
-                                                                                         end_time - start_time))
+        Parameters
+        ----------
+        key
+            The image.
+        value
+            Its near duplicates with a greater index.
+        keep
+            The images kept so far, appended to.
+        remove
+            The images removed so far, appended to.
+        removed
+            The set of the elements of remove, updated.
+        group_writer
+            When set, the images removed are appended to the group of the image kept in their place: the image
+            itself if it's kept, else the image kept in place of the near duplicate that caused its removal.
 
-        return files_to_keep, files_to_remove, dict_image_to_duplicates
+        Returns
+        -------
+        The near duplicates removed because of the image.
+        """
+        was_removed = key in removed
+        if key not in removed:
+            # I keep the key if and only if it doesn't have neighbors in common
+            # to the previously removed keys (so is a different image).
+            # Otherwise remove the key.
+            if not any(elem in removed for elem in value):
+                keep.append(key)
+            else:
+                remove.append(key)
+                removed.add(key)
+        # Either key is or isn't in remove, I remove the key's neighbors that hasn't removed yet.
+        new_elements = [elem for elem in dict.fromkeys(value) if elem not in removed]
+        remove.extend(new_elements)
+        removed.update(new_elements)
+
+        if group_writer is not None:
+            if was_removed:
+                group_writer.write(group_writer.owner(key), new_elements)
+            elif len(keep) > 0 and keep[-1] == key:
+                group_writer.write(key, new_elements)
+            else:
+                # Removed because of a near duplicate removed before, the new elements aren't.
+                new_set = set(new_elements)
+                neighbor = next(elem for elem in value if elem not in new_set)
+                group_writer.write(group_writer.owner(neighbor), [key] + new_elements)
+        return new_elements
 
     def show_an_image_duplicates(self, image_to_duplicates, image, output_path, image_w=128, image_h=128):
         """ Show near duplicates.
@@ -199,10 +269,10 @@ class NearDuplicateImageFinder(object):
         duplicate = image_to_duplicates[image]
         files_to_show = []
 
-        image_path = self.df_dataset.iloc[image]['file']
+        image_path = self.dataset.file(image)
         files_to_show.append(ImgUtils.scale(ImgUtils.read_image_numpy(image_path, image_w, image_h)))
 
-        duplicates_path = [f for f in list(self.df_dataset.iloc[duplicate]['file'])]
+        duplicates_path = self.dataset.files_at(duplicate)
         for path in duplicates_path:
             print(path)
         duplicates_arr = [ImgUtils.scale(ImgUtils.read_image_numpy(f, image_w, image_h)) for f in duplicates_path]
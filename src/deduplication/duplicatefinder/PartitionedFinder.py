@@ -0,0 +1,195 @@
+import json
+import os
+import zlib
+
+import numpy as np
+from sklearn.neighbors import KDTree
+from tqdm import tqdm
+
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.dataset.PathTable import PathTable
+from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+
+# Written into each shard directory by PartitionedFinder.map_shard().
+SHARD_HEADER = 'shard.json'
+
+
+class PartitionedFinder(object):
+    """
+    Deterministic map-reduce deduplication.
+
+    The images are partitioned into shards by the CRC32 of their path, so the partition doesn't depend on the
+    machine nor on the order of the images:
+    - map_shard() hashes nothing: it takes the rows of its shard from a dataset, finds the pairs of near duplicates
+      within the shard and writes the shard (its dataset, the global ids of its images and its pairs) into
+      shards_path/shard-<id>.
+    - reduce_shards() finds the pairs between the shards from their hashes only, one tree at a time, and chooses the
+      images to keep with NearDuplicateImageFinder.select_duplicates() on the pairs of the whole collection.
+
+    Every pair of images within the threshold is found, so the result is the one of a single run of a tree finder
+    whose nearest_neighbors covers every neighbor within the threshold.
+    """
+
+    def __init__(self, shards_path, distance_metric='manhattan', leaf_size=40):
+        assert distance_metric in KDTreeFinder.valid_metrics, "{} isn't a valid metric.".format(distance_metric)
+        self.shards_path = shards_path
+        self.distance_metric = distance_metric
+        self.leaf_size = leaf_size
+
+    @staticmethod
+    def shard_of(path, shards):
+        """ The shard of an image, a stable hash of its path. """
+        return zlib.crc32(os.fsencode(path)) % shards
+
+    @staticmethod
+    def partition(files, shards):
+        """
+        :param files: the paths of the images, e.g. a PathTable.
+        :param shards: the number of shards.
+        :return: an int64 array, the shard of each image.
+        """
+        return np.fromiter((PartitionedFinder.shard_of(path, shards) for path in files), dtype=np.int64,
+                           count=len(files))
+
+    def shard_path(self, shard_id):
+        return os.path.join(self.shards_path, 'shard-{:05d}'.format(shard_id))
+
+    def pairs_within(self, tree, ids_a, hashes_b, ids_b, threshold, after_only=False):
+        """
+        The pairs of images within the threshold between the images of a tree and other images.
+        :param tree: the tree of the images ids_a.
+        :param ids_a: the global ids of the images of the tree.
+        :param hashes_b: the hashes of the other images.
+        :param ids_b: their global ids.
+        :param threshold: the maximum distance.
+        :param after_only: keep only the pairs whose tree image comes after the other image in hashes_b, for the
+        pairs of a tree with its own images.
+        :return: an int64 matrix P x 2 of the pairs (i, j) of global ids, with i < j.
+        """
+        pairs = []
+        for row, neighbors in enumerate(tree.query_radius(np.asarray(hashes_b), threshold)):
+            if after_only:
+                neighbors = neighbors[neighbors > row]
+            if len(neighbors) > 0:
+                pairs.append(np.stack([np.full(len(neighbors), ids_b[row]), ids_a[neighbors]], axis=1))
+        if len(pairs) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        return np.sort(np.concatenate(pairs).astype(np.int64), axis=1)
+
+    def map_shard(self, df_dataset, shards, shard_id, threshold):
+        """
+        Find the near duplicates within a shard and write the shard.
+        :param df_dataset: the whole dataset, e.g. a saved dataset: only the rows of the shard are read.
+        :param shards: the number of shards.
+        :param shard_id: the shard, between 0 and shards - 1.
+        :param threshold: the maximum distance of the near duplicates.
+        :return: the directory of the shard.
+        """
+        assert 0 <= shard_id < shards, "The shard id must be between 0 and {}.".format(shards - 1)
+        dataset = HashDataset.wrap(df_dataset)
+        ids = np.flatnonzero(PartitionedFinder.partition(dataset.files, shards) == shard_id)
+        shard = dataset.take(ids)
+        print("Shard {0}/{1}: {2} images of {3}".format(shard_id, shards, len(shard), len(dataset)))
+
+        pairs = np.zeros((0, 2), dtype=np.int64)
+        if len(shard) > 0:
+            tree = KDTree(shard.hashes, leaf_size=self.leaf_size, metric=self.distance_metric)
+            pairs = self.pairs_within(tree, ids, shard.hashes, ids, threshold, after_only=True)
+        print("\t{} pairs of near duplicates within the shard".format(len(pairs)))
+
+        shard_path = self.shard_path(shard_id)
+        shard.save(os.path.join(shard_path, 'dataset'))
+        np.save(os.path.join(shard_path, 'ids.npy'), ids)
+        np.save(os.path.join(shard_path, 'pairs.npy'), pairs)
+        header = {'shard_id': shard_id, 'shards': shards, 'images': len(dataset), 'threshold': threshold,
+                  'distance_metric': self.distance_metric}
+        with open(os.path.join(shard_path, SHARD_HEADER), 'w') as f:
+            json.dump(header, f, indent=2)
+        return shard_path
+
+    def load_headers(self, threshold):
+        """ Check that every shard has been written with the same settings. """
+        headers = []
+        for name in sorted(os.listdir(self.shards_path)):
+            header_path = os.path.join(self.shards_path, name, SHARD_HEADER)
+            if os.path.exists(header_path):
+                with open(header_path) as f:
+                    headers.append(json.load(f))
+        if len(headers) == 0:
+            raise ValueError("{} doesn't contain any shard.".format(self.shards_path))
+
+        shards = headers[0]['shards']
+        if sorted(header['shard_id'] for header in headers) != list(range(0, shards)):
+            raise ValueError("{0} must contain the {1} shards.".format(self.shards_path, shards))
+        for header in headers:
+            if (header['shards'], header['images'], header['threshold'], header['distance_metric']) != \
+                    (shards, headers[0]['images'], threshold, self.distance_metric):
+                raise ValueError("The shard {0} has been written with {1}, not with threshold {2} and metric {3}."
+                                 .format(header['shard_id'], header, threshold, self.distance_metric))
+        return headers
+
+    def load_shards(self, headers):
+        """ The dataset of each shard and the global ids of its images. """
+        return [(HashDataset.load(os.path.join(self.shard_path(header['shard_id']), 'dataset')),
+                 np.load(os.path.join(self.shard_path(header['shard_id']), 'ids.npy')))
+                for header in headers]
+
+    def dataset(self, threshold):
+        """
+        The dataset of the whole collection, put together from the shards in the order of the global ids, e.g. for
+        the keep order of reduce_shards().
+        :param threshold: the maximum distance, the one of map_shard().
+        :return: a HashDataset.
+        """
+        shards = self.load_shards(self.load_headers(threshold))
+        order = np.argsort(np.concatenate([ids for _, ids in shards]), kind='stable')
+        files = PathTable.from_paths(path for dataset, _ in shards for path in dataset.files).take(order)
+        metadata = {name: np.concatenate([np.asarray(dataset.metadata[name]) for dataset, _ in shards])[order]
+                    for name in shards[0][0].metadata}
+        return HashDataset(np.concatenate([dataset.hashes for dataset, _ in shards])[order], files, metadata=metadata,
+                           hash_size=shards[0][0].hash_size, hash_algo=shards[0][0].hash_algo)
+
+    def reduce_shards(self, threshold, keep_ranks=None):
+        """
+        Find the near duplicates between the shards and choose the images to keep.
+        :param threshold: the maximum distance, the one of map_shard().
+        :param keep_ranks: when set, the rank of each image by global id, see NearDuplicateImageFinder.keep_ranks.
+        :return: the same results of NearDuplicateImageFinder.find_all_near_duplicates(), the files are a PathTable.
+        """
+        print('Reconciling the shards...')
+        headers = self.load_headers(threshold)
+        shards = self.load_shards(headers)
+
+        pairs = [np.load(os.path.join(self.shard_path(header['shard_id']), 'pairs.npy')) for header in headers]
+        with tqdm(total=len(shards) * (len(shards) - 1) // 2) as pbar:
+            for a, (dataset_a, ids_a) in enumerate(shards):
+                if len(dataset_a) == 0:
+                    pbar.update(len(shards) - a - 1)
+                    continue
+                tree = KDTree(dataset_a.hashes, leaf_size=self.leaf_size, metric=self.distance_metric)
+                for dataset_b, ids_b in shards[a + 1:]:
+                    pairs.append(self.pairs_within(tree, ids_a, dataset_b.hashes, ids_b, threshold))
+                    pbar.update(1)
+        pairs = np.concatenate(pairs) if len(pairs) > 0 else np.zeros((0, 2), dtype=np.int64)
+        print("\t{} pairs of near duplicates".format(len(pairs)))
+
+        keep, remove, dict_image_to_duplicates = NearDuplicateImageFinder.select_duplicates(
+            map(tuple, pairs.tolist()), ranks=keep_ranks)
+
+        # global id -> (shard, position in the shard)
+        shard_of_id = np.empty(headers[0]['images'], dtype=np.int64)
+        position_of_id = np.empty(headers[0]['images'], dtype=np.int64)
+        for s, (_, ids) in enumerate(shards):
+            shard_of_id[ids] = s
+            position_of_id[ids] = np.arange(0, len(ids))
+
+        def files(ids):
+            return PathTable.from_paths(shards[shard_of_id[i]][0].file(position_of_id[i]) for i in ids)
+
+        files_to_remove = files(remove)
+        print("\t number of files to remove: {}".format(len(files_to_remove)))
+        files_to_keep = files(keep)
+        print("\t number of files to keep: {}".format(len(files_to_keep)))
+
+        return files_to_keep, files_to_remove, dict_image_to_duplicates
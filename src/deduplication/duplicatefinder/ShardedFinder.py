@@ -0,0 +1,192 @@
+import multiprocessing
+
+import numpy as np
+from scipy.spatial import cKDTree
+from sklearn.neighbors import KDTree
+
+from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+from deduplication.duplicatefinder.cKDTreeFinder import cKDTreeFinder
+
+# The Minkowski p-norm of the cKDTree metrics.
+ckdtree_p = {'manhattan': 1, 'euclidean': 2}
+
+# The shards of the current query worker, see ShardedFinder.init_query_worker().
+_shards = None
+
+
+def _build_shard(args):
+    tree_type, hashes, distance_metric, leaf_size = args
+    if tree_type == 'cKDTree':
+        return cKDTree(hashes, leafsize=leaf_size)
+    return KDTree(hashes, leaf_size=leaf_size, metric=distance_metric)
+
+
+def _query_rows(bounds):
+    start, end, k, distance_upper_bound = bounds
+    trees, offsets, tree_type, distance_metric, hashes = _shards
+    return ShardedFinder.query_shards(trees, offsets, tree_type, distance_metric, hashes[start:end], k,
+                                      distance_upper_bound)
+
+
+def _query_radius_rows(bounds):
+    start, end, radius = bounds
+    trees, offsets, tree_type, distance_metric, hashes = _shards
+    return ShardedFinder.query_radius_shards(trees, offsets, tree_type, distance_metric, hashes[start:end], radius)
+
+
+class ShardedFinder(NearDuplicateImageFinder):
+    """
+    Multi-core finder: the dataset is partitioned into contiguous shards and the tree of each shard is built by a
+    pool of processes. The queries are split among the processes of a second pool, each of them asks every shard
+    and merges the top-k (or radius) results, so both the build and the queries use all the workers whatever the
+    tree type.
+
+    The trees are sent back from the build pool. On 1M 8x8 hashes a KDTree takes 5.9s to build and 0.9s more when
+    it's built in a pool process, a cKDTree 1.3s and 1.3s more: build_tree() (the command line --parallel) only
+    shards KDTrees, a cKDTree is built once and queried with cKDTree.query(workers=N).
+    """
+
+    def __init__(self, df_dataset, tree_type='KDTree', distance_metric='manhattan', leaf_size=40, batch_size=32,
+                 verbose=0, workers=None, shards=None):
+        valid_metrics = cKDTreeFinder.valid_metrics if tree_type == 'cKDTree' else KDTreeFinder.valid_metrics
+        assert tree_type in ['KDTree', 'cKDTree'], "{} isn't a valid tree type.".format(tree_type)
+        assert distance_metric in valid_metrics, "{0} isn't a valid metric for {1}.".format(distance_metric,
+                                                                                            tree_type)
+        self.tree_type = tree_type
+        self.distance_metric = distance_metric
+        self.shards = shards
+        self.trees = []
+        # offsets[s] is the id of the first image of the s-th shard, offsets[-1] the number of images.
+        self.offsets = None
+        self.query_pool = None
+        super().__init__(df_dataset, leaf_size, parallel=True, batch_size=batch_size, verbose=verbose,
+                         workers=workers)
+
+    def build_tree(self):
+        number_of_shards = min(self.shards or self.number_of_cpu, max(1, len(self.dataset)))
+        print('Building {0} {1}s with {2} processes...'.format(number_of_shards, self.tree_type, self.number_of_cpu))
+
+        self.offsets = np.linspace(0, len(self.dataset), number_of_shards + 1).astype(np.int64)
+        tasks = [(self.tree_type, self.dataset.hashes[start:end], self.distance_metric, self.leaf_size)
+                 for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+        with multiprocessing.Pool(processes=self.number_of_cpu) as pool:
+            self.trees = pool.map(_build_shard, tasks, chunksize=1)
+
+    @staticmethod
+    def init_query_worker(trees, offsets, tree_type, distance_metric, hashes):
+        global _shards
+        _shards = (trees, offsets, tree_type, distance_metric, hashes)
+
+    @staticmethod
+    def query_shards(trees, offsets, tree_type, distance_metric, x, k, distance_upper_bound=np.inf):
+        """
+        Ask the k nearest neighbors to every shard and merge the results.
+        :return: the distances and the ids of the k nearest neighbors of each point of x, sorted by distance and id.
+        The missing neighbors have an infinite distance and the id len(dataset).
+        """
+        x = np.asarray(x, dtype=np.float64)
+        shard_distances = []
+        shard_indices = []
+        for tree, offset, end in zip(trees, offsets[:-1], offsets[1:]):
+            shard_k = min(k, end - offset)
+            if tree_type == 'cKDTree':
+                distances, indices = tree.query(x, k=shard_k, p=ckdtree_p[distance_metric],
+                                                distance_upper_bound=distance_upper_bound)
+            else:
+                distances, indices = tree.query(x, k=shard_k)
+            distances = np.asarray(distances, dtype=np.float64).reshape(len(x), shard_k)
+            indices = np.asarray(indices, dtype=np.int64).reshape(len(x), shard_k)
+            shard_distances.append(distances)
+            # cKDTree marks the missing neighbors with the size of the shard.
+            shard_indices.append(np.where(indices < end - offset, indices + offset, offsets[-1]))
+
+        distances = np.concatenate(shard_distances, axis=1)
+        indices = np.concatenate(shard_indices, axis=1)
+        order = np.lexsort((indices, distances), axis=-1)[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    @staticmethod
+    def query_radius_shards(trees, offsets, tree_type, distance_metric, x, radius):
+        """
+        Ask the neighbors within radius to every shard and merge the results.
+        :return: for each point of x, an array of distances and an array of ids sorted by distance and id.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        distances = [[] for _ in range(0, len(x))]
+        indices = [[] for _ in range(0, len(x))]
+        for tree, offset in zip(trees, offsets[:-1]):
+            if tree_type == 'cKDTree':
+                p = ckdtree_p[distance_metric]
+                for i, neighbors in enumerate(tree.query_ball_point(x, radius, p=p)):
+                    neighbors = np.asarray(neighbors, dtype=np.int64)
+                    indices[i].append(neighbors + offset)
+                    distances[i].append(np.linalg.norm(tree.data[neighbors] - x[i], ord=p, axis=1)
+                                        if len(neighbors) > 0 else np.zeros(0))
+            else:
+                shard_indices, shard_distances = tree.query_radius(x, radius, return_distance=True)
+                for i in range(0, len(x)):
+                    indices[i].append(shard_indices[i].astype(np.int64) + offset)
+                    distances[i].append(shard_distances[i])
+
+        results = []
+        for d, ids in zip(distances, indices):
+            d = np.concatenate(d).astype(np.float64)
+            ids = np.concatenate(ids)
+            order = np.lexsort((ids, d))
+            results.append((d[order], ids[order]))
+        return results
+
+    def get_query_pool(self):
+        if self.query_pool is None:
+            self.query_pool = multiprocessing.Pool(processes=self.number_of_cpu,
+                                                   initializer=ShardedFinder.init_query_worker,
+                                                   initargs=(self.trees, self.offsets, self.tree_type,
+                                                             self.distance_metric, self.dataset.hashes))
+        return self.query_pool
+
+    def query_bounds(self):
+        """ Split the images in a few blocks of rows for each worker. """
+        rows = max(self.batch_size, -(-len(self.dataset) // (4 * self.number_of_cpu)))
+        return [(start, min(start + rows, len(self.dataset))) for start in range(0, len(self.dataset), rows)]
+
+    def _find_all(self, nearest_neighbors=5, threshold=10):
+        distance_upper_bound = threshold if self.tree_type == 'cKDTree' else np.inf
+        print("\tCPU: {}".format(self.number_of_cpu))
+        results = self.get_query_pool().map(_query_rows, [(start, end, nearest_neighbors, distance_upper_bound)
+                                                          for start, end in self.query_bounds()])
+        distances = np.concatenate([d for d, _ in results])
+        indices = np.concatenate([i for _, i in results])
+
+        # The first neighbor must be the image itself, even if other images have the same hash.
+        ids = np.arange(0, len(self.dataset))
+        is_self = indices == ids[:, np.newaxis]
+        for row in np.flatnonzero(is_self[:, 0] == 0):
+            others = ~is_self[row]
+            indices[row] = np.concatenate([[row], indices[row][others]])[:nearest_neighbors]
+            distances[row] = np.concatenate([[0.0], distances[row][others]])[:nearest_neighbors]
+
+        return distances, indices
+
+    def _find(self, image_id, nearest_neighbors=5, threshold=10):
+        distance_upper_bound = threshold if self.tree_type == 'cKDTree' else np.inf
+        return ShardedFinder.query_shards(self.trees, self.offsets, self.tree_type, self.distance_metric,
+                                          self.dataset.hashes[image_id].reshape(1, -1), nearest_neighbors,
+                                          distance_upper_bound)
+
+    def find_within_radius(self, radius):
+        """
+        Find the neighbors within radius of every image.
+        :param radius: the maximum distance.
+        :return: for each image, an array of distances and an array of ids sorted by distance and id (the image
+        itself included).
+        """
+        results = self.get_query_pool().map(_query_radius_rows,
+                                            [(start, end, radius) for start, end in self.query_bounds()])
+        return [neighbors for block in results for neighbors in block]
+
+    def close(self):
+        if self.query_pool is not None:
+            self.query_pool.close()
+            self.query_pool.join()
+            self.query_pool = None
@@ -0,0 +1,217 @@
+import csv
+import hashlib
+import os
+import time
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+
+from deduplication.duplicatefinder.CollectionJoin import CollectionJoin
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+
+# The version of the format of the saved forests.
+FOREST_VERSION = 1
+
+# The minimum number of candidate edges buffered before they are reduced to a spanning forest.
+MIN_BUFFERED_EDGES = 1 << 20
+
+
+class SingleLinkageFinder(NearDuplicateImageFinder):
+    """
+    Single-linkage hierarchy of the near duplicates, for any threshold up to max_radius.
+
+    build_tree() queries every image once within max_radius and reduces the pairs of near duplicates to their minimum
+    spanning forest, the at most N - 1 edges that single linkage needs: the images connected by the edges within a
+    threshold are the groups of that threshold. The pairs are reduced batch by batch, so only the forest and a
+    buffer of pairs are held in memory. The forest can be saved into forest_path and reused by later runs with
+    other thresholds, without querying the images again.
+
+    A group is a connected component: an image is removed if a chain of near duplicates links it to the image kept,
+    the first image of the group in the order of the dataset or of keep_ranks, even if they are further apart than
+    the threshold.
+    """
+
+    def __init__(self, df_dataset, tree_type='KDTree', distance_metric='manhattan', leaf_size=40, batch_size=1024,
+                 max_radius=10, forest_path=None, verbose=0):
+        self.collection_join = CollectionJoin(tree_type=tree_type, distance_metric=distance_metric,
+                                              leaf_size=leaf_size, batch_size=batch_size)
+        self.distance_metric = distance_metric
+        self.max_radius = max_radius
+        self.forest_path = forest_path
+        # The edges of the forest: two int64 arrays of image ids and their distances, sorted by distance.
+        self.edges = None
+        super().__init__(df_dataset, leaf_size, parallel=False, batch_size=batch_size, verbose=verbose)
+
+    def fingerprint(self):
+        """ The digest of the hashes, in the order of the dataset: a saved forest is only valid for them. """
+        return hashlib.sha1(np.ascontiguousarray(self.dataset.hashes)).hexdigest()
+
+    @staticmethod
+    def spanning_forest(size, a, b, distances):
+        """
+        Kruskal's minimum spanning forest of a graph of near duplicates.
+        :param size: the number of images.
+        :param a: the first image of each edge.
+        :param b: the second image of each edge, the pairs are unique.
+        :param distances: the distance of each edge.
+        :return: the edges of the forest (a, b, distances), sorted by distance.
+        """
+        if len(a) == 0:
+            return a, b, distances
+        order = np.argsort(distances, kind='stable')
+        a, b, distances = a[order], b[order], distances[order]
+        # The ranks are the weights: a sparse matrix would drop the zero distances, and the ties keep their order.
+        ranks = np.arange(1, len(order) + 1, dtype=np.float64)
+        forest = minimum_spanning_tree(coo_matrix((ranks, (a, b)), shape=(size, size))).tocoo()
+        kept = np.sort(forest.data.astype(np.int64) - 1)
+        return a[kept], b[kept], distances[kept]
+
+    def build_tree(self):
+        if self.forest_path is not None and os.path.exists(self.forest_path) and self.load_forest():
+            return
+
+        print('Building the minimum spanning forest of the near duplicates within {}...'.format(self.max_radius))
+        start_time = time.time()
+        size = len(self.dataset)
+        empty = np.empty(0, dtype=np.int64)
+        edges = (empty, empty, np.empty(0, dtype=np.float64))
+        buffered = []
+        buffered_edges = 0
+        if size > 0:
+            tree = self.collection_join.build_index(self.dataset)
+            for row, ids, distances in self.collection_join.query(tree, size, self.dataset.hashes, self.max_radius,
+                                                                  after_only=True):
+                buffered.append((np.full(len(ids), row, dtype=np.int64), ids.astype(np.int64),
+                                 distances.astype(np.float64)))
+                buffered_edges += len(ids)
+                if buffered_edges >= max(size, MIN_BUFFERED_EDGES):
+                    edges = SingleLinkageFinder.spanning_forest(size, *(np.concatenate(column) for column
+                                                                        in zip(edges, *buffered)))
+                    buffered = []
+                    buffered_edges = 0
+        self.edges = SingleLinkageFinder.spanning_forest(size, *(np.concatenate(column) for column
+                                                                 in zip(edges, *buffered)))
+        print("\t{0} edges in {1} seconds".format(len(self.edges[0]), time.time() - start_time))
+
+        if self.forest_path is not None:
+            self.save_forest()
+
+    def save_forest(self):
+        tmp_path = '{0}.{1}.tmp.npz'.format(self.forest_path, os.getpid())
+        a, b, distances = self.edges
+        np.savez(tmp_path, a=a, b=b, distance=distances, size=len(self.dataset), max_radius=self.max_radius,
+                 distance_metric=self.distance_metric, fingerprint=self.fingerprint(), version=FOREST_VERSION)
+        os.replace(tmp_path, self.forest_path)
+        print("\tForest saved into {}".format(self.forest_path))
+
+    def load_forest(self):
+        """
+        Open the forest saved into forest_path, if it's been built from the same hashes, with the same metric and
+        at least the same radius.
+        :return: whether the forest has been loaded, otherwise it has to be built again.
+        """
+        with np.load(self.forest_path) as forest:
+            settings = (int(forest['version']), str(forest['distance_metric']), int(forest['size']),
+                        str(forest['fingerprint']))
+            if settings != (FOREST_VERSION, self.distance_metric, len(self.dataset), self.fingerprint()) or \
+                    float(forest['max_radius']) < self.max_radius:
+                print("{} has been built from other images or settings, it's built again.".format(self.forest_path))
+                return False
+            self.max_radius = forest['max_radius'].item()
+            self.edges = (forest['a'], forest['b'], forest['distance'])
+        print("Forest loaded from {0}: {1} edges within {2}".format(self.forest_path, len(self.edges[0]),
+                                                                    self.max_radius))
+        return True
+
+    def cut(self, threshold):
+        """
+        :param threshold: the maximum distance, at most max_radius.
+        :return: the group of each image, the connected components of the edges within the threshold.
+        """
+        if threshold > self.max_radius:
+            raise ValueError("The threshold {0} is greater than the radius of the forest {1}.".format(
+                threshold, self.max_radius))
+        a, b, distances = self.edges
+        count = np.searchsorted(distances, threshold, side='right')
+        size = len(self.dataset)
+        graph = coo_matrix((np.ones(count), (a[:count], b[:count])), shape=(size, size))
+        return connected_components(graph, directed=False)[1]
+
+    def summary(self):
+        """
+        The groups of every threshold up to max_radius, without cutting the forest: each edge within a threshold
+        merges two groups, so the images removed are the edges and the images without any edge are alone.
+        :return: the thresholds where the groups change, the number of groups and the number of images removed at
+        each of them.
+        """
+        a, b, distances = self.edges
+        size = len(self.dataset)
+        thresholds = np.unique(distances)
+        removed = np.searchsorted(distances, thresholds, side='right')
+        # The distance of the nearest neighbor of each image in the forest.
+        nearest = np.full(size, np.inf)
+        np.minimum.at(nearest, a, distances)
+        np.minimum.at(nearest, b, distances)
+        alone = size - np.searchsorted(np.sort(nearest), thresholds, side='right')
+        return thresholds, size - removed - alone, removed
+
+    def write_summary(self, summary_path):
+        """ Write the summary() into a CSV file with columns 'threshold', 'groups' and 'removed'. """
+        with open(summary_path, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(['threshold', 'groups', 'removed'])
+            writer.writerows(zip(*(values.tolist() for values in self.summary())))
+        print("\tSummary of the thresholds written into {}".format(summary_path))
+
+    def find_all_near_duplicates(self, nearest_neighbors=5, threshold=10):
+        """Cut the forest at the threshold.
+
+        Parameters
+        ----------
+        nearest_neighbors
+            Unused, every neighbor within max_radius is in the forest.
+        threshold
+
+        Returns
+        -------
+        The same results of NearDuplicateImageFinder.find_all_near_duplicates(), except that the dict maps each image
+        to keep to the other images of its group.
+        """
+        print('Cutting the forest at {}...'.format(threshold))
+        start_time = time.time()
+
+        labels = self.cut(threshold)
+        images = np.arange(0, len(self.dataset))
+        ranks = images if self.keep_ranks is None else np.asarray(self.keep_ranks)
+        first_rank = np.full(labels.max() + 1 if len(labels) > 0 else 0, len(self.dataset))
+        np.minimum.at(first_rank, labels, ranks)
+        # The image of lowest rank of each group.
+        first = np.empty(len(self.dataset), dtype=np.int64)
+        first[ranks] = images
+        first = first[first_rank]
+        in_group = np.bincount(labels)[labels] > 1
+        keep = images[in_group & (first[labels] == images)]
+        remove = images[in_group & (first[labels] != images)]
+
+        owners = first[labels[remove]]
+        order = np.argsort(owners, kind='stable')
+        owners, grouped = owners[order], remove[order]
+        starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]]) if len(owners) > 0 else []
+        dict_image_to_duplicates = {int(owners[start]): group.tolist()
+                                    for start, group in zip(starts, np.split(grouped, starts[1:]))}
+        if self.group_writer is not None:
+            for image, duplicates in dict_image_to_duplicates.items():
+                self.group_writer.write(image, duplicates)
+
+        files_to_remove = self.dataset.files_at(remove)
+        print("\t number of files to remove: {}".format(len(files_to_remove)))
+
+        files_to_keep = self.dataset.files_at(keep)
+        print("\t number of files to keep: {}".format(len(files_to_keep)))
+
+        end_time = time.time()
+        print("{0} duplicates or near duplicates has been founded in {1} seconds".format(len(files_to_remove),
+                                                                                         end_time - start_time))
+
+        return files_to_keep, files_to_remove, dict_image_to_duplicates
@@ -0,0 +1,161 @@
+import datetime
+import os
+import time
+from array import array
+from collections import deque
+
+import numpy as np
+from scipy.spatial.distance import cdist
+from tqdm import tqdm
+
+from deduplication.duplicatefinder.ExternalSortFinder import cdist_metrics
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+
+
+class WindowedFinder(NearDuplicateImageFinder):
+    """
+    Streaming finder for images captured one after the other, e.g. the bursts of a camera: each image is only
+    compared with a sliding window of the images before it, the previous window_size images and/or the images
+    captured in the previous window_seconds seconds.
+
+    The images are visited in the order of the dataset, the natural order of their paths, or in the order of the
+    capture time parsed from their file names with timestamp_format. The work is O(n * window) and only the window
+    is held in memory: stream() also works on the images of a live capture as they arrive.
+    """
+
+    def __init__(self, df_dataset, distance_metric='manhattan', window_size=None, window_seconds=None,
+                 timestamp_format=None, verbose=0):
+        assert distance_metric in cdist_metrics, "{} isn't a valid metric.".format(distance_metric)
+        if window_size is None and window_seconds is None:
+            raise ValueError("A window size or a window duration is required.")
+        if window_size is not None and window_size < 1:
+            raise ValueError("The window size must be greater than or equal to 1.")
+        if window_seconds is not None and timestamp_format is None:
+            raise ValueError("A window duration requires the format of the timestamps of the file names.")
+        self.distance_metric = distance_metric
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self.timestamp_format = timestamp_format
+        # The capture time of each image, when timestamp_format is set, and the order of the visit.
+        self.timestamps = None
+        self.order = None
+        super().__init__(df_dataset, parallel=False, verbose=verbose)
+
+    @staticmethod
+    def parse_timestamp(path, timestamp_format):
+        """
+        The capture time of an image, parsed from its file name without the extension, e.g. '%Y-%m-%d-%H-%M-%S'
+        for 2018-12-11-15-03-11.png. The times without a time zone are taken as UTC.
+        :return: the time in seconds since the epoch.
+        """
+        name = os.path.splitext(os.path.basename(path))[0]
+        capture_time = datetime.datetime.strptime(name, timestamp_format)
+        return capture_time.replace(tzinfo=capture_time.tzinfo or datetime.timezone.utc).timestamp()
+
+    def build_tree(self):
+        if self.timestamp_format is None:
+            self.order = np.arange(0, len(self.dataset))
+            return
+
+        print('Parsing the capture times...')
+        self.timestamps = np.fromiter((WindowedFinder.parse_timestamp(path, self.timestamp_format)
+                                       for path in self.dataset.files), dtype=np.float64, count=len(self.dataset))
+        self.order = np.argsort(self.timestamps, kind='stable')
+
+    def stream(self, items, threshold):
+        """
+        Compare each image with the window before it and choose the images to keep, as select_duplicates() would
+        do with the pairs of near duplicates within the window.
+        :param items: an iterable of (image id, hash digits, capture time in seconds or None), in capture order.
+        :param threshold: the maximum distance.
+        :return: a generator of (image id, whether it's kept in place of its near duplicates, the images removed
+        because of it, itself included), in the order of items. An image is generated when it leaves the window.
+        """
+        metric = cdist_metrics[self.distance_metric]
+        # (image id, hash, capture time) of the images of the window.
+        window = deque()
+        # image of the window -> its near duplicates after it
+        later = {}
+        # The images of the window that have been removed.
+        removed = set()
+        keep = []
+        remove = []
+
+        def leave():
+            image = window.popleft()[0]
+            if image in later:
+                NearDuplicateImageFinder.select_duplicate(image, later.pop(image), keep, remove, removed,
+                                                          self.group_writer)
+            kept, removed_now = len(keep) > 0, remove[:]
+            removed.discard(image)
+            if self.group_writer is not None:
+                self.group_writer.forget(image)
+            del keep[:], remove[:]
+            return image, kept, removed_now
+
+        for image, digits, capture_time in items:
+            while len(window) > 0 and (
+                    (self.window_size is not None and len(window) >= self.window_size) or
+                    (self.window_seconds is not None and capture_time - window[0][2] > self.window_seconds)):
+                yield leave()
+
+            if len(window) > 0:
+                distances = cdist(np.asarray(digits, dtype=np.float64).reshape(1, -1),
+                                  np.array([entry[1] for entry in window], dtype=np.float64), metric=metric)[0]
+                for position in np.flatnonzero(distances <= threshold):
+                    later.setdefault(window[position][0], []).append(image)
+            window.append((image, digits, capture_time))
+
+        while len(window) > 0:
+            yield leave()
+
+    def find_all_near_duplicates(self, nearest_neighbors=5, threshold=10):
+        """Find the near duplicates within the sliding window of each image.
+
+        Parameters
+        ----------
+        nearest_neighbors
+            Unused, every image of the window is compared.
+        threshold
+
+        Returns
+        -------
+        The same results of NearDuplicateImageFinder.find_all_near_duplicates(), except that the dict maps each image
+        to keep to the near duplicates removed because of it.
+        """
+        if self.keep_ranks is not None:
+            raise ValueError("The windowed finder keeps the first image of the window, it doesn't support a keep "
+                             "order.")
+        window = []
+        if self.window_size is not None:
+            window.append('{} images'.format(self.window_size))
+        if self.window_seconds is not None:
+            window.append('{} seconds'.format(self.window_seconds))
+        print('Finding duplicates and/or near duplicates within a window of {}...'.format(' and '.join(window)))
+        start_time = time.time()
+
+        items = ((int(i), self.dataset.hashes[i], self.timestamps[i] if self.timestamps is not None else None)
+                 for i in self.order)
+        keep = array('q')
+        remove = array('q')
+        dict_image_to_duplicates = {}
+        with tqdm(total=len(self.order)) as pbar:
+            for image, kept, removed in self.stream(items, threshold):
+                if kept:
+                    keep.append(image)
+                    if len(removed) > 0:
+                        dict_image_to_duplicates[image] = removed
+                remove.extend(removed)
+                pbar.update(1)
+
+        files_to_remove = self.dataset.files_at(np.frombuffer(remove, dtype=np.int64))
+        print("\t number of files to remove: {}".format(len(files_to_remove)))
+
+        files_to_keep = self.dataset.files_at(np.frombuffer(keep, dtype=np.int64))
+        print("\t number of files to keep: {}".format(len(files_to_keep)))
+
+        end_time = time.time()
+        print("{0} duplicates or near duplicates has been founded in {1} seconds".format(len(files_to_remove),
+                                                                                         end_time - start_time))
+
+        return files_to_keep, files_to_remove, dict_image_to_duplicates
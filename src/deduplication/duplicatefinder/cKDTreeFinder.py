@@ -9,21 +9,22 @@ class cKDTreeFinder(NearDuplicateImageFinder):
         'euclidean'
     ]
 
-    def __init__(self, img_file_list, distance_metric, leaf_size=40, parallel=False, batch_size=32, verbose=0):
+    def __init__(self, img_file_list, distance_metric, leaf_size=40, parallel=False, batch_size=32, verbose=0,
+                 workers=None):
         self.distance_metric = distance_metric
-        super().__init__(img_file_list, leaf_size, parallel, batch_size, verbose)
+        super().__init__(img_file_list, leaf_size, parallel, batch_size, verbose, workers)
 
     def build_tree(self):
         print('Building the cKDTree...')
         assert self.distance_metric in self.valid_metrics, "{} isn't a valid metric for cKDTree.".format(
             self.distance_metric)
 
-        hash_str_len = len(self.df_dataset.at[0, 'hash_list'])
-        self.tree = cKDTree(self.df_dataset[[str(i) for i in range(0, hash_str_len)]], leafsize=self.leaf_size)
+        self.tree = cKDTree(self.dataset.hashes, leafsize=self.leaf_size)
+        # The points of the tree, cKDTree keeps its own float64 copy of the hashes.
+        self.points = self.tree.data
 
     def _find_all(self, nearest_neighbors=5, threshold=10):
         n_jobs = 1
-        hash_str_len = len(self.df_dataset.at[0, 'hash_list'])
         """
         p : float, 1<=p<=infinity
                    Which Minkowski p-norm to use. 
@@ -44,9 +45,8 @@ class cKDTreeFinder(NearDuplicateImageFinder):
             print("\tCPU: {}".format(self.number_of_cpu))
             n_jobs = self.number_of_cpu
 
-        distances, indices = self.tree.query(self.df_dataset[[str(i) for i in range(0, hash_str_len)]],
-                                             k=nearest_neighbors, p=p, distance_upper_bound=threshold,
-                                             n_jobs=n_jobs)
+        distances, indices = self._query(self.points, n_jobs, k=nearest_neighbors, p=p,
+                                         distance_upper_bound=threshold)
 
         return distances, indices
 
@@ -55,11 +55,14 @@ class cKDTreeFinder(NearDuplicateImageFinder):
         if self.parallel:
             n_jobs = self.number_of_cpu
 
-        hash_str_len = len(self.df_dataset.at[0, 'hash_list'])
-
-        distances, indices = self.tree.query(
-            self.df_dataset[[str(i) for i in range(0, hash_str_len)]].iloc[image_id].values.reshape(1, -1),
-            k=nearest_neighbors, p=1, distance_upper_bound=threshold,
-            n_jobs=n_jobs)
+        distances, indices = self._query(self.points[image_id].reshape(1, -1), n_jobs, k=nearest_neighbors, p=1,
+                                         distance_upper_bound=threshold)
 
         return distances, indices
+
+    def _query(self, x, n_jobs, **kwargs):
+        # scipy 1.6 renamed the n_jobs argument of cKDTree.query to workers, scipy 1.9 removed n_jobs.
+        try:
+            return self.tree.query(x, workers=n_jobs, **kwargs)
+        except TypeError:
+            return self.tree.query(x, n_jobs=n_jobs, **kwargs)
@@ -0,0 +1,410 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import time
+import warnings
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from deduplication.commands.enqueue import enqueue
+from deduplication.commands.merge import merge
+from deduplication.commands.worker import worker
+from deduplication.dataset import ImageToHash as image_to_hash_module
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.dataset.ImageToHash import ImageToHash
+from deduplication.dataset.PathTable import PathTable
+from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.tests.conftest import POTATOES_MULTI_FOLDER_BASE_PATH
+from deduplication.utils.ArrowUtils import ArrowUtils
+
+
+@pytest.mark.parametrize('scheduling_order', ['inode', 'fiemap'])
+def test_scheduling_order(scheduling_order):
+    df_natural, img_file_list = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8,
+                                            hash_algo='phash').build_dataset(parallel=False)
+    image_to_hash = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8, hash_algo='phash',
+                                scheduling_order=scheduling_order)
+    df_scheduled, _ = image_to_hash.build_dataset(parallel=False)
+
+    assert sorted(image_to_hash.scheduled_file_list) == sorted(img_file_list)
+    assert list(df_scheduled.files) == img_file_list
+    assert np.array_equal(df_scheduled.hashes, df_natural.hashes)
+
+
+def test_throttled_build_dataset():
+    image_to_hash = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8, hash_algo='phash',
+                                max_files_per_second=25)
+    df_dataset, img_file_list = image_to_hash.build_dataset(parallel=False)
+
+    assert len(df_dataset) == len(img_file_list)
+    assert image_to_hash.stats['files'] == len(img_file_list)
+    assert image_to_hash.stats['bytes'] > 0
+    # The burst covers 25 files, the other 7 files can't be read in less than 7/25 seconds.
+    assert image_to_hash.stats['throttle_wait'] > 0
+    assert image_to_hash.stats['seconds'] >= 0.9 * 7 / 25
+
+
+def test_single_worker_falls_back_to_serial():
+    with pytest.warns(UserWarning, match='single worker'):
+        df_parallel, img_file_list = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8,
+                                                 hash_algo='phash').build_dataset(parallel=True, workers=1)
+    df_serial, _ = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8,
+                               hash_algo='phash').build_dataset(parallel=False)
+    assert np.array_equal(df_parallel.hashes, df_serial.hashes)
+
+    with pytest.warns(UserWarning, match='single worker'):
+        finder = KDTreeFinder(df_parallel, 'manhattan', parallel=True, workers=1)
+    assert not finder.parallel
+    to_keep, to_remove, _ = finder.find_all_near_duplicates(5, 10)
+    assert len(to_keep) + len(to_remove) <= len(img_file_list)
+
+
+def test_serial_build_dataset_restores_the_process_settings():
+    niceness = os.nice(0)
+    max_image_pixels = Image.MAX_IMAGE_PIXELS
+    filters = list(warnings.filters)
+    image_to_hash = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8, hash_algo='phash',
+                                worker_priority='low', max_image_pixels=10 ** 6, max_files_per_second=1000)
+    df_low, img_file_list = image_to_hash.build_dataset(parallel=False)
+    df_normal, _ = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8, hash_algo='phash',
+                               max_image_pixels=10 ** 6, max_files_per_second=1000).build_dataset(parallel=False)
+
+    assert np.array_equal(df_low.hashes, df_normal.hashes)
+    assert os.nice(0) == niceness
+    assert Image.MAX_IMAGE_PIXELS == max_image_pixels
+    assert warnings.filters == filters
+    assert image_to_hash_module._rate_limiter.files_per_second is None
+
+
+def test_checkpoint(tmpdir):
+    checkpoint_path = os.path.join(str(tmpdir), 'checkpoint.jsonl')
+    df_dataset, img_file_list = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8,
+                                            hash_algo='phash').build_dataset(parallel=False)
+
+    # Simulate a run interrupted after 10 images, while writing the 11th.
+    ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8, hash_algo='phash',
+                checkpoint_path=checkpoint_path).build_dataset(parallel=False, batch_size=5)
+    with open(checkpoint_path) as f:
+        lines = f.readlines()
+    assert len(lines) == len(img_file_list) + 1
+    with open(checkpoint_path, 'w') as f:
+        f.writelines(lines[:11] + [lines[11][:20]])
+
+    image_to_hash = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8, hash_algo='phash',
+                                checkpoint_path=checkpoint_path)
+    df_resumed, _ = image_to_hash.build_dataset(parallel=False, batch_size=5)
+
+    assert image_to_hash.stats['files'] == len(img_file_list) - 10
+    assert list(df_resumed.files) == img_file_list
+    assert np.array_equal(df_resumed.hashes, df_dataset.hashes)
+    assert np.array_equal(df_resumed.metadata['file_size'], df_dataset.metadata['file_size'])
+
+    # A checkpoint can't be resumed with other hash settings.
+    with pytest.raises(ValueError):
+        ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=16, hash_algo='phash',
+                    checkpoint_path=checkpoint_path).build_dataset(parallel=False)
+
+
+def test_image_metadata(tmpdir):
+    images_path = os.path.join(str(tmpdir), 'images')
+    shutil.copytree(POTATOES_MULTI_FOLDER_BASE_PATH, images_path)
+    exif = Image.Exif()
+    exif[306] = '2019:01:02 03:04:05'
+    Image.new('RGB', (64, 48), (200, 10, 10)).save(os.path.join(images_path, 'v1', 'capture.jpg'), exif=exif.tobytes())
+    checkpoint_path = os.path.join(str(tmpdir), 'checkpoint.jsonl')
+
+    dataset, _ = ImageToHash(images_path, checkpoint_path=checkpoint_path).build_dataset(parallel=False)
+    capture = dataset.index_of(os.path.join(images_path, 'v1', 'capture.jpg'))
+    assert (dataset.metadata['width'][capture], dataset.metadata['height'][capture]) == (64, 48)
+    assert dataset.metadata['format'][capture] == 'JPEG'
+    assert dataset.metadata['exif_time'][capture] == 1546398245.0
+    others = np.arange(0, len(dataset)) != capture
+    assert set(dataset.metadata['format'][others]) == {'PNG'} and np.isnan(dataset.metadata['exif_time'][others]).all()
+    assert (dataset.metadata['width'][others] > 0).all()
+    assert dataset.metadata['mtime'][0] == os.stat(dataset.file(0)).st_mtime
+
+    # The metadata are resumed from the checkpoint and saved with the dataset.
+    resumed, _ = ImageToHash(images_path, checkpoint_path=checkpoint_path).build_dataset(parallel=False)
+    resumed.save(os.path.join(str(tmpdir), 'dataset'))
+    loaded = HashDataset.load(os.path.join(str(tmpdir), 'dataset'))
+    for name, values in dataset.metadata.items():
+        assert np.array_equal(loaded.metadata[name], values, equal_nan=values.dtype.kind == 'f')
+
+
+def test_quality_score(tmpdir):
+    image = Image.open(os.path.join(POTATOES_MULTI_FOLDER_BASE_PATH, 'v1', os.listdir(
+        os.path.join(POTATOES_MULTI_FOLDER_BASE_PATH, 'v1'))[0])).convert('RGB')
+    image.save(os.path.join(str(tmpdir), 'sharp.jpg'), quality=80)
+    image.filter(ImageFilter.GaussianBlur(2)).save(os.path.join(str(tmpdir), 'blurred.jpg'), quality=80)
+
+    dataset, _ = ImageToHash(str(tmpdir), quality_score=True).build_dataset(parallel=False)
+    sharp, blurred = dataset.index_of(os.path.join(str(tmpdir), 'sharp.jpg')), \
+        dataset.index_of(os.path.join(str(tmpdir), 'blurred.jpg'))
+    assert dataset.metadata['sharpness'][sharp] > dataset.metadata['sharpness'][blurred] > 0
+    assert list(dataset.metadata['jpeg_quality']) == [80, 80]
+
+    # The hashes don't depend on the quality score, which is off by default.
+    default, _ = ImageToHash(str(tmpdir)).build_dataset(parallel=False)
+    assert np.array_equal(default.hashes, dataset.hashes) and np.isnan(default.metadata['sharpness']).all()
+
+
+@pytest.fixture
+def pathological_images(tmpdir):
+    """A copy of the multi folder dataset with a corrupt image and an image whose decoding hangs."""
+    images_path = os.path.join(str(tmpdir), 'images')
+    shutil.copytree(POTATOES_MULTI_FOLDER_BASE_PATH, images_path)
+    corrupt_image = os.path.join(images_path, 'v1', 'corrupt.png')
+    with open(corrupt_image, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\nnot an image')
+    stuck_image = os.path.join(images_path, 'v2', '2018-12-11-16-28399.png')
+
+    return images_path, corrupt_image, stuck_image
+
+
+def test_quarantine(pathological_images, monkeypatch):
+    images_path, corrupt_image, stuck_image = pathological_images
+    quarantine_path = os.path.join(images_path, 'quarantine.tsv')
+    img_hash = ImageToHash.img_hash
+
+    def slow_img_hash(image_path, hash_size=8, hash_algo='phash'):
+        if image_path == stuck_image:
+            time.sleep(60)
+        return img_hash(image_path, hash_size, hash_algo)
+
+    monkeypatch.setattr(ImageToHash, 'img_hash', staticmethod(slow_img_hash))
+
+    image_to_hash = ImageToHash(images_path, hash_size=8, hash_algo='phash', image_timeout=0.5,
+                                quarantine_path=quarantine_path)
+    df_dataset, img_file_list = image_to_hash.build_dataset(parallel=False)
+
+    assert len(img_file_list) == 33
+    assert len(df_dataset) == 31
+    assert [image for image, _ in image_to_hash.quarantined] == [corrupt_image, stuck_image]
+    assert image_to_hash.quarantined[1][1].startswith('TimeoutError')
+
+    # The next runs skip the quarantined images.
+    assert len(ImageToHash(images_path, quarantine_path=quarantine_path).img_file_list) == 31
+
+
+def test_stuck_worker_is_replaced(pathological_images, monkeypatch):
+    images_path, corrupt_image, stuck_image = pathological_images
+    img_hash = ImageToHash.img_hash
+
+    def stuck_img_hash(image_path, hash_size=8, hash_algo='phash'):
+        if image_path == stuck_image:
+            # Like native code, ignore the alarm.
+            signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+            time.sleep(60)
+        return img_hash(image_path, hash_size, hash_algo)
+
+    monkeypatch.setattr(ImageToHash, 'img_hash', staticmethod(stuck_img_hash))
+    monkeypatch.setattr(image_to_hash_module, 'WATCHDOG_GRACE_SECONDS', 1)
+
+    image_to_hash = ImageToHash(images_path, hash_size=8, hash_algo='phash', image_timeout=0.2)
+    df_dataset, img_file_list = image_to_hash.build_dataset(parallel=True, batch_size=8, workers=2)
+
+    assert len(df_dataset) == 31
+    assert list(df_dataset.files) == [image for image in img_file_list if image not in [corrupt_image, stuck_image]]
+    assert sorted(image for image, _ in image_to_hash.quarantined) == sorted([corrupt_image, stuck_image])
+
+
+def test_dead_worker_is_replaced(pathological_images, monkeypatch):
+    images_path, corrupt_image, crash_image = pathological_images
+    img_hash = ImageToHash.img_hash
+
+    def crashing_img_hash(image_path, hash_size=8, hash_algo='phash'):
+        if image_path == crash_image:
+            # Like the OOM killer.
+            os.kill(os.getpid(), signal.SIGKILL)
+        return img_hash(image_path, hash_size, hash_algo)
+
+    monkeypatch.setattr(ImageToHash, 'img_hash', staticmethod(crashing_img_hash))
+
+    # Without image_timeout the batch of the dead worker is detected all the same.
+    image_to_hash = ImageToHash(images_path, hash_size=8, hash_algo='phash')
+    df_dataset, img_file_list = image_to_hash.build_dataset(parallel=True, batch_size=8, workers=2)
+
+    assert len(df_dataset) == 31
+    assert sorted(image for image, _ in image_to_hash.quarantined) == sorted([corrupt_image, crash_image])
+
+
+def test_worker_dead_before_reporting_is_replaced(pathological_images, monkeypatch):
+    images_path, corrupt_image, crash_image = pathological_images
+    multiprocessing_img_hash = ImageToHash.multiprocessing_img_hash
+
+    def crashing_multiprocessing_img_hash(self, block, batch_id=None):
+        if crash_image in [image for _, image in block]:
+            # Killed before it reports the batch it runs.
+            os.kill(os.getpid(), signal.SIGKILL)
+        return multiprocessing_img_hash(self, block, batch_id)
+
+    # The bound method is sent to the workers by name.
+    crashing_multiprocessing_img_hash.__name__ = 'multiprocessing_img_hash'
+    monkeypatch.setattr(ImageToHash, 'multiprocessing_img_hash', crashing_multiprocessing_img_hash)
+    monkeypatch.setattr(image_to_hash_module, 'WATCHDOG_GRACE_SECONDS', 1)
+
+    image_to_hash = ImageToHash(images_path, hash_size=8, hash_algo='phash')
+    df_dataset, img_file_list = image_to_hash.build_dataset(parallel=True, batch_size=8, workers=2)
+
+    assert len(df_dataset) == 31
+    assert sorted(image for image, _ in image_to_hash.quarantined) == sorted([corrupt_image, crash_image])
+
+
+def test_hash_dataset(build_potato_multi_folder_dataset):
+    dataset, img_file_list = build_potato_multi_folder_dataset
+
+    assert isinstance(dataset, HashDataset)
+    assert dataset.hashes.dtype == np.uint8 and dataset.hashes.flags['C_CONTIGUOUS']
+    assert dataset.hashes.shape == (len(img_file_list), 16)
+    assert dataset.files_at([0, 1]) == img_file_list[:2]
+    assert dataset.index_of(img_file_list[3]) == 3
+    assert HashDataset.digits_to_hex(dataset.hashes[0]) == str(dataset.hash(0))
+
+    df_dataset = dataset.to_pandas()
+    assert list(df_dataset.columns[:4]) == ['file', 'short_file', 'hash', 'hash_list']
+    assert np.shares_memory(df_dataset['0'].values, dataset.hashes)
+    assert [int(digit, 16) for digit in df_dataset.at[0, 'hash_list']] == list(dataset.hashes[0])
+
+    round_trip = HashDataset.from_pandas(df_dataset)
+    assert np.array_equal(round_trip.hashes, dataset.hashes)
+    assert round_trip.files == dataset.files
+
+
+def test_path_table(build_potato_multi_folder_dataset):
+    dataset, img_file_list = build_potato_multi_folder_dataset
+    paths = list(img_file_list) + ['relative.png', os.path.join('/tmp', 'caf\xe9 \udcff.png')]
+    table = PathTable.from_paths(paths)
+
+    assert len(table) == len(paths)
+    assert list(table) == paths and table == paths
+    assert table[-1] == paths[-1] and table[2:5] == paths[2:5]
+    assert table.name(0) == paths[0].split(os.sep)[-1]
+    assert table.index_of(paths[7]) == 7 and table.index_of('/not/there.png') is None
+    assert table.take([5, 0, 5]) == [paths[5], paths[0], paths[5]]
+    # The directories are stored once.
+    assert len(table.directories) == len(set(os.path.dirname(path) for path in paths))
+    assert table.nbytes() < sum(len(path) for path in paths)
+    assert dataset.files_at([1, 0]) == [img_file_list[1], img_file_list[0]]
+    # The first occurrence of a repeated path, every path is found by the index.
+    repeated = PathTable.from_paths(paths + paths[:3])
+    assert [repeated.index_of(path) for path in paths] == list(range(0, len(paths)))
+
+    # The table is built while the directories are walked, in natural order.
+    walked = ImageToHash.get_images_table(POTATOES_MULTI_FOLDER_BASE_PATH)
+    assert walked == ImageToHash.get_images_list(POTATOES_MULTI_FOLDER_BASE_PATH)
+
+
+def test_images_table_order(tmpdir):
+    # The images of a directory and of its subdirectories are interleaved in the natural order of the full paths.
+    for name in ['a.png', 'z.png', 'sub/b.png', 'sub.png', 'img10.png', 'img2/c.png', 'img2.png', 'v10/d.png',
+                 'v9/d.png', 'sub-x/e.png']:
+        os.makedirs(os.path.dirname(os.path.join(str(tmpdir), name)), exist_ok=True)
+        open(os.path.join(str(tmpdir), name), 'w').close()
+    walked = ImageToHash.get_images_table(str(tmpdir))
+    assert walked == ImageToHash.get_images_list(str(tmpdir))
+    assert [os.path.relpath(image, str(tmpdir)) for image in walked][:3] == ['a.png', 'img2.png', 'img2/c.png']
+
+
+def test_save_and_load_dataset(build_potato_multi_folder_dataset, tmpdir):
+    dataset, img_file_list = build_potato_multi_folder_dataset
+    dataset_path = os.path.join(str(tmpdir), 'dataset')
+    dataset.save(dataset_path)
+    # Saving again replaces the dataset.
+    dataset.save(dataset_path)
+
+    # The hashes are packed two digits per byte.
+    assert np.load(os.path.join(dataset_path, 'hashes.npy')).shape == (len(dataset), -(-dataset.hash_length // 2))
+
+    loaded = HashDataset.load(dataset_path)
+    assert isinstance(loaded.metadata['file_size'], np.memmap)
+    assert np.array_equal(loaded.hashes, dataset.hashes)
+    assert loaded.files == img_file_list
+    assert loaded.index_of(img_file_list[5]) == 5
+    assert np.array_equal(loaded.metadata['file_size'], dataset.metadata['file_size'])
+    assert (loaded.hash_size, loaded.hash_algo) == (dataset.hash_size, dataset.hash_algo)
+
+    # The finders open the saved dataset directly.
+    distances, _ = KDTreeFinder(dataset_path, distance_metric='manhattan')._find_all(5)
+    expected_distances, _ = KDTreeFinder(dataset, distance_metric='manhattan')._find_all(5)
+    assert np.array_equal(distances, expected_distances)
+
+    with pytest.raises(ValueError):
+        HashDataset.load(str(tmpdir))
+
+    # An odd number of digits.
+    odd = HashDataset(np.random.RandomState(0).randint(0, 16, (3, 5)), ['a.png', 'b.png', 'c.png'])
+    odd.save(os.path.join(str(tmpdir), 'odd'))
+    assert np.load(os.path.join(str(tmpdir), 'odd', 'hashes.npy')).shape == (3, 3)
+    assert np.array_equal(HashDataset.load(os.path.join(str(tmpdir), 'odd')).hashes, odd.hashes)
+
+    # A directory which isn't a saved dataset is never replaced.
+    other_path = os.path.join(str(tmpdir), 'other')
+    os.makedirs(other_path)
+    open(os.path.join(other_path, 'notes.txt'), 'w').close()
+    with pytest.raises(ValueError):
+        dataset.save(other_path)
+    assert os.listdir(other_path) == ['notes.txt']
+    os.rename(other_path, dataset_path + '.tmp')
+    with pytest.raises(ValueError):
+        dataset.save(dataset_path)
+    assert os.listdir(dataset_path + '.tmp') == ['notes.txt']
+
+
+def test_work_queue(tmpdir):
+    queue_path = os.path.join(str(tmpdir), 'queue')
+    dataset, img_file_list = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8,
+                                         hash_algo='phash').build_dataset(parallel=False)
+    work_queue = enqueue(POTATOES_MULTI_FOLDER_BASE_PATH, queue_path, hash_size=8, hash_algo='phash', batch_size=5)
+    assert work_queue.status() == {'pending': 7, 'leased': 0, 'expired': 0, 'done': 0}
+
+    # A worker that dies after claiming a batch: its lease expires and the batch is claimed again.
+    assert work_queue.claim('dead-worker', lease_seconds=0.5)[0] == 0
+    with pytest.raises(ValueError):
+        work_queue.merge()
+
+    workers = [multiprocessing.Process(target=worker, args=(queue_path, 'worker-{}'.format(i)),
+                                       kwargs={'lease_seconds': 30, 'poll_interval': 0.2}) for i in range(0, 2)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+    assert work_queue.status()['done'] == 7
+    # The shards store two hexadecimal digits per byte.
+    with np.load(work_queue.shard_path(1)) as shard:
+        assert shard['hashes'].shape == (5, 8)
+    # The dead worker can't complete the batch anymore.
+    assert not work_queue.complete(0, 'dead-worker', dataset.hashes[:5], range(0, 5), [0] * 5)
+
+    merged = merge(queue_path, os.path.join(str(tmpdir), 'dataset'))
+    assert merged.files == img_file_list
+    assert np.array_equal(merged.hashes, dataset.hashes)
+    assert np.array_equal(HashDataset.load(os.path.join(str(tmpdir), 'dataset')).hashes, dataset.hashes)
+
+
+@pytest.mark.parametrize('extension', ['parquet', 'arrow'])
+def test_export_dataset(tmpdir, extension):
+    pa = pytest.importorskip('pyarrow')
+    dataset, _ = ImageToHash(POTATOES_MULTI_FOLDER_BASE_PATH, hash_size=8).build_dataset(parallel=False)
+    export_path = os.path.join(str(tmpdir), 'dataset.' + extension)
+    ArrowUtils.write_dataset(dataset, export_path)
+
+    table = ArrowUtils.read_table(export_path)
+    assert pa.types.is_dictionary(table.schema.field('directory').type)
+    assert table.schema.field('hash').type == pa.binary(8)
+    assert table.schema.metadata[b'hash_algo'] == b'phash'
+    exported = ArrowUtils.read_dataset(export_path)
+    assert exported.files == dataset.files
+    assert np.array_equal(exported.hashes, dataset.hashes)
+    for name, values in dataset.metadata.items():
+        assert np.array_equal(exported.metadata[name], values, equal_nan=values.dtype.kind == 'f')
+
+    # The names and the directories that aren't valid UTF-8 keep their bytes.
+    for files in [['/images/' + os.fsdecode(b'caf\xe9.png'), '/images/other/b.png'],
+                  ['/images/' + os.fsdecode(b'caf\xe9') + '/a.png', '/images/other/b.png']]:
+        dataset = HashDataset(dataset.hashes[:2], files)
+        ArrowUtils.write_dataset(dataset, export_path)
+        assert ArrowUtils.read_dataset(export_path).files == dataset.files
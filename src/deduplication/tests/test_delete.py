@@ -1,8 +1,29 @@
+import csv
+import json
 import os
+from collections import Counter
 
+import numpy as np
 import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 
 from commands.delete import delete
+from deduplication.commands.helpers import keep_order, link_targets
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.duplicatefinder.CollectionJoin import CollectionJoin
+from deduplication.duplicatefinder.ExternalSortFinder import ExternalSortFinder
+from deduplication.duplicatefinder.GroupWriter import GroupWriter
+from deduplication.duplicatefinder.GroupedFinder import GroupedFinder
+from deduplication.duplicatefinder.KDTreeFinder import KDTreeFinder
+from deduplication.duplicatefinder.NearDuplicateImageFinder import NearDuplicateImageFinder
+from deduplication.duplicatefinder.PartitionedFinder import PartitionedFinder
+from deduplication.duplicatefinder.ShardedFinder import ShardedFinder
+from deduplication.duplicatefinder import SingleLinkageFinder as single_linkage_module
+from deduplication.duplicatefinder.SingleLinkageFinder import SingleLinkageFinder
+from deduplication.duplicatefinder.WindowedFinder import WindowedFinder
+from deduplication.duplicatefinder.cKDTreeFinder import cKDTreeFinder
+from deduplication.utils.ArrowUtils import ArrowUtils
 from tests.conftest import mkdir_output, PROJECT_DIR
 
 
@@ -68,3 +89,362 @@ def test_delete_multi_folder(build_potato_multi_folder_dataset, tree_type, hash_
     # delete_output(output_path)
 
     print()
+
+
+@pytest.mark.parametrize('prefix_length', [None, 2])
+def test_external_sort_finder(build_potato_dataset, prefix_length, tmpdir):
+    df_dataset, img_file_list = build_potato_dataset
+
+    # A tiny memory budget spills many runs.
+    finder = ExternalSortFinder(df_dataset, distance_metric='manhattan', memory_budget=1024,
+                                prefix_length=prefix_length, tmp_dir=str(tmpdir))
+    assert len(finder.runs) > 1
+
+    hex_hashes = [HashDataset.digits_to_hex(digits) for digits in finder.dataset.hashes]
+    expected = {}
+    for i, hex_hash in enumerate(hex_hashes):
+        expected.setdefault(hex_hash[:prefix_length], []).append(i)
+    expected = sorted(group for group in expected.values() if len(group) > 1)
+
+    assert sorted(group.tolist() for group in finder.groups()) == expected
+    finder.close()
+    assert os.listdir(str(tmpdir)) == []
+
+    to_keep, to_remove, _ = ExternalSortFinder(df_dataset, memory_budget=1024, prefix_length=prefix_length,
+                                               tmp_dir=str(tmpdir)).find_all_near_duplicates(threshold=0)
+    # With threshold 0 only the identical hashes are duplicates: one image is kept for each hash.
+    counts = Counter(hex_hashes)
+    assert len(to_keep) == sum(1 for count in counts.values() if count > 1)
+    assert len(to_remove) == len(hex_hashes) - len(counts)
+
+    # The keep/remove decisions, streamed group by group and tile by tile, are the ones of the pairs of each group.
+    finder = ExternalSortFinder(df_dataset, memory_budget=1024, prefix_length=prefix_length, tmp_dir=str(tmpdir))
+    assert finder.tile_size() < max(len(group) for group in expected)
+    hashes = finder.dataset.hashes.astype(int)
+    distances = np.abs(hashes[:, np.newaxis] - hashes).sum(axis=2)
+    pairs = [(i, j) for group in expected for i in group for j in group if i < j and distances[i, j] <= 10]
+    expected_keep, expected_remove, _ = NearDuplicateImageFinder.select_duplicates(pairs)
+    to_keep, to_remove, _ = finder.find_all_near_duplicates(threshold=10)
+    assert sorted(to_keep) == sorted(finder.dataset.files_at(expected_keep))
+    assert sorted(to_remove) == sorted(finder.dataset.files_at(expected_remove))
+
+    # The single queries scan every image.
+    finder = ExternalSortFinder(df_dataset, memory_budget=1024, prefix_length=prefix_length, tmp_dir=str(tmpdir))
+    try:
+        query_distances, query_indices = finder._find(3, nearest_neighbors=4)
+        assert np.array_equal(query_distances[0], np.sort(distances[3])[:4])
+        assert np.array_equal(distances[3][query_indices[0]], query_distances[0])
+        all_distances, all_indices = finder._find_all(3)
+        assert np.array_equal(all_indices[:, 0], np.arange(0, len(hashes)))
+    finally:
+        finder.close()
+
+
+@pytest.mark.parametrize('tree_type', ['KDTree', 'cKDTree'])
+def test_sharded_finder(build_potato_multi_folder_dataset, tree_type):
+    df_dataset, img_file_list = build_potato_multi_folder_dataset
+    finder = KDTreeFinder(df_dataset, distance_metric='manhattan') if tree_type == 'KDTree' else \
+        cKDTreeFinder(df_dataset, distance_metric='manhattan')
+    sharded_finder = ShardedFinder(df_dataset, tree_type=tree_type, distance_metric='manhattan', workers=2, shards=3)
+    try:
+        assert len(sharded_finder.trees) == 3
+        expected_distances, _ = finder._find_all(5, threshold=40)
+        distances, indices = sharded_finder._find_all(5, threshold=40)
+        assert np.array_equal(distances, expected_distances)
+        # The first neighbor is the image itself.
+        assert np.array_equal(indices[:, 0], np.arange(0, len(img_file_list)))
+
+        expected_keep, expected_remove, _ = finder.find_all_near_duplicates(5, 40)
+        to_keep, to_remove, _ = sharded_finder.find_all_near_duplicates(5, 40)
+        assert (len(to_keep), len(to_remove)) == (len(expected_keep), len(expected_remove))
+
+        within_radius = sharded_finder.find_within_radius(10)
+        brute_force = np.abs(finder.dataset.hashes[:, np.newaxis].astype(int) - finder.dataset.hashes).sum(axis=2)
+        for i, (neighbor_distances, neighbors) in enumerate(within_radius):
+            assert sorted(neighbors.tolist()) == np.flatnonzero(brute_force[i] <= 10).tolist()
+            assert np.array_equal(neighbor_distances, brute_force[i][neighbors])
+    finally:
+        sharded_finder.close()
+
+
+def test_partitioned_finder(build_potato_dataset, tmpdir):
+    df_dataset, img_file_list = build_potato_dataset
+    shards_path = os.path.join(str(tmpdir), 'shards')
+    finder = PartitionedFinder(shards_path, distance_metric='manhattan')
+
+    # The partition only depends on the paths.
+    assert np.array_equal(PartitionedFinder.partition(img_file_list, 3),
+                          PartitionedFinder.partition(list(reversed(img_file_list)), 3)[::-1])
+    for shard_id in range(0, 3):
+        finder.map_shard(df_dataset, 3, shard_id, threshold=10)
+    # The reduce must use the settings of the map.
+    with pytest.raises(ValueError):
+        finder.reduce_shards(threshold=12)
+    to_keep, to_remove, _ = finder.reduce_shards(threshold=10)
+
+    # The same result of a single run that compares every image with all the others.
+    expected_keep, expected_remove, _ = KDTreeFinder(df_dataset, distance_metric='manhattan') \
+        .find_all_near_duplicates(nearest_neighbors=len(img_file_list), threshold=10)
+    assert sorted(to_keep) == sorted(expected_keep)
+    assert sorted(to_remove) == sorted(expected_remove)
+
+    # The keep order is computed from the metadata of the shards.
+    dataset = finder.dataset(threshold=10)
+    assert dataset.files == img_file_list and np.array_equal(dataset.hashes, HashDataset.wrap(df_dataset).hashes)
+    keep_ranks = np.argsort(keep_order(dataset, 'largest'))
+    first_keep = to_keep
+    to_keep, to_remove, _ = finder.reduce_shards(threshold=10, keep_ranks=keep_ranks)
+    assert sorted(to_keep) != sorted(first_keep)
+    kd_tree_finder = KDTreeFinder(df_dataset, distance_metric='manhattan')
+    kd_tree_finder.keep_ranks = keep_ranks
+    expected_keep, expected_remove, _ = kd_tree_finder.find_all_near_duplicates(len(img_file_list), threshold=10)
+    assert sorted(to_keep) == sorted(expected_keep)
+    assert sorted(to_remove) == sorted(expected_remove)
+
+
+@pytest.mark.parametrize('tree_type', ['KDTree', 'cKDTree'])
+def test_grouped_finder(build_potato_multi_folder_dataset, tree_type):
+    df_dataset, img_file_list = build_potato_multi_folder_dataset
+    dataset = HashDataset.wrap(df_dataset)
+
+    groups, group_names = dataset.files.groups(1)
+    assert sorted(group_names) == ['v1', 'v2']
+    assert [group_names[g] for g in groups] == [os.path.basename(os.path.dirname(f)) for f in img_file_list]
+
+    to_keep, to_remove, _ = GroupedFinder(df_dataset, tree_type=tree_type, distance_metric='manhattan') \
+        .find_all_near_duplicates(nearest_neighbors=len(img_file_list), threshold=10)
+
+    # The pairs of near duplicates of different groups only.
+    distances = np.abs(dataset.hashes[:, None, :].astype(np.int64) -
+                       dataset.hashes[None, :, :].astype(np.int64)).sum(axis=2)
+    # The distance_upper_bound of a cKDTree excludes the threshold, as with cKDTreeFinder.
+    within = distances < 10 if tree_type == 'cKDTree' else distances <= 10
+    pairs = [(i, j) for i, j in np.argwhere(within) if i < j and groups[i] != groups[j]]
+    assert len(pairs) > 0
+    keep, remove, _ = NearDuplicateImageFinder.select_duplicates(pairs)
+    assert sorted(to_keep) == sorted(dataset.files_at(keep))
+    assert sorted(to_remove) == sorted(dataset.files_at(remove))
+
+
+@pytest.mark.parametrize('window_size', [3, 1000])
+def test_windowed_finder(build_potato_dataset, window_size):
+    df_dataset, img_file_list = build_potato_dataset
+    dataset = HashDataset.wrap(df_dataset)
+
+    to_keep, to_remove, dict_image_to_duplicates = WindowedFinder(df_dataset, window_size=window_size) \
+        .find_all_near_duplicates(threshold=10)
+
+    # The same choices of select_duplicates() on the pairs within the window.
+    distances = np.abs(dataset.hashes[:, None, :].astype(np.int64) -
+                       dataset.hashes[None, :, :].astype(np.int64)).sum(axis=2)
+    pairs = [(i, j) for i, j in np.argwhere(distances <= 10) if i < j < i + window_size]
+    keep, remove, _ = NearDuplicateImageFinder.select_duplicates(pairs)
+    assert sorted(to_keep) == sorted(dataset.files_at(keep))
+    assert sorted(to_remove) == sorted(dataset.files_at(remove))
+    assert set(dict_image_to_duplicates.keys()) <= set(keep)
+    assert {j for duplicates in dict_image_to_duplicates.values() for j in duplicates} <= set(remove)
+
+
+def test_windowed_finder_seconds(build_potato_dataset):
+    df_dataset, _ = build_potato_dataset
+    timestamp_format = '%Y-%m-%d-%H-%M-%S'
+    assert WindowedFinder.parse_timestamp('/a/2018-12-11-15-03-11.png', timestamp_format) - \
+        WindowedFinder.parse_timestamp('/a/2018-12-11-15-02-58.png', timestamp_format) == 13
+
+    # The images captured every 2 seconds, in a shuffled order.
+    dataset = HashDataset.wrap(df_dataset)
+    seconds = np.random.RandomState(0).permutation(len(dataset)) * 2
+    captures = HashDataset(dataset.hashes, ['/captures/2020-01-01-{:02d}-{:02d}-{:02d}.png'.format(
+        s // 3600, s // 60 % 60, s % 60) for s in seconds], hash_size=dataset.hash_size, hash_algo=dataset.hash_algo)
+
+    with pytest.raises(ValueError):
+        WindowedFinder(captures, window_seconds=5)
+    finder = WindowedFinder(captures, window_seconds=5, timestamp_format=timestamp_format)
+    assert np.array_equal(finder.order, np.argsort(seconds))
+    to_keep, to_remove, _ = finder.find_all_near_duplicates(threshold=10)
+
+    # The pairs captured at most 5 seconds apart, in the order of the captures.
+    distances = np.abs(dataset.hashes[:, None, :].astype(np.int64) -
+                       dataset.hashes[None, :, :].astype(np.int64)).sum(axis=2)
+    pairs = [(seconds[i] // 2, seconds[j] // 2) for i, j in np.argwhere(distances <= 10)
+             if 0 < seconds[j] - seconds[i] <= 5]
+    keep, remove, _ = NearDuplicateImageFinder.select_duplicates(pairs)
+    assert len(remove) > 0
+    assert sorted(to_keep) == sorted(captures.files_at(finder.order[keep]))
+    assert sorted(to_remove) == sorted(captures.files_at(finder.order[remove]))
+
+
+@pytest.mark.parametrize('keep_policy, expected', [('first', 0), ('largest', 1), ('newest', 2), ('oldest', 1),
+                                                   ('highest-resolution', 3), ('sharpest', 0),
+                                                   ('path-priority', 2)])
+def test_keep_policy(keep_policy, expected):
+    files = ['/images/thumbs/a.png', '/images/originals/a.png', '/images/master/a.png', '/images/thumbs/b.png',
+             '/images/thumbs/c.png']
+    hashes = np.zeros((5, 16), dtype=np.uint8)
+    hashes[4] = 15
+    dataset = HashDataset(hashes, files, metadata={
+        'file_size': np.array([10, 900, 500, 800, 10]), 'width': np.array([100, 400, 400, 800, 10]),
+        'height': np.array([100, 300, 300, 600, 10]), 'mtime': np.array([5.0, 1.0, 9.0, 2.0, 1.0]),
+        'exif_time': np.array([np.nan, 0.5, np.nan, np.nan, np.nan]),
+        'sharpness': np.array([7.0, 7.0, 1.0, np.nan, 0.0]), 'jpeg_quality': np.array([90, 60, 0, 0, 0])})
+
+    # The finders visit the images in the keep order, the dataset isn't reordered.
+    keep_ranks = np.argsort(keep_order(dataset, keep_policy, ['/images/master', '/images/originals']))
+    for finder in [KDTreeFinder(dataset, distance_metric='manhattan'), ExternalSortFinder(dataset, prefix_length=2),
+                   SingleLinkageFinder(dataset, max_radius=0)]:
+        finder.keep_ranks = keep_ranks
+        to_keep, to_remove, _ = finder.find_all_near_duplicates(4, 0)
+        assert list(to_keep) == [files[expected]]
+        assert sorted(to_remove) == sorted(files[i] for i in range(0, 4) if i != expected)
+
+
+def test_keep_policy_dataframe(build_potato_dataset):
+    output_path = mkdir_output(os.path.join(str(PROJECT_DIR), "outputs"))
+    df_dataset, img_file_list = build_potato_dataset
+    priority_paths = [os.path.dirname(img_file_list[0])]
+
+    # A Pandas DataFrame of the previous versions.
+    to_keep, to_remove = delete(df_dataset.to_pandas(), img_file_list, output_path, 8, 'KDTree', 'manhattan', 5, 40,
+                                False, 32, 10, False, False, True, keep_policy='path-priority',
+                                priority_paths=priority_paths)
+    expected_keep, expected_remove = delete(df_dataset, img_file_list, output_path, 8, 'KDTree', 'manhattan', 5, 40,
+                                            False, 32, 10, False, False, True)
+    assert (list(to_keep), list(to_remove)) == (list(expected_keep), list(expected_remove))
+
+
+def test_keep_policy_requires_metadata():
+    dataset = HashDataset(np.zeros((2, 16), dtype=np.uint8), ['a.png', 'b.png'])
+    with pytest.raises(ValueError):
+        keep_order(dataset, 'largest')
+    # The images have been hashed without the quality score.
+    dataset.metadata.update(sharpness=np.full(2, np.nan), jpeg_quality=np.zeros(2), file_size=np.ones(2))
+    with pytest.raises(ValueError):
+        keep_order(dataset, 'sharpest')
+
+
+@pytest.mark.parametrize('finder_args', [{}, {'memory_budget': 1 << 20, 'prefix_length': 2}, {'window_size': 3},
+                                         {'max_radius': 20}])
+@pytest.mark.parametrize('group_format', ['jsonl', 'csv', 'parquet'])
+def test_group_stream(build_potato_dataset, finder_args, group_format):
+    if group_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    output_path = mkdir_output(os.path.join(str(PROJECT_DIR), "outputs"))
+    df_dataset, img_file_list = build_potato_dataset
+
+    to_keep, to_remove = delete(df_dataset, img_file_list, output_path, 8, 'KDTree', 'manhattan', 5, 40, False, 32,
+                                10, False, False, True, group_format=group_format, **finder_args)
+
+    groups_path = os.path.join(output_path, 'duplicate_groups_8_dist_10.' + group_format)
+    if group_format == 'parquet':
+        columns = ArrowUtils.read_table(groups_path).to_pydict()
+        rows = [(group, os.path.join(*keep), os.path.join(*remove), distance) for group, keep, remove, distance in
+                zip(columns['group'], zip(columns['keep_directory'], columns['keep_name']),
+                    zip(columns['remove_directory'], columns['remove_name']), columns['distance'])]
+    else:
+        with open(groups_path, newline='') as f:
+            if group_format == 'jsonl':
+                rows = [(row['group'], row['keep'], remove, distance) for row in map(json.loads, f)
+                        for remove, distance in zip(row['remove'], row['distances'])]
+            else:
+                rows = [(int(row['group']), row['keep'], row['remove'], float(row['distance']))
+                        for row in csv.DictReader(f)]
+
+    # Every image removed is streamed once, in the group of an image kept.
+    assert sorted(row[2] for row in rows) == sorted(to_remove)
+    assert {row[1] for row in rows} == set(to_keep)
+    assert len({(row[0], row[1]) for row in rows}) == len({row[0] for row in rows}) == len(to_keep)
+    assert all(row[3] >= 0 for row in rows)
+
+
+def test_link_targets():
+    # 0 - 1 - 2 is a chain: 2 is farther than the threshold from 0, its group keeps 0 all the same.
+    hashes = np.zeros((4, 16), dtype=np.uint8)
+    hashes[1, :2] = 15
+    hashes[2, :4] = 15
+    hashes[3] = 15
+    dataset = HashDataset(hashes, ['a.png', 'b.png', 'c.png', 'd.png'], metadata={
+        'file_size': np.array([10, 20, 30, 40]), 'mtime': np.array([1.5, np.nan, 3.0, 4.0])})
+    finder = KDTreeFinder(dataset, distance_metric='manhattan')
+    with GroupWriter(None, finder.dataset, keep_targets=True) as group_writer:
+        finder.group_writer = group_writer
+        to_keep, to_remove, _ = finder.find_all_near_duplicates(4, 30)
+    assert (list(to_keep), sorted(to_remove)) == (['a.png'], ['b.png', 'c.png'])
+    targets, file_stats = link_targets(finder.dataset, group_writer.kept_in_place, to_remove)
+    assert targets == ['a.png', 'a.png']
+    assert file_stats == {'a.png': (10, 1.5), 'b.png': (20, None), 'c.png': (30, 3.0)}
+    with pytest.raises(ValueError):
+        link_targets(finder.dataset, group_writer.kept_in_place, ['d.png'])
+
+
+@pytest.mark.parametrize('results_format', ['parquet', 'arrow'])
+def test_results_format(build_potato_dataset, results_format):
+    pytest.importorskip('pyarrow')
+    output_path = mkdir_output(os.path.join(str(PROJECT_DIR), "outputs"))
+    df_dataset, img_file_list = build_potato_dataset
+
+    to_keep, to_remove = delete(df_dataset, img_file_list, output_path, 8, 'KDTree', 'manhattan', 5, 40, False, 32,
+                                10, False, False, True, results_format=results_format)
+
+    for column, files in [('keep', to_keep), ('remove', to_remove)]:
+        table = ArrowUtils.read_table(os.path.join(output_path,
+                                                   'duplicates_{0}_8_dist_10.{1}'.format(column, results_format)))
+        assert table.column_names == [column + '_directory', column + '_name']
+        assert table.schema.metadata == {b'hash_size': b'8', b'threshold': b'10'}
+        assert [os.path.join(directory, name) for directory, name in
+                zip(*table.to_pydict().values())] == list(files)
+
+
+def test_single_linkage_finder(build_potato_dataset, tmpdir, monkeypatch):
+    df_dataset, _ = build_potato_dataset
+    dataset = HashDataset.wrap(df_dataset)
+    distances = np.abs(dataset.hashes[:, None, :].astype(np.int64) - dataset.hashes[None, :, :].astype(np.int64)).sum(
+        axis=2)
+    forest_path = os.path.join(str(tmpdir), 'forest.npz')
+    # Reduce the pairs to the forest many times.
+    monkeypatch.setattr(single_linkage_module, 'MIN_BUFFERED_EDGES', 1)
+    finder = SingleLinkageFinder(dataset, distance_metric='manhattan', batch_size=50, max_radius=30,
+                                 forest_path=forest_path)
+    assert len(finder.edges[0]) < len(dataset)
+
+    thresholds, groups, removed = finder.summary()
+    for threshold in [0, 10, 25, 30]:
+        # The groups are the connected components of all the pairs within the threshold.
+        _, labels = connected_components(csr_matrix(distances <= threshold), directed=False)
+        expected = {frozenset(np.flatnonzero(labels == label)) for label in np.unique(labels)}
+        cut = finder.cut(threshold)
+        assert {frozenset(np.flatnonzero(cut == label)) for label in np.unique(cut)} == expected
+
+        sizes = np.bincount(labels)
+        row = np.searchsorted(thresholds, threshold, side='right') - 1
+        assert (groups[row], removed[row]) == ((sizes > 1).sum(), (sizes[sizes > 1] - 1).sum())
+
+        to_keep, to_remove, _ = finder.find_all_near_duplicates(5, threshold)
+        assert len(to_keep) == (sizes > 1).sum() and len(to_remove) == (sizes[sizes > 1] - 1).sum()
+        # The first image of each group is kept.
+        assert set(to_keep) == {dataset.file(min(group)) for group in expected if len(group) > 1}
+    with pytest.raises(ValueError):
+        finder.cut(31)
+
+    # The saved forest is reused without querying the images, but not for other hashes.
+    monkeypatch.setattr(CollectionJoin, 'query', None)
+    reused = SingleLinkageFinder(dataset, distance_metric='manhattan', max_radius=10, forest_path=forest_path)
+    assert reused.max_radius == 30
+    assert all(np.array_equal(edges, reused_edges) for edges, reused_edges in zip(finder.edges, reused.edges))
+    with pytest.raises(TypeError):
+        SingleLinkageFinder(dataset.take(np.arange(1, len(dataset))), distance_metric='manhattan', max_radius=30,
+                            forest_path=forest_path)
+
+
+def test_threshold_summary(build_potato_dataset, tmpdir):
+    output_path = str(tmpdir)
+    df_dataset, img_file_list = build_potato_dataset
+    forest_path = os.path.join(output_path, 'forest.npz')
+
+    to_keep, to_remove = delete(df_dataset, img_file_list, output_path, 8, 'KDTree', 'manhattan', 5, 40, False, 32,
+                                10, False, False, True, max_radius=40, forest_path=forest_path)
+
+    with open(os.path.join(output_path, 'threshold_summary_8_radius_40.csv'), newline='') as f:
+        rows = [(float(row['threshold']), int(row['groups']), int(row['removed'])) for row in csv.DictReader(f)]
+    assert rows == sorted(rows) and rows[-1][0] <= 40
+    at_threshold = [row for row in rows if row[0] <= 10][-1]
+    assert at_threshold[1:] == (len(to_keep), len(to_remove))
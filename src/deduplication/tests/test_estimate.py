@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from deduplication.commands.estimate import estimate, ratio_estimate, sample_blocks
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.tests.conftest import POTATOES_BASE_PATH
+
+
+def test_sample_blocks():
+    positions, blocks, total_blocks = sample_blocks(103, 30, 10, np.random.RandomState(0))
+    assert total_blocks == 11
+    assert len(np.unique(blocks)) == 3 and np.array_equal(blocks, positions // 10)
+    # Whole blocks of consecutive images, the last one is shorter.
+    assert all(np.array_equal(positions[blocks == block], np.arange(block * 10, min(block * 10 + 10, 103)))
+               for block in np.unique(blocks))
+    positions, _, _ = sample_blocks(103, 1000, 10, np.random.RandomState(0))
+    assert np.array_equal(positions, np.arange(0, 103))
+
+
+def test_ratio_estimate():
+    values = np.array([1., 0., 1., 1., 0., 0.])
+    blocks = np.array([0, 0, 3, 3, 5, 5])
+    estimate_value, interval = ratio_estimate(values, blocks, 3, 10, 0.95)
+    assert estimate_value == 0.5 and interval > 0
+    # A census has no sampling error.
+    assert ratio_estimate(values, blocks, 3, 3, 0.95) == (0.5, 0)
+    assert np.isnan(ratio_estimate(values[:2], blocks[:2], 1, 10, 0.95)[1])
+
+
+def test_estimate(build_potato_dataset, tmpdir):
+    df_dataset, _ = build_potato_dataset
+    dataset = HashDataset.wrap(df_dataset)
+    distances = np.abs(dataset.hashes[:, None, :].astype(np.int64) - dataset.hashes[None, :, :].astype(np.int64)).sum(
+        axis=2)
+    near_duplicates = (distances <= 10).sum(axis=1) - 1
+    removed = near_duplicates / (near_duplicates + 1)
+
+    # With the whole collection as sample the estimates are exact.
+    results = estimate(POTATOES_BASE_PATH, threshold=10, sample_size=len(dataset), block_size=16, seed=0,
+                       output_path=str(tmpdir))
+    assert (results['images'], results['sample']) == (len(dataset), len(dataset))
+    assert results['duplicate_rate'] == pytest.approx(removed.mean())
+    assert results['duplicate_rate_interval'] == 0
+    assert results['reclaimable_bytes'] == pytest.approx((removed * dataset.metadata['file_size']).sum())
+    assert results['total_bytes'] == pytest.approx(dataset.metadata['file_size'].sum())
+    assert results['hashing_seconds'] > 0
+
+    results = estimate(POTATOES_BASE_PATH, threshold=10, sample_size=100, block_size=16, seed=0)
+    assert results['sample'] == 112 and results['blocks'] == 7
+    low, high = (results['duplicate_rate'] - results['duplicate_rate_interval'],
+                 results['duplicate_rate'] + results['duplicate_rate_interval'])
+    assert 0 <= low < high <= 1.5
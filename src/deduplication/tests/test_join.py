@@ -0,0 +1,76 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+from deduplication.commands.join import join
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.duplicatefinder.CollectionJoin import CollectionJoin
+from deduplication.utils.ArrowUtils import ArrowUtils
+
+
+def read_pairs(results_path):
+    with open(results_path, newline='') as f:
+        rows = list(csv.reader(f))
+    return rows[0], sorted((a, b, float(distance)) for a, b, distance in rows[1:])
+
+
+def brute_force_pairs(dataset_a, dataset_b, threshold, after_only=False):
+    distances = np.abs(dataset_a.hashes[:, None, :].astype(np.int64) -
+                       dataset_b.hashes[None, :, :].astype(np.int64)).sum(axis=2)
+    return sorted((dataset_a.file(a), dataset_b.file(b), float(distances[a, b]))
+                  for a, b in np.argwhere(distances <= threshold) if not after_only or b > a)
+
+
+@pytest.mark.parametrize('tree_type, a_share', [('KDTree', 3), ('cKDTree', 3), ('KDTree', 2)])
+def test_join(build_potato_dataset, tmpdir, tree_type, a_share):
+    df_dataset, _ = build_potato_dataset
+    dataset = HashDataset.wrap(df_dataset)
+    # A is the smaller collection, or the larger one with a_share == 2.
+    in_a = np.arange(0, len(dataset)) % a_share == 0
+    if a_share == 2:
+        in_a = ~in_a
+    dataset_a = dataset.take(np.flatnonzero(in_a))
+    dataset_b = dataset.take(np.flatnonzero(~in_a))
+    output_path = str(tmpdir)
+
+    count = join(dataset_a, dataset_b, output_path, tree_type, 'manhattan', 40, 7, 10, self_join=True)
+
+    columns, pairs = read_pairs(os.path.join(output_path, 'join_8_dist_10.csv'))
+    assert columns == ['a_path', 'b_path', 'distance']
+    assert count == len(pairs) > 0
+    assert pairs == brute_force_pairs(dataset_a, dataset_b, 10)
+
+    _, self_pairs = read_pairs(os.path.join(output_path, 'join_self_8_dist_10.csv'))
+    assert self_pairs == brute_force_pairs(dataset_a, dataset_a, 10, after_only=True)
+
+
+def test_join_different_hashes(build_potato_dataset):
+    df_dataset, _ = build_potato_dataset
+    dataset = HashDataset.wrap(df_dataset)
+    other = HashDataset(dataset.hashes, dataset.files, hash_size=dataset.hash_size, hash_algo='dhash')
+
+    with pytest.raises(ValueError):
+        list(CollectionJoin().join(dataset, other, 10))
+
+
+@pytest.mark.parametrize('results_format', ['parquet', 'arrow'])
+def test_join_columnar(build_potato_dataset, tmpdir, results_format):
+    pytest.importorskip('pyarrow')
+    df_dataset, _ = build_potato_dataset
+    dataset = HashDataset.wrap(df_dataset)
+    dataset_a = dataset.take(np.arange(0, len(dataset), 3))
+    output_path = str(tmpdir)
+
+    count = join(dataset_a, dataset, output_path, 'KDTree', 'manhattan', 40, 7, 10, results_format=results_format)
+
+    table = ArrowUtils.read_table(os.path.join(output_path, 'join_8_dist_10.' + results_format))
+    assert table.column_names == ['a_directory', 'a_name', 'b_directory', 'b_name', 'distance']
+    assert table.schema.metadata == {b'hash_size': b'8', b'threshold': b'10'}
+    rows = table.to_pydict()
+    pairs = sorted((os.path.join(rows['a_directory'][i], rows['a_name'][i]),
+                    os.path.join(rows['b_directory'][i], rows['b_name'][i]), rows['distance'][i])
+                   for i in range(0, table.num_rows))
+    assert count == len(pairs) > 0
+    assert pairs == brute_force_pairs(dataset_a, dataset, 10)
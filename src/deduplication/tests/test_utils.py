@@ -0,0 +1,241 @@
+import errno
+import os
+
+import pytest
+
+from deduplication.commands.helpers import backup_images, quarantine_images, QUARANTINE_MANIFEST, deletion_entries, \
+    run_journal, DELETION_JOURNAL, delete_images
+from deduplication.commands.purge import purge
+from deduplication.commands.undo import undo
+from deduplication.utils.DeletionJournal import DeletionJournal
+
+from deduplication.utils import CpuUtils as cpu_utils_module
+from deduplication.utils.CommandLine import CommandLine
+from deduplication.utils.CpuUtils import CpuUtils
+from deduplication.utils.FileSystem import FileSystem
+from deduplication.utils.RateLimiter import RateLimiter
+
+
+@pytest.mark.parametrize('cpu_max, expected', [('max 100000', None), ('150000 100000', 1.5), ('50000 100000', 0.5)])
+def test_cgroup_v2_cpu_quota(tmpdir, monkeypatch, cpu_max, expected):
+    cpu_max_path = os.path.join(str(tmpdir), 'cpu.max')
+    with open(cpu_max_path, 'w') as f:
+        f.write(cpu_max + '\n')
+    monkeypatch.setattr(cpu_utils_module, 'CGROUP_V2_CPU_MAX', [cpu_max_path])
+
+    assert CpuUtils.cgroup_cpu_quota() == expected
+    assert 1 <= CpuUtils.available_cpus() <= len(os.sched_getaffinity(0))
+
+
+def test_number_of_workers():
+    assert CpuUtils.number_of_workers(3) == 3
+    assert CpuUtils.number_of_workers() == CpuUtils.available_cpus()
+    with pytest.raises(ValueError):
+        CpuUtils.number_of_workers(0)
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(bytes_per_second=1000, files_per_second=None, burst=0.1)
+
+    # The first 100 bytes fit in the burst, the next 100 bytes must wait 0.1 seconds.
+    assert rate_limiter.acquire(100) == 0
+    assert rate_limiter.acquire(100) == pytest.approx(0.1, abs=0.02)
+    assert rate_limiter.waited == pytest.approx(0.1, abs=0.02)
+    assert RateLimiter().acquire(10 ** 9) == 0
+
+
+@pytest.mark.parametrize('size, expected', [('512', 512), ('64K', 64 * 1024), ('50M', 50 * 1024 ** 2),
+                                            ('1.5GB', int(1.5 * 1024 ** 3))])
+def test_str2size(size, expected):
+    assert CommandLine.str2size(size) == expected
+
+
+@pytest.mark.parametrize('methods, expected', [(('copy',), 'copy'), (('hardlink', 'copy'), 'hardlink')])
+def test_link_or_copy(tmpdir, methods, expected):
+    file_path = os.path.join(str(tmpdir), 'a.png')
+    with open(file_path, 'wb') as f:
+        f.write(b'0123456789')
+    dest_path = os.path.join(str(tmpdir), 'b.png')
+
+    # An existing backup is replaced.
+    for _ in range(0, 2):
+        method, copied = FileSystem.link_or_copy(file_path, dest_path, methods)
+        assert (method, copied) == (expected, 10 if expected == 'copy' else 0)
+        with open(dest_path, 'rb') as f:
+            assert f.read() == b'0123456789'
+    assert os.path.samefile(file_path, dest_path) == (expected == 'hardlink')
+
+
+def test_link_or_copy_fallback(tmpdir, monkeypatch):
+    file_path = os.path.join(str(tmpdir), 'a.png')
+    with open(file_path, 'wb') as f:
+        f.write(b'0123456789')
+
+    def cross_device_link(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(os, 'link', cross_device_link)
+
+    unsupported = set()
+    assert FileSystem.link_or_copy(file_path, os.path.join(str(tmpdir), 'b.png'), ('hardlink', 'copy'),
+                                   unsupported) == ('copy', 10)
+    assert unsupported == {'hardlink'}
+
+
+def test_backup_images(tmpdir):
+    files = []
+    for directory in ['x', 'y']:
+        os.makedirs(os.path.join(str(tmpdir), 'images', directory))
+        for name in ['a.png', 'b.png']:
+            files.append(os.path.join(str(tmpdir), 'images', directory, name))
+            with open(files[-1], 'wb') as f:
+                f.write(b'0123')
+    files.append(os.path.join(str(tmpdir), 'images', 'x', 'missing.png'))
+    output_path = os.path.join(str(tmpdir), 'output')
+
+    counts = backup_images(files, output_path, 'remove', backup_method='copy', threads=2)
+
+    assert (counts['copy'], counts['bytes'], counts['missing']) == (4, 16, 1)
+    for full_file_name in files[:-1]:
+        assert os.path.isfile(os.path.join(output_path, 'remove', full_file_name[1:]))
+
+
+def test_move_file_across_filesystems(tmpdir, monkeypatch):
+    file_path = os.path.join(str(tmpdir), 'a.png')
+    with open(file_path, 'wb') as f:
+        f.write(b'0123456789')
+
+    def cross_device_rename(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(os, 'rename', cross_device_rename)
+
+    dest_path = os.path.join(str(tmpdir), 'b.png')
+    assert FileSystem.move_file(file_path, dest_path) == ('copy', 10)
+    assert not os.path.exists(file_path)
+    with open(dest_path, 'rb') as f:
+        assert f.read() == b'0123456789'
+
+
+def test_quarantine_and_purge(tmpdir):
+    files = []
+    os.makedirs(os.path.join(str(tmpdir), 'images', 'x'))
+    for name in ['a.png', 'b.png']:
+        files.append(os.path.join(str(tmpdir), 'images', 'x', name))
+        with open(files[-1], 'wb') as f:
+            f.write(b'0123')
+    run_path = os.path.join(str(tmpdir), 'output')
+
+    counts = quarantine_images(files, run_path, threads=2)
+
+    assert (counts['rename'], counts['bytes']) == (2, 0)
+    with open(os.path.join(run_path, QUARANTINE_MANIFEST)) as f:
+        rows = [line.rstrip('\n').split(',') for line in f]
+    assert rows[0] == ['original', 'quarantined']
+    assert [original for original, _ in rows[1:]] == files
+    for original, quarantined in rows[1:]:
+        assert not os.path.exists(original) and os.path.isfile(quarantined)
+
+    # A path of the manifest outside of the quarantine isn't deleted.
+    outside = os.path.join(str(tmpdir), 'outside.png')
+    open(outside, 'wb').close()
+    with open(os.path.join(run_path, QUARANTINE_MANIFEST), 'a') as f:
+        f.write('{0},{0}\n'.format(outside))
+
+    assert purge(run_path) == (2, 8)
+    assert os.path.exists(outside)
+    assert not os.path.exists(os.path.join(run_path, 'quarantine'))
+    with pytest.raises(ValueError):
+        purge(run_path)
+
+
+def test_deletion_journal(tmpdir):
+    files = []
+    os.makedirs(os.path.join(str(tmpdir), 'images'))
+    for name in ['a.png', 'b.png', 'c.png', 'd.png']:
+        files.append(os.path.join(str(tmpdir), 'images', name))
+        with open(files[-1], 'wb') as f:
+            f.write(name.encode())
+    run_path = os.path.join(str(tmpdir), 'output')
+    backup_images(files, run_path, 'remove', backup_method='copy')
+    journal = DeletionJournal(os.path.join(run_path, DELETION_JOURNAL), sync_every=2)
+    assert journal.plan(deletion_entries(files, run_path, 'delete', 'remove')) == 4
+
+    # The process is killed after deleting the first image, while writing a record.
+    os.remove(files[0])
+    with open(journal.journal_path, 'a') as f:
+        f.write('{"op": "do')
+    counts = run_journal(run_path)
+    assert (counts['missing'], counts['delete']) == (1, 3)
+    assert not any(os.path.exists(file) for file in files)
+    intents, done, undone = journal.load()
+    assert [entry['file'] for entry in intents] == files and done == set(files) and undone == set()
+
+    counts = undo(run_path, threads=2)
+    assert counts['restored'] == 4
+    for file in files:
+        with open(file, 'rb') as f:
+            assert f.read() == os.path.basename(file).encode()
+    # The restored images aren't deleted again.
+    assert run_journal(run_path)['delete'] == 0
+    assert all(os.path.exists(file) for file in files)
+
+
+@pytest.mark.parametrize('link_method', ['hardlink', 'symlink'])
+def test_link_mode(tmpdir, link_method):
+    files = []
+    os.makedirs(os.path.join(str(tmpdir), 'images'))
+    for name in ['keep.png', 'a.png', 'b.png', 'far.png']:
+        files.append(os.path.join(str(tmpdir), 'images', name))
+        with open(files[-1], 'wb') as f:
+            f.write(name.encode() * 10)
+    run_path = os.path.join(str(tmpdir), 'output')
+    backup_images(files[1:3], run_path, 'remove', backup_method='copy')
+
+    counts = delete_images(files[1:3], run_path, 'link', 'remove', targets=[files[0], files[0]],
+                           link_method=link_method)
+    assert (counts['link'], counts['linked_bytes']) == (2, 100)
+    for file in files[1:3]:
+        assert os.path.samefile(file, files[0]) and os.path.islink(file) == (link_method == 'symlink')
+        with open(file, 'rb') as f:
+            assert f.read() == b'keep.png' * 10
+    # The other images are left in place, no temporary file is left behind.
+    assert not os.path.samefile(files[3], files[0])
+    assert sorted(os.listdir(os.path.dirname(files[0]))) == sorted(os.path.basename(file) for file in files)
+    # The links already made aren't made again.
+    assert run_journal(run_path)['link'] == 0
+
+    counts = undo(run_path)
+    assert counts['restored'] == 2
+    for file in files[1:]:
+        assert not os.path.islink(file) and not os.path.samefile(file, files[0])
+        with open(file, 'rb') as f:
+            assert f.read() == os.path.basename(file).encode() * 10
+
+
+def test_replace_with_link_checks_the_target(tmpdir):
+    file_path = os.path.join(str(tmpdir), 'a.png')
+    with open(file_path, 'wb') as f:
+        f.write(b'a')
+    with pytest.raises(OSError):
+        FileSystem.replace_with_link(os.path.join(str(tmpdir), 'missing.png'), file_path)
+    with open(file_path, 'rb') as f:
+        assert f.read() == b'a'
+    assert os.listdir(str(tmpdir)) == ['a.png']
+
+
+def test_replace_with_link_checks_the_hashed_files(tmpdir):
+    target_path, file_path = (os.path.join(str(tmpdir), name) for name in ['keep.png', 'a.png'])
+    for path in [target_path, file_path]:
+        with open(path, 'wb') as f:
+            f.write(b'image')
+    target_stat = (5, os.stat(target_path).st_mtime)
+    file_stat = (5, os.stat(file_path).st_mtime)
+
+    # The duplicate or the target has been edited since it was hashed.
+    for stats in [((6, None), target_stat), (file_stat, (5, target_stat[1] - 10))]:
+        with pytest.raises(OSError):
+            FileSystem.replace_with_link(target_path, file_path, 'hardlink', *stats)
+        assert not os.path.samefile(file_path, target_path)
+    assert sorted(os.listdir(str(tmpdir))) == ['a.png', 'keep.png']
+
+    assert FileSystem.replace_with_link(target_path, file_path, 'hardlink', (5, None), target_stat) == 5
+    assert os.path.samefile(file_path, target_path)
@@ -0,0 +1,257 @@
+import os
+
+import numpy as np
+
+from deduplication.dataset.HashDataset import HashDataset
+from deduplication.dataset.PathTable import PathTable
+
+# pyarrow is optional, it's only required by the columnar formats.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# The columnar formats, by file extension: Parquet and the Arrow IPC file format (Feather V2).
+columnar_formats = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+# The number of rows of a record batch written by a BatchWriter.
+BATCH_ROWS = 65536
+
+
+class ArrowUtils(object):
+    """
+    Columnar files of the datasets and of the results, for the jobs that load them again and again.
+
+    The paths are stored as two columns: <prefix>directory, dictionary-encoded with the directories of the PathTable,
+    and <prefix>name, built on the basenames buffer of the PathTable without copying it. Both are binary when some of
+    their values aren't valid UTF-8. The hashes are stored
+    packed, two digits per byte, see HashDataset.pack_digits(). The settings of the run (hash size, threshold, ...)
+    are stored once in the metadata of the schema instead of on every row.
+    """
+
+    @staticmethod
+    def require():
+        if pa is None:
+            raise ImportError("The parquet and arrow formats require pyarrow: pip install pyarrow")
+
+    @staticmethod
+    def format_of(path):
+        """
+        :param path: a file path ending with .parquet or .arrow.
+        :return: the columnar format of the file.
+        """
+        extension = os.path.splitext(path)[1][1:].lower()
+        if extension not in columnar_formats:
+            raise ValueError("{0} must end with one of {1}.".format(path, ', '.join('.' + extension for extension
+                                                                                  in columnar_formats)))
+        return columnar_formats[extension]
+
+    @staticmethod
+    def names_type(files):
+        """
+        :param files: a PathTable.
+        :return: the type of the names column: large_string, or large_binary when some names aren't valid UTF-8,
+        os.fsencode() keeps their bytes.
+        """
+        ArrowUtils.require()
+        names = pa.LargeStringArray.from_buffers(len(files), pa.py_buffer(np.ascontiguousarray(files.offsets)),
+                                                 pa.py_buffer(files.names))
+        try:
+            names.validate(full=True)
+        except pa.ArrowInvalid:
+            return pa.large_binary()
+        return pa.large_string()
+
+    @staticmethod
+    def directories_type(files):
+        """
+        :param files: a PathTable.
+        :return: the type of the dictionary of the directory column: string, or binary when some directories aren't
+        valid UTF-8, os.fsencode() keeps their bytes.
+        """
+        ArrowUtils.require()
+        try:
+            for directory in files.directories:
+                directory.encode('utf-8')
+        except UnicodeEncodeError:
+            return pa.binary()
+        return pa.string()
+
+    @staticmethod
+    def paths_fields(files, prefix='', names_type=None):
+        """
+        :param files: a PathTable.
+        :param prefix: the prefix of the names of the columns.
+        :param names_type: the type of the names column, see names_type().
+        :return: the fields of the columns of paths_columns().
+        """
+        ArrowUtils.require()
+        return [pa.field(prefix + 'directory', pa.dictionary(pa.int32(), ArrowUtils.directories_type(files))),
+                pa.field(prefix + 'name', names_type or ArrowUtils.names_type(files))]
+
+    @staticmethod
+    def paths_columns(files, indices=None, prefix='', names_type=None):
+        """
+        The columns of some paths of a PathTable.
+        :param files: a PathTable, or the paths.
+        :param indices: the positions of the paths, all the paths by default.
+        :param prefix: the prefix of the names of the columns.
+        :param names_type: the type of the names column, by default the type of the selected names, see names_type().
+        :return: a dict name -> pyarrow Array, the directories are always the whole dictionary of the table so the
+        batches of a file share it.
+        """
+        ArrowUtils.require()
+        files = PathTable.from_paths(files)
+        selected = files if indices is None else files.take(indices)
+        directory_ids = np.asarray(selected.directory_ids).astype(np.int32)
+        directories_type = ArrowUtils.directories_type(files)
+        dictionary = files.directories if directories_type == pa.string() else \
+            [os.fsencode(directory) for directory in files.directories]
+        directories = pa.DictionaryArray.from_arrays(pa.array(directory_ids),
+                                                     pa.array(dictionary, type=directories_type))
+        names_type = names_type or ArrowUtils.names_type(selected)
+        # The names are the buffer of the table, without a copy.
+        names = pa.Array.from_buffers(names_type, len(selected),
+                                      [None, pa.py_buffer(np.ascontiguousarray(selected.offsets, dtype=np.int64)),
+                                       pa.py_buffer(selected.names)])
+        return {prefix + 'directory': directories, prefix + 'name': names}
+
+    @staticmethod
+    def hash_column(hashes):
+        """
+        :param hashes: a uint8 matrix N x L of hexadecimal digits.
+        :return: a pyarrow FixedSizeBinaryArray of the packed hashes, ceil(L / 2) bytes each.
+        """
+        ArrowUtils.require()
+        packed = np.ascontiguousarray(HashDataset.pack_digits(hashes))
+        return pa.FixedSizeBinaryArray.from_buffers(pa.binary(packed.shape[1]), len(packed),
+                                                    [None, pa.py_buffer(packed)])
+
+    @staticmethod
+    def dataset_table(dataset, columns=None):
+        """
+        :param dataset: a HashDataset.
+        :param columns: more columns, a dict name -> array of one value for each image.
+        :return: a pyarrow Table with the paths, the packed hashes and the metadata of the dataset.
+        """
+        ArrowUtils.require()
+        table_columns = ArrowUtils.paths_columns(dataset.files)
+        table_columns['hash'] = ArrowUtils.hash_column(dataset.hashes)
+        for name, values in list(dataset.metadata.items()) + list((columns or {}).items()):
+            table_columns[name] = pa.array(np.asarray(values))
+        return ArrowUtils.table(table_columns, {'hash_size': dataset.hash_size, 'hash_algo': dataset.hash_algo,
+                                                'hash_length': dataset.hash_length})
+
+    @staticmethod
+    def table(columns, metadata=None):
+        """
+        :param columns: a dict name -> pyarrow Array.
+        :param metadata: the settings stored in the metadata of the schema, their values are written as strings.
+        :return: a pyarrow Table.
+        """
+        ArrowUtils.require()
+        table = pa.table(columns)
+        if metadata:
+            table = table.replace_schema_metadata({str(key): str(value) for key, value in metadata.items()})
+        return table
+
+    @staticmethod
+    def write_table(table, path, output_format=None):
+        """
+        Write a table into a file, aside first and renamed at the end.
+        :param table: a pyarrow Table.
+        :param path: the file.
+        :param output_format: 'parquet' or 'arrow', by default the format of the extension of path.
+        """
+        output_format = output_format or ArrowUtils.format_of(path)
+        tmp_path = path + '.tmp'
+        with BatchWriter(tmp_path, table.schema, output_format) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def write_dataset(dataset, path):
+        """
+        Export a dataset into a Parquet or Arrow file, see dataset_table().
+        :param dataset: a HashDataset.
+        :param path: a file path ending with .parquet or .arrow.
+        """
+        ArrowUtils.write_table(ArrowUtils.dataset_table(dataset), path)
+        print("\tDataset exported into {}".format(path))
+
+    @staticmethod
+    def read_table(path):
+        """
+        :param path: a file path ending with .parquet or .arrow.
+        :return: the pyarrow Table of the file.
+        """
+        ArrowUtils.require()
+        if ArrowUtils.format_of(path) == 'parquet':
+            return pq.read_table(path)
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    @staticmethod
+    def read_dataset(path):
+        """
+        Read a dataset exported by write_dataset().
+        :param path: the file.
+        :return: a HashDataset.
+        """
+        table = ArrowUtils.read_table(path)
+        settings = {key.decode(): value.decode() for key, value in table.schema.metadata.items()}
+        hash_column = table.column('hash').combine_chunks()
+        width = hash_column.type.byte_width
+        packed = np.frombuffer(hash_column.buffers()[1], dtype=np.uint8)[
+            hash_column.offset * width:(hash_column.offset + len(hash_column)) * width]
+        hashes = HashDataset.unpack_digits(packed.reshape(len(hash_column), width), int(settings['hash_length']))
+        files = [os.path.join(os.fsdecode(directory), os.fsdecode(name))
+                 for directory, name in zip(table.column('directory').to_pylist(), table.column('name').to_pylist())]
+        metadata = {}
+        for name in table.column_names:
+            if name not in ['directory', 'name', 'hash']:
+                values = table.column(name).to_numpy()
+                # The strings are read as Python objects.
+                metadata[name] = values.astype(str) if values.dtype == object else values
+        return HashDataset(hashes, files, metadata=metadata, hash_size=int(settings['hash_size']),
+                           hash_algo=settings['hash_algo'])
+
+
+class BatchWriter(object):
+    """
+    Write record batches into a Parquet file or an Arrow IPC file, as they come.
+    """
+
+    def __init__(self, path, schema, output_format='parquet'):
+        ArrowUtils.require()
+        assert output_format in columnar_formats.values(), "{} isn't a columnar format.".format(output_format)
+        self.path = path
+        self.schema = schema
+        self.output_format = output_format
+        self.sink = None
+        self.writer = None
+
+    def __enter__(self):
+        if self.output_format == 'parquet':
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        else:
+            self.sink = pa.OSFile(self.path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+    def write_table(self, table):
+        self.writer.write_table(table)
+
+    def write_columns(self, columns):
+        """
+        Append a record batch.
+        :param columns: a dict name -> pyarrow Array, in the order of the schema.
+        """
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.schema))
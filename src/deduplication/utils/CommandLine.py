@@ -1,5 +1,7 @@
 import argparse
 
+size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
 
 class CommandLine(object):
 
@@ -11,3 +13,13 @@ class CommandLine(object):
             return False
         else:
             raise argparse.ArgumentTypeError('Boolean value expected.')
+
+    @staticmethod
+    def str2size(v):
+        """ Parse a size such as 512, 64K, 50M or 1.5G into a number of bytes. """
+        value = v.strip().upper().rstrip('B')
+        unit = value[-1] if value and value[-1] in size_units else ''
+        try:
+            return int(float(value[:len(value) - len(unit)]) * size_units[unit])
+        except ValueError:
+            raise argparse.ArgumentTypeError('Size value expected, for example 512K, 50M or 1G.')
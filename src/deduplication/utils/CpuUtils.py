@@ -0,0 +1,100 @@
+import math
+import os
+
+# cgroup v2 exposes "<quota> <period>" in cpu.max, cgroup v1 exposes them in two separate files.
+CGROUP_V2_CPU_MAX = ['/sys/fs/cgroup/cpu.max']
+CGROUP_V1_CPU_QUOTA = [('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us'),
+                       ('/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu,cpuacct/cpu.cfs_period_us')]
+
+# Scheduling priorities of the worker processes.
+# - normal: unchanged.
+# - low: nice 10.
+# - idle: nice 19 and SCHED_IDLE where available, so the process only runs when the CPU would be idle.
+# On Linux the I/O priority of a process follows its CPU priority unless it has been set explicitly.
+worker_priorities = ['normal', 'low', 'idle']
+
+
+class CpuUtils(object):
+
+    @staticmethod
+    def read_first_line(file_path):
+        try:
+            with open(file_path) as f:
+                return f.readline().strip()
+        except (OSError, IOError):
+            return None
+
+    @staticmethod
+    def cgroup_cpu_quota():
+        """
+        Retrieve the CPU quota of the cgroup (v2 or v1) that contains the process.
+        :return: the quota as a number of CPUs (float), or None if the cgroup isn't limited.
+        """
+        for cpu_max in CGROUP_V2_CPU_MAX:
+            line = CpuUtils.read_first_line(cpu_max)
+            if line is not None:
+                quota, period = (line.split() + ['100000'])[:2]
+                if quota == 'max':
+                    return None
+                return int(quota) / int(period)
+
+        for cfs_quota, cfs_period in CGROUP_V1_CPU_QUOTA:
+            quota = CpuUtils.read_first_line(cfs_quota)
+            period = CpuUtils.read_first_line(cfs_period)
+            if quota is not None and period is not None:
+                if int(quota) <= 0:
+                    return None
+                return int(quota) / int(period)
+
+        return None
+
+    @staticmethod
+    def available_cpus():
+        """
+        Number of CPUs the process can actually use: the CPUs of its affinity mask, bounded by the cgroup CPU quota.
+        os.cpu_count() and multiprocessing.cpu_count() return all the CPUs of the host, even inside a container.
+        :return: the number of usable CPUs.
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            number_of_cpu = len(os.sched_getaffinity(0))
+        else:
+            number_of_cpu = os.cpu_count() or 1
+
+        quota = CpuUtils.cgroup_cpu_quota()
+        if quota is not None:
+            number_of_cpu = min(number_of_cpu, max(1, math.ceil(quota)))
+
+        return number_of_cpu
+
+    @staticmethod
+    def number_of_workers(workers=None):
+        """
+        Number of worker processes to use.
+        :param workers: an explicit number of workers, overriding the detected CPUs.
+        :return: the number of workers.
+        """
+        if workers is not None:
+            if workers < 1:
+                raise ValueError("Number of workers must be greater than or equal to 1.")
+            return workers
+        return CpuUtils.available_cpus()
+
+    @staticmethod
+    def set_priority(priority='normal'):
+        """
+        Lower the scheduling priority of the current process.
+        :param priority: one of worker_priorities.
+        """
+        assert priority in worker_priorities, "{} isn't a valid priority.".format(priority)
+
+        if priority == 'normal' or not hasattr(os, 'nice'):
+            return
+
+        niceness = 10 if priority == 'low' else 19
+        os.nice(max(0, niceness - os.nice(0)))
+
+        if priority == 'idle' and hasattr(os, 'sched_setscheduler') and hasattr(os, 'SCHED_IDLE'):
+            try:
+                os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+            except OSError as e:
+                print("Unable to set the idle scheduling policy. %s" % e)
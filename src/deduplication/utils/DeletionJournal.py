@@ -0,0 +1,118 @@
+import json
+import os
+from contextlib import contextmanager
+
+# The first line of a journal.
+JOURNAL_HEADER = {'format': 'deduplication-deletion-journal', 'version': 1}
+
+# Operations of the records.
+INTENT = 'intent'
+DONE = 'done'
+UNDONE = 'undone'
+
+
+class DeletionJournal(object):
+    """
+    Write-ahead journal of the deletions of a run.
+
+    The journal is a JSON Lines file: after the header, plan() writes an 'intent' record for every image to delete
+    or to quarantine and syncs them to disk before any image is touched. Each image deleted or quarantined is then
+    recorded as 'done' and each image restored by an undo as 'undone', these records are synced every sync_every
+    records. After a crash the intents that aren't done are the work left to resume, the intents that are done are
+    the images to restore to undo the run.
+    """
+
+    def __init__(self, journal_path, sync_every=1024):
+        self.journal_path = journal_path
+        self.sync_every = sync_every
+
+    def exists(self):
+        return os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0
+
+    def plan(self, entries):
+        """
+        Append the intents and sync them to disk. The header is written first if the journal is new.
+        :param entries: an iterable of dicts with keys 'file' (the image), 'action' ('delete' or 'quarantine'),
+        'backup' (the path of its backup or None) and 'quarantined' (its path in the quarantine or None).
+        :return: the number of intents.
+        """
+        if self.exists():
+            # Check the header and drop a truncated line.
+            self.load()
+
+        count = 0
+        with open(self.journal_path, 'a') as f:
+            if f.tell() == 0:
+                f.write(json.dumps(JOURNAL_HEADER) + '\n')
+            for entry in entries:
+                f.write(json.dumps(dict(entry, op=INTENT)) + '\n')
+                count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        return count
+
+    def load(self):
+        """
+        Read the journal.
+        :return: the list of the intents, in order, the set of the images done and the set of the images undone. A
+        new intent for an image, e.g. of a later run in the same output directory, replaces its previous records.
+        """
+        if not self.exists():
+            raise ValueError("{} isn't a deletion journal.".format(self.journal_path))
+
+        # image -> its last intent
+        intents = {}
+        done = set()
+        undone = set()
+        complete = 0
+        with open(self.journal_path, 'rb') as f:
+            for i, line in enumerate(f):
+                # The last line is truncated if the process has been killed while writing it.
+                if not line.endswith(b'\n'):
+                    break
+                complete += len(line)
+                record = json.loads(line.decode('utf-8'))
+                if i == 0:
+                    if record != JOURNAL_HEADER:
+                        raise ValueError("{0} has an unsupported format: {1}.".format(self.journal_path, record))
+                    continue
+                operation = record.pop('op')
+                if operation == INTENT:
+                    intents.pop(record['file'], None)
+                    intents[record['file']] = record
+                    done.discard(record['file'])
+                    undone.discard(record['file'])
+                elif operation == DONE:
+                    done.add(record['file'])
+                    undone.discard(record['file'])
+                elif operation == UNDONE:
+                    undone.add(record['file'])
+
+        # Drop the truncated line, so the next records are appended after the last complete line.
+        if complete < os.path.getsize(self.journal_path):
+            os.truncate(self.journal_path, complete)
+
+        return list(intents.values()), done, undone
+
+    @contextmanager
+    def recorder(self):
+        """
+        Append records to the journal.
+        :return: a function record(op, file) that appends a 'done' or 'undone' record, the records are synced every
+        sync_every records and when the context exits.
+        """
+        with open(self.journal_path, 'a') as f:
+            count = [0]
+
+            def record(operation, file):
+                f.write(json.dumps({'op': operation, 'file': file}) + '\n')
+                count[0] += 1
+                if count[0] % self.sync_every == 0:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            try:
+                yield record
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
@@ -1,7 +1,30 @@
+import errno
 import os
 import shutil
+import struct
+import sys
 from pathlib import Path
 
+# Linux FIEMAP ioctl, see linux/fiemap.h and linux/fs.h.
+# struct fiemap is 32 bytes and each struct fiemap_extent is 56 bytes.
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER_FORMAT = '=QQLLLL'
+FIEMAP_EXTENT_FORMAT = '=QQQQQLLLL'
+
+# Linux FICLONE ioctl: the destination shares the extents of the source until one of them is written (reflink).
+FICLONE = 0x40049409
+
+# The errors of a hard link or a reflink that mean that the filesystem can't do it, the file must be copied.
+LINK_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.EMLINK,
+               errno.ENOSYS}
+
+# The links made by replace_with_link().
+link_methods = ['hardlink', 'reflink', 'symlink']
+
+# The methods tried in turn by link_or_copy().
+backup_methods = {'auto': ('reflink', 'hardlink', 'copy'), 'reflink': ('reflink', 'copy'),
+                  'hardlink': ('hardlink', 'copy'), 'copy': ('copy',)}
+
 
 class FileSystem(object):
 
@@ -39,6 +62,131 @@ class FileSystem(object):
             except IOError as e:
                 print("Unable to copy file. %s" % e)
 
+    @staticmethod
+    def reflink(file_path, dest_path):
+        """
+        Clone a file with the Linux FICLONE ioctl, on filesystems that support it (Btrfs, XFS, ...).
+        :raise OSError: if the file can't be cloned, the destination is removed.
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "FICLONE is only available on Linux", dest_path)
+
+        import fcntl
+
+        with open(file_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(dest_path)
+                raise
+        shutil.copymode(file_path, dest_path)
+
+    @staticmethod
+    def link_or_copy(file_path, dest_path, methods=backup_methods['auto'], unsupported=None):
+        """
+        Make dest_path a backup of file_path with the first method that works: 'reflink', 'hardlink' or 'copy'.
+        An existing dest_path is replaced.
+        :param file_path: the file.
+        :param dest_path: the path of the backup.
+        :param methods: the methods tried in turn.
+        :param unsupported: a set of the methods that the filesystem can't do, updated and skipped. It saves the
+        failing system calls when it's shared by the files of a backup.
+        :return: the method used and the number of bytes copied.
+        """
+        unsupported = set() if unsupported is None else unsupported
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        for method in methods:
+            if method in unsupported:
+                continue
+            try:
+                if method == 'reflink':
+                    FileSystem.reflink(file_path, dest_path)
+                    return method, 0
+                if method == 'hardlink':
+                    os.link(file_path, dest_path)
+                    return method, 0
+                shutil.copy(file_path, dest_path)
+                return method, os.path.getsize(dest_path)
+            except OSError as e:
+                if method == 'copy' or e.errno not in LINK_ERRNOS:
+                    raise
+                unsupported.add(method)
+        raise OSError(errno.ENOTSUP, "None of the methods {} is supported".format(methods), dest_path)
+
+    @staticmethod
+    def move_file(file_path, dest_path):
+        """
+        Move a file with a rename, or across filesystems with a copy that is synced to the disk before the file is
+        removed. An existing dest_path is replaced.
+        :return: 'rename' and 0, or 'copy' and the number of bytes copied.
+        """
+        try:
+            os.rename(file_path, dest_path)
+            return 'rename', 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        tmp_path = dest_path + '.tmp'
+        shutil.copy2(file_path, tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, dest_path)
+        os.remove(file_path)
+        return 'copy', os.path.getsize(dest_path)
+
+    @staticmethod
+    def replace_with_link(target_path, file_path, link_method='hardlink', file_stat=None, target_stat=None):
+        """
+        Replace a file with a link to another file. The file and the target are first checked against the size and
+        the modification time recorded when they were hashed, so an image changed since then is never replaced. The
+        link is made aside and renamed over the file, so the readers of file_path never find it missing.
+        :param target_path: the file to link to.
+        :param file_path: the file to replace.
+        :param link_method: 'hardlink', 'reflink' (a copy-on-write clone) or 'symlink' (an absolute symbolic link).
+        :param file_stat: the (size, modification time) that file_path must still have, None to skip the check. The
+        modification time isn't checked when it's None.
+        :param target_stat: the same for target_path.
+        :return: the number of bytes of the replaced file.
+        :raise OSError: if a file has changed or the link can't be made, file_path is left untouched.
+        """
+        assert link_method in link_methods, "{} isn't a valid link method.".format(link_method)
+        if not os.path.isfile(target_path) or os.path.getsize(target_path) == 0:
+            raise OSError(errno.ENOENT, "The target is missing or empty", target_path)
+        for path, expected in [(file_path, file_stat), (target_path, target_stat)]:
+            if expected is not None and not FileSystem.unchanged(path, *expected):
+                raise OSError(errno.ESTALE, "The file has changed since it was hashed", path)
+        replaced = os.path.getsize(file_path)
+
+        directory, name = os.path.split(file_path)
+        tmp_path = os.path.join(directory, '.{}.link.tmp'.format(name))
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            if link_method == 'hardlink':
+                os.link(target_path, tmp_path)
+            elif link_method == 'reflink':
+                FileSystem.reflink(target_path, tmp_path)
+            else:
+                os.symlink(os.path.abspath(target_path), tmp_path)
+            os.replace(tmp_path, file_path)
+        except OSError:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return replaced
+
+    @staticmethod
+    def unchanged(file_path, size, mtime=None):
+        """
+        :return: whether a file still has a size and a modification time, the modification time isn't checked when
+        it's None.
+        """
+        stat = os.stat(file_path)
+        return stat.st_size == size and (mtime is None or stat.st_mtime == mtime)
+
     @staticmethod
     def find_a_specific_parent_dir(file_path, parent_dir_name):
         if str(file_path) == os.path.sep:
@@ -47,3 +195,61 @@ class FileSystem(object):
             return Path(file_path).parent
         else:
             return FileSystem.find_a_specific_parent_dir(Path(file_path).parent, parent_dir_name)
+
+    @staticmethod
+    def first_extent(file_path):
+        """
+        Physical offset of the first extent of a file, using the Linux FIEMAP ioctl.
+        :param file_path: a file path.
+        :return: the physical offset in bytes or None if FIEMAP isn't available or the file has no extents.
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+
+        import fcntl
+
+        # Ask for the first extent only: fm_start=0, fm_length=~0, fm_extent_count=1.
+        response = bytearray(struct.pack(FIEMAP_HEADER_FORMAT, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) +
+                             bytes(struct.calcsize(FIEMAP_EXTENT_FORMAT)))
+        try:
+            with open(file_path, 'rb') as f:
+                fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, response, True)
+        except OSError:
+            return None
+
+        header_size = struct.calcsize(FIEMAP_HEADER_FORMAT)
+        mapped_extents = struct.unpack_from(FIEMAP_HEADER_FORMAT, response)[3]
+        if mapped_extents == 0:
+            return None
+        # fe_logical, fe_physical, ...
+        return struct.unpack_from(FIEMAP_EXTENT_FORMAT, response, header_size)[1]
+
+    @staticmethod
+    def disk_locality_order(file_list, method='inode', return_indices=False):
+        """
+        Sort a list of files by their physical locality on disk, in order to reduce the seeks on spinning disks.
+
+        Files are sorted by the physical offset of their first extent (method='fiemap', Linux only) or by their
+        inode number (method='inode'). Files whose key can't be retrieved keep their relative position in
+        file_list (directory order) and are scheduled after the others.
+        :param file_list: a list of file paths in directory order.
+        :param method: 'fiemap' or 'inode'.
+        :param return_indices: return the positions of the files in file_list instead of their paths.
+        :return: the sorted list of file paths.
+        """
+        assert method in ['fiemap', 'inode'], "{} isn't a valid disk locality method.".format(method)
+
+        def locality_key(file_path):
+            if method == 'fiemap':
+                physical = FileSystem.first_extent(file_path)
+                if physical is not None:
+                    return 0, physical
+            try:
+                return 1, os.stat(file_path).st_ino
+            except OSError:
+                return 2, 0
+
+        # sorted() is stable, so the files that share a key stay in directory order.
+        if return_indices:
+            return sorted(range(0, len(file_list)), key=lambda i: locality_key(file_list[i]))
+        return sorted(file_list, key=locality_key)
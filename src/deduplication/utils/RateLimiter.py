@@ -0,0 +1,56 @@
+import time
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the number of bytes and/or files read per second.
+
+    Each bucket holds up to `burst` seconds of tokens. A read larger than the available tokens is allowed and puts
+    the bucket in debt, the next reads wait until the debt is paid off.
+    """
+
+    def __init__(self, bytes_per_second=None, files_per_second=None, burst=1.0):
+        self.bytes_per_second = bytes_per_second
+        self.files_per_second = files_per_second
+        self.burst = burst
+        # Total time spent waiting for tokens.
+        self.waited = 0.0
+
+        self._last = time.monotonic()
+        self._byte_tokens = bytes_per_second * burst if bytes_per_second else 0.0
+        self._file_tokens = files_per_second * burst if files_per_second else 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.bytes_per_second) or bool(self.files_per_second)
+
+    def acquire(self, nbytes=0, nfiles=1):
+        """
+        Take the tokens needed to read nbytes bytes from nfiles files, sleeping if there aren't enough.
+        :param nbytes: the number of bytes to read.
+        :param nfiles: the number of files to read.
+        :return: the time waited in seconds.
+        """
+        if not self.enabled:
+            return 0.0
+
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+
+        wait = 0.0
+        if self.bytes_per_second:
+            self._byte_tokens = min(self.bytes_per_second * self.burst,
+                                    self._byte_tokens + elapsed * self.bytes_per_second) - nbytes
+            if self._byte_tokens < 0:
+                wait = max(wait, -self._byte_tokens / self.bytes_per_second)
+        if self.files_per_second:
+            self._file_tokens = min(self.files_per_second * self.burst,
+                                    self._file_tokens + elapsed * self.files_per_second) - nfiles
+            if self._file_tokens < 0:
+                wait = max(wait, -self._file_tokens / self.files_per_second)
+
+        if wait > 0:
+            time.sleep(wait)
+            self.waited += wait
+        return wait